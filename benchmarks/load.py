@@ -0,0 +1,220 @@
+"""End-to-end load benchmark against a simulated Factorio server
+
+Runs the status UI in-process against a fake RCON server & mod portal (see
+factorio_status_ui.simulator) with the given numbers of players and mods, and
+measures:
+
+* RCON cycle latency: how long a full poll of the players, and of the config, takes
+* Page throughput: requests per second & latency of each page under concurrent load,
+  while players keep joining and leaving
+* Memory: peak RSS, and optionally the memory allocated by the UI (--trace-memory)
+
+The load is generated from the same process, so compare figures between
+changes rather than reading them as absolute capacity.
+
+    PYTHONPATH=. python benchmarks/load.py --players 10000 --mods 500 --latency 0.02
+"""
+import argparse
+import asyncio
+import resource
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+from factorio_status_ui import handlers, serve, simulator, web as status_web
+from factorio_status_ui.state import application_config, configure_servers, mod_database, servers
+
+PATHS = ['/', '/api/status', '/api/players', '/api/mods']
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def format_latencies(values):
+    return 'mean {:.2f}ms, p50 {:.2f}ms, p99 {:.2f}ms'.format(
+        sum(values) / len(values) * 1000 if values else 0,
+        percentile(values, 0.5) * 1000,
+        percentile(values, 0.99) * 1000,
+    )
+
+
+def peak_rss_mb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def wait_until(condition, timeout, description):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError('Timed out waiting for {}'.format(description))
+        await asyncio.sleep(0.1)
+
+
+async def time_cycles(poller, cycles, factorio, churn):
+    durations = []
+    for _ in range(cycles):
+        factorio.churn(churn)
+        start = time.perf_counter()
+        await poller()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def load_page(url, concurrency, duration):
+    latencies = []
+    errors = 0
+    received = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(session):
+        nonlocal errors, received
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.get(url, headers={'Accept-Encoding': 'gzip'}) as response:
+                    received += len(await response.read())
+                    if response.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    return latencies, errors, received
+
+
+async def churn_players(factorio, count, interval=1):
+    while True:
+        await asyncio.sleep(interval)
+        factorio.churn(count)
+
+
+async def run(args, directory: Path):
+    if args.trace_memory:
+        tracemalloc.start()
+
+    names = simulator.make_mods_directory(directory / 'mods', args.mods, seed=1)
+    (directory / 'saves').mkdir()
+    factorio = simulator.FakeFactorio(password='benchmark', players=args.players, online=args.online,
+                                      admins=args.admins, latency=args.latency, jitter=args.jitter, seed=1)
+    portal = simulator.FakeModPortal(names, seed=1)
+    rcon_port = await factorio.start()
+    await portal.start()
+
+    argv = [
+        '--rcon-host=127.0.0.1', '--rcon-port={}'.format(rcon_port), '--rcon-password=benchmark',
+        '--rcon-timeout=10', '--poll-idle-factor=1', '--mods-directory={}'.format(directory / 'mods'),
+        '--saves-directory={}'.format(directory / 'saves'), '--mod-portal-url={}'.format(portal.url),
+        '--mod-portal-cache={}'.format(directory / 'mod-portal.json'),
+        '--all-mods-directory={}'.format(directory / 'all-mods'),
+        '--history-directory={}'.format(directory / 'history'),
+        '--snapshot-directory={}'.format(directory / 'snapshot'),
+    ]
+    if args.lua:
+        argv.append('--rcon-lua-batching')
+    arguments = serve.get_parser().parse_args(argv)
+    for option in dir(application_config):
+        if not option.startswith('_'):
+            setattr(application_config, option, getattr(arguments, option))
+    configure_servers()
+    server = servers['default']
+
+    app = web.Application()
+    status_web.setup_routes(app)
+    status_web.setup_templates(app)
+    app.on_startup.append(status_web.start_background_tasks)
+    app.on_startup.append(status_web.get_version)
+    app.on_cleanup.append(status_web.cleanup_background_tasks)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = simulator.bind_socket('127.0.0.1', 0)
+    base_url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+    await web.SockSite(runner, sock).start()
+
+    try:
+        start = time.perf_counter()
+        await wait_until(lambda: len(server.players) >= args.players and server.mods and mod_database,
+                         args.timeout, 'the initial state')
+        print('Warm up: {:.2f}s to load {:,} players & {:,} mods. Peak RSS {:.1f} MB'.format(
+            time.perf_counter() - start, len(server.players), len(server.mods), peak_rss_mb()
+        ))
+        if args.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            print('Allocated: {:.1f} MB now, {:.1f} MB peak'.format(current / 1024 / 1024, peak / 1024 / 1024))
+
+        rcon = app['rcon'][server.slug]
+        pollers = [
+            ('players', status_web.PlayersPoller(server, rcon)),
+            ('config', status_web.ConfigPoller(rcon, partial(handlers.handle_config, server))),
+        ]
+        print('\nRCON cycles ({} each, {} players changing per cycle):'.format(args.cycles, args.churn))
+        for name, poller in pollers:
+            durations = await time_cycles(poller, args.cycles, factorio, args.churn)
+            print('{:>12}: {}'.format(name, format_latencies(durations)))
+
+        print('\nPages ({} concurrent clients for {}s each, {} players changing per second):'.format(
+            args.concurrency, args.duration, args.churn
+        ))
+        factorio.drop_rate = args.drop_rate
+        reconnects = server.rcon_health.reconnects
+        churn = asyncio.ensure_future(churn_players(factorio, args.churn))
+        try:
+            for path in PATHS:
+                latencies, errors, received = await load_page(base_url + path, args.concurrency, args.duration)
+                print('{:>12}: {:,.0f} req/s, {}, {:,.0f} bytes/response (decoded){}'.format(
+                    path, len(latencies) / args.duration, format_latencies(latencies),
+                    received / max(1, len(latencies) - errors), ', {} errors'.format(errors) if errors else ''
+                ))
+        finally:
+            churn.cancel()
+            factorio.drop_rate = 0
+        if args.drop_rate:
+            print('RCON reconnects under load: {}'.format(server.rcon_health.reconnects - reconnects))
+
+        print('\nPeak RSS: {:.1f} MB'.format(peak_rss_mb()))
+        if args.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            print('Allocated: {:.1f} MB now, {:.1f} MB peak'.format(current / 1024 / 1024, peak / 1024 / 1024))
+    finally:
+        await runner.cleanup()
+        await portal.close()
+        await factorio.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=1000, help='Players known to the server.')
+    parser.add_argument('--online', type=int, default=100, help='Players online at the start.')
+    parser.add_argument('--admins', type=int, default=5, help='Admins among the players.')
+    parser.add_argument('--mods', type=int, default=100, help='Mods installed.')
+    parser.add_argument('--churn', type=int, default=5, help='Players joining or leaving per cycle/second.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each RCON reply.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more seconds per reply.')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Chance of the RCON connection being dropped per command during the page load.')
+    parser.add_argument('--lua', action='store_true', help='Poll players with a single Lua command.')
+    parser.add_argument('--cycles', type=int, default=50, help='RCON poll cycles to time.')
+    parser.add_argument('--concurrency', type=int, default=20, help='Concurrent page requests.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of load per page.')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for the initial state.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Report memory allocated by Python. Slows everything down.')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        loop.run_until_complete(run(args, Path(directory)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark of handling /players output for servers with long player histories
+
+Compares the current handle_players() against the original implementation,
+which scanned the whole player list for every line of output.
+
+    python benchmarks/player_registry.py --players 10000 50000
+"""
+import argparse
+import time
+from functools import partial
+
+from factorio_status_ui import handlers
+from factorio_status_ui.state import Player, Server
+
+
+def legacy_handle_players(server, player_data: bytes):
+    """The original implementation, kept here for comparison"""
+    player_data = player_data.decode('utf8')
+    for player_line in player_data.split('\n')[1:]:
+        username, *extra = player_line.strip().split(' ', 1)
+        player_found = False
+        for player in server.players:
+            if player.username == username:
+                player.is_online = '(online)' in extra
+                player_found = True
+        if not player_found:
+            server.players.append(Player(username=username, is_online='(online)' in extra))
+
+
+def players_output(players, poll):
+    """/players output where a different tenth of the players are online on each poll"""
+    lines = ['Players ({}):'.format(players)]
+    for i in range(players):
+        online = (i + poll) % 10 == 0
+        lines.append('  player-{}{}'.format(i, ' (online)' if online else ''))
+    return '\n'.join(lines).encode('utf8')
+
+
+def time_polls(handle, outputs):
+    start = time.perf_counter()
+    for output in outputs:
+        handle(output)
+    return (time.perf_counter() - start) / len(outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, nargs='+', default=[10000, 50000], help='Player counts to test.')
+    parser.add_argument('--polls', type=int, default=5, help='Polls to time per player count.')
+    parser.add_argument('--skip-legacy-above', type=int, default=20000,
+                        help='Skip the (quadratic) original implementation above this many players.')
+    args = parser.parse_args()
+
+    for players in args.players:
+        outputs = [players_output(players, poll) for poll in range(args.polls)]
+
+        current = time_polls(partial(handlers.handle_players, Server()), outputs)
+        result = '{:>7,} players: current {:9.2f} ms/poll'.format(players, current * 1000)
+
+        if players <= args.skip_legacy_above:
+            legacy_server = Server(players=[])
+            legacy = time_polls(lambda output: legacy_handle_players(legacy_server, output), outputs[:2])
+            result += ', original {:9.2f} ms/poll'.format(legacy * 1000)
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Micro-benchmark of RCON response decoding
+
+Streams a large number of /players-sized responses from a local fake RCON
+server and measures how quickly they are decoded, comparing the current
+frame reader against the original read()-based implementation.
+
+    python benchmarks/rcon_decode.py --players 5000 --frames 200
+"""
+import argparse
+import asyncio
+import struct
+import time
+from functools import partial
+
+from factorio_status_ui import rcon
+
+
+async def legacy_get_response(reader):
+    """The original implementation, kept here for comparison"""
+    response_size, = struct.unpack('=l', await reader.read(4))
+    message_format = ''.join(['=ll', str(response_size - 9), 's1s'])
+    response_data = await reader.read(response_size)
+    response_id, response_type, response_string, response_dummy = struct.unpack(message_format, response_data)
+    return response_string.rstrip(b'\x00\n'), response_id, response_type
+
+
+def make_players_frame(players):
+    lines = ['Players ({}):'.format(players)]
+    lines.extend('  player-{}{}'.format(i, ' (online)' if i % 10 == 0 else '') for i in range(players))
+    body = '\n'.join(lines).encode('utf8')
+    return rcon.PACKET_HEADER_STRUCT.pack(len(body) + 10, 1, rcon.MESSAGE_TYPE_RESP) + body + b'\x00\x00'
+
+
+async def run(decoder, frame, frames, port):
+    async def serve(reader, writer):
+        try:
+            for _ in range(frames):
+                writer.write(frame)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(serve, '127.0.0.1', port)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    decoded = 0
+    error = None
+    start = time.perf_counter()
+    try:
+        for _ in range(frames):
+            await decoder(reader)
+            decoded += 1
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    elapsed = time.perf_counter() - start
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return decoded, len(frame) * decoded / elapsed, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=5000, help='Players listed per response.')
+    parser.add_argument('--frames', type=int, default=200, help='Responses to decode per run.')
+    parser.add_argument('--port', type=int, default=27115, help='Port for the local fake RCON server.')
+    args = parser.parse_args()
+
+    frame = make_players_frame(args.players)
+    print('Frame size: {:,} bytes, {} frames'.format(len(frame), args.frames))
+
+    loop = asyncio.get_event_loop()
+    for name, decoder in [('legacy', legacy_get_response), ('current', partial(rcon.get_response, timeout=10))]:
+        decoded, rate, error = loop.run_until_complete(run(decoder, frame, args.frames, args.port))
+        print('{:>8}: {:,.1f} MB/s, {}/{} frames decoded{}'.format(
+            name, rate / 1024 / 1024, decoded, args.frames, ' (failed: {})'.format(error) if error else ''
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""The admin console: RCON commands sent by authenticated admins
+
+Admins are identified by bearer tokens, listed in ``--admin-tokens-file`` as
+a JSON object of user names to tokens::
+
+    {"alice": "5d41402abc4b2a76b9719d911017c592", "bob": "7d793037a0760186574b0282f2f435e7"}
+
+Their commands go ahead of the background polls on the shared RCON
+connection (see rcon.CommandQueue), and each admin is rate limited, so the
+load on the game server stays predictable.
+"""
+import hmac
+import json
+import time
+from pathlib import Path
+
+
+class RateLimiter(object):
+    """A token bucket per user, allowing ``burst`` commands at once refilled at ``rate`` per minute"""
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate / 60
+        self.burst = burst
+        self.clock = clock
+        self._buckets = {}  # user -> (tokens, updated)
+
+    def check(self, user: str) -> float:
+        """Use up one of the user's commands, returning 0, or the seconds until they may try again"""
+        now = self.clock()
+        tokens, updated = self._buckets.get(user, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[user] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[user] = (tokens - 1, now)
+        return 0
+
+
+def load_tokens(path: Path) -> dict:
+    """Read the tokens file, returning {token: user name}"""
+    with open(path) as f:
+        users = json.load(f)
+    if not isinstance(users, dict) or not all(isinstance(token, str) and token for token in users.values()):
+        raise ValueError('Expected a JSON object of user names to tokens')
+    return {token: user for user, token in users.items()}
+
+
+class AdminConsole(object):
+    """Who may send commands, and how often"""
+
+    def __init__(self, tokens_file: Path, rate: float, burst: int):
+        self.tokens = load_tokens(tokens_file)
+        self.limiter = RateLimiter(rate, burst)
+
+    def authenticate(self, authorization: str) -> str:
+        """The user whose token is given in an Authorization header, or None"""
+        scheme, _, given = authorization.partition(' ')
+        if scheme.lower() != 'bearer' or not given.strip():
+            return None
+        given = given.strip().encode('utf8')
+        user = None
+        # Compare against every token in constant time, so that timing reveals nothing
+        for token, name in self.tokens.items():
+            if hmac.compare_digest(token.encode('utf8'), given):
+                user = name
+        return user
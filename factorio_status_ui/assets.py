@@ -0,0 +1,281 @@
+"""Bundling the pages' CSS & JavaScript into single fingerprinted files
+
+Run at build time (the Docker image does so)::
+
+    python -m factorio_status_ui.assets
+
+Each bundle, and every file its CSS refers to (fonts & images), is written
+to the output directory under a name containing a hash of its content, along
+with gzip and (if the brotli package is installed) brotli compressed copies.
+As the names change whenever the content does, they are served with
+``Cache-Control: immutable``. ``manifest.json`` maps each bundle to its
+current name, and records a hash of the sources it was built from so that
+edits to them are picked up.
+
+When the bundles can't be built (node_modules is missing from a checkout)
+the pages fall back to including each source file separately.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent.parent
+DEFAULT_OUTPUT_DIR = ROOT_DIR / 'assets'
+MANIFEST_FILE = 'manifest.json'
+
+# Relative to the root directory, in the order they are included. Only what the pages use: no Ionicons,
+# only the blue skin, and AdminLTE's own font stack rather than fetching Source Sans Pro from Google Fonts.
+BUNDLES = {
+    'app.css': [
+        'node_modules/bootstrap/dist/css/bootstrap.min.css',
+        'node_modules/font-awesome/css/font-awesome.min.css',
+        'node_modules/admin-lte/dist/css/AdminLTE.min.css',
+        'node_modules/admin-lte/dist/css/skins/skin-blue.min.css',
+        'static/styles.css',
+    ],
+    'app.js': [
+        'node_modules/jquery/dist/jquery.min.js',
+        'node_modules/bootstrap/dist/js/bootstrap.min.js',
+        'node_modules/admin-lte/dist/js/adminlte.min.js',
+        'node_modules/chart.js/Chart.min.js',
+        'static/live.js',
+        'static/history.js',
+    ],
+}
+
+# Relative url()s in stylesheets, with any query string or fragment (such as the "?#iefix" of fonts)
+URL_RE = re.compile(r'''url\(\s*(['"]?)(?![a-z]+:|/|#)([^'")?#]+)([?#][^'")]*)?\1\s*\)''')
+# Types worth compressing. Images & WOFF fonts are compressed already.
+COMPRESSIBLE_TYPES = {'.css', '.js', '.svg', '.ttf', '.eot'}
+
+# Not known to every Python version's mimetypes
+mimetypes.add_type('font/woff', '.woff')
+mimetypes.add_type('font/woff2', '.woff2')
+
+
+class AssetError(Exception): pass
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    stem, extension = posixpath.splitext(posixpath.basename(name))
+    return '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+def gzip_compress(data: bytes) -> bytes:
+    # Without a timestamp, so that a rebuild gives identical files
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def compress(name: str, data: bytes) -> dict:
+    """The data in each encoding worth serving, keyed by the encoding (None for none)"""
+    bodies = {None: data}
+    if posixpath.splitext(name)[1] in COMPRESSIBLE_TYPES:
+        bodies['gzip'] = gzip_compress(data)
+        if brotli:
+            bodies['br'] = brotli.compress(data)
+    # A compressed copy which is no smaller isn't worth sending
+    return {encoding: body for encoding, body in bodies.items() if encoding is None or len(body) < len(data)}
+
+
+class Builder(object):
+    """Builds the bundles, collecting the files they refer to along the way"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.files = {}  # fingerprinted name -> data
+        self._referenced = {}  # path -> fingerprinted name
+
+    def add(self, name: str, data: bytes) -> str:
+        fingerprinted = fingerprint(name, data)
+        self.files[fingerprinted] = data
+        return fingerprinted
+
+    def reference(self, path: Path) -> str:
+        """Add a file referred to by a stylesheet, returning its fingerprinted name"""
+        path = path.resolve()
+        if path not in self._referenced:
+            self._referenced[path] = self.add(path.name, path.read_bytes())
+        return self._referenced[path]
+
+    def rewrite_urls(self, css: str, directory: Path) -> str:
+        """Point a stylesheet's relative url()s at the fingerprinted files, which sit alongside the bundle"""
+        def replace(match):
+            quote, url, suffix = match.groups()
+            try:
+                name = self.reference(directory / url)
+            except OSError:
+                logger.warning('Stylesheet in {} refers to missing file {}'.format(directory, url))
+                return match.group(0)
+            return 'url({0}{1}{2}{0})'.format(quote, name, suffix or '')
+        return URL_RE.sub(replace, css)
+
+    def bundle(self, name: str, sources: list) -> str:
+        parts = []
+        for source in sources:
+            path = self.root / source
+            try:
+                content = path.read_text('utf8')
+            except OSError as e:
+                raise AssetError('Could not read {} for {}: {}. Has "npm install" been run?'.format(source, name, e))
+            if name.endswith('.css'):
+                content = self.rewrite_urls(content, path.parent)
+            parts.append('/* {} */\n{}'.format(source, content))
+        # Semicolons guard against scripts which don't end their last statement
+        separator = '\n' if name.endswith('.css') else '\n;\n'
+        return self.add(name, separator.join(parts).encode('utf8'))
+
+
+def sources_hash(root: Path) -> str:
+    """Hash the content of every bundle's sources, or None if any are missing"""
+    digest = hashlib.sha256()
+    for name, sources in sorted(BUNDLES.items()):
+        for source in sources:
+            try:
+                digest.update((root / source).read_bytes())
+            except OSError:
+                return None
+            digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def read_manifest(output: Path) -> dict:
+    try:
+        with open(output / MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_previous_build(output: Path):
+    try:
+        with open(output / MANIFEST_FILE) as f:
+            names = json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return
+    for name in names:
+        for suffix in ('', '.gz', '.br'):
+            try:
+                (output / (name + suffix)).unlink()
+            except FileNotFoundError:
+                pass
+
+
+def build(root: Path = ROOT_DIR, output: Path = DEFAULT_OUTPUT_DIR) -> dict:
+    """Build the bundles into the output directory, returning the manifest"""
+    builder = Builder(root)
+    bundles = {name: builder.bundle(name, sources) for name, sources in BUNDLES.items()}
+
+    output.mkdir(parents=True, exist_ok=True)
+    remove_previous_build(output)
+    for name, data in builder.files.items():
+        for encoding, body in compress(name, data).items():
+            suffix = {None: '', 'gzip': '.gz', 'br': '.br'}[encoding]
+            (output / (name + suffix)).write_bytes(body)
+
+    manifest = {'bundles': bundles, 'files': sorted(builder.files), 'sources': sources_hash(root)}
+    with open(output / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info('Built {} into {}'.format(', '.join(sorted(bundles.values())), output))
+    return manifest
+
+
+def ensure_built(root: Path = ROOT_DIR, output: Path = DEFAULT_OUTPUT_DIR) -> bool:
+    """Build the bundles if they are missing or out of date, such as when running from a checkout
+
+    Returns whether there are bundles to serve. An existing build is used
+    as-is when its sources are gone, as in the Docker image.
+    """
+    manifest = read_manifest(output)
+    sources = sources_hash(root)
+    if manifest and (sources is None or manifest.get('sources') == sources):
+        return True
+    if sources is None:
+        logger.warning('The CSS & JavaScript bundles cannot be built, as their sources are missing '
+                       '(has "npm install" been run?). Serving the files separately instead.')
+        return False
+
+    if manifest:
+        logger.warning('The CSS & JavaScript bundles are out of date, rebuilding them now.')
+    else:
+        logger.warning('The CSS & JavaScript bundles have not been built, building them now. '
+                       'Run "python -m factorio_status_ui.assets" when installing to avoid this.')
+    build(root, output)
+    return True
+
+
+class Asset(object):
+    """A built file, held in memory in each encoding it was built with"""
+
+    def __init__(self, name: str, bodies: dict):
+        self.name = name
+        self.bodies = bodies
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.charset = 'utf-8' if posixpath.splitext(name)[1] in ('.css', '.js') else None
+
+
+class Assets(object):
+    """The built assets, loaded from the output directory"""
+
+    def __init__(self, output: Path = DEFAULT_OUTPUT_DIR):
+        try:
+            with open(output / MANIFEST_FILE) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise AssetError('Could not load the assets from {}: {}'.format(output, e))
+        self.bundles = manifest['bundles']
+        self.files = {}
+        for name in manifest['files']:
+            bodies = {}
+            for encoding, suffix in ((None, ''), ('gzip', '.gz'), ('br', '.br')):
+                path = output / (name + suffix)
+                if path.exists():
+                    bodies[encoding] = path.read_bytes()
+            self.files[name] = Asset(name, bodies)
+
+    def urls(self, bundle: str) -> list:
+        return ['/assets/{}'.format(self.bundles[bundle])]
+
+
+class UnbundledAssets(object):
+    """Each of the bundles' sources, served separately from /lib (node_modules) & /static"""
+    files = {}
+
+    def urls(self, bundle: str) -> list:
+        return [
+            '/lib/{}'.format(source[len('node_modules/'):]) if source.startswith('node_modules/') else '/' + source
+            for source in BUNDLES[bundle]
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the fingerprinted CSS & JavaScript bundles')
+    parser.add_argument('--root', help='Directory containing node_modules/ and static/.', type=Path,
+                        default=ROOT_DIR)
+    parser.add_argument('--output', help='Where to write the bundles, replacing any previous build there.',
+                        type=Path, default=DEFAULT_OUTPUT_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s | %(message)s')
+    if not brotli:
+        logger.warning('The brotli package is not installed, so only gzip copies will be built')
+    build(args.root, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+subscriptions = set()
+
+
+class Subscription(object):
+    """A single client's queue of pending server-sent events for one server
+
+    A client which falls too far behind is marked as overflowed and
+    disconnected. Its browser will reconnect and receive a fresh snapshot.
+    """
+
+    def __init__(self, channel: str, max_pending=100):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def __enter__(self):
+        subscriptions.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        subscriptions.discard(self)
+
+    def put(self, message: bytes):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            # Wake up the reader so it notices
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+def encode_event(event: str, data) -> bytes:
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data)).encode('utf8')
+
+
+def subscriber_count(channel: str) -> int:
+    return sum(1 for subscription in subscriptions if subscription.channel == channel)
+
+
+def publish(channel: str, event: str, data):
+    """Send an event to every client connected to the channel (i.e. the server's slug)
+
+    The event is encoded once, no matter how many clients are connected.
+    """
+    receivers = [subscription for subscription in subscriptions if subscription.channel == channel]
+    if not receivers:
+        return
+    message = encode_event(event, data)
+    for subscription in receivers:
+        subscription.put(message)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Published {} event to {} clients of {}'.format(event, len(receivers), channel))
@@ -1,134 +1,230 @@
-import json
-import re
-import tempfile
+import asyncio
+from functools import wraps
 from pathlib import Path
 from typing import Tuple, List
 
 import logging
-from zipfile import ZipFile
 
-from datetime import datetime
-
-from factorio_status_ui.state import Player, server, mod_database, Mod, ServerConfig, application_config
+from factorio_status_ui import events, metrics, mod_archive, mod_info, mod_portal
+from factorio_status_ui.state import Player, Server, servers, mod_database, Mod, ServerConfig, application_config
+from factorio_status_ui.utils import handle_aio_exceptions
 
 logger = logging.getLogger(__name__)
 
+all_mods_lock = asyncio.Lock()
+
+
+def changes_state(handler):
+    """Bump the server's state version once the handler has run
+
+    Handlers take the server whose state they change as their first argument.
+    Cached renderings of the state are keyed on this version.
+    """
+    @wraps(handler)
+    def wrapper(server: Server, *args, **kwargs):
+        try:
+            with metrics.HANDLER_DURATION.time(handler=handler.__name__):
+                return handler(server, *args, **kwargs)
+        finally:
+            server.state_version += 1
+    return wrapper
+
 
-def handle_players(player_data: str):
+@changes_state
+def handle_players(server: Server, player_data: bytes):
     player_data = player_data.decode('utf8')
 
+    # The first line is a heading, then one line per player, e.g. "  bob (online)"
+    usernames = []
+    online = set()
     for player_line in player_data.split('\n')[1:]:
         username, *extra = player_line.strip().split(' ', 1)
+        if username:
+            usernames.append(username)
+            if '(online)' in extra:
+                online.add(username)
 
-        player_found = False
-        for player in server.players:
-            if player.username == username:
-                player.is_online = '(online)' in extra
-                player_found = True
+    added = server.players.add(usernames)
+    joined, left = server.players.set_online(online)
+    log_changes('Players', added=[p.username for p in added], joined=joined, left=left)
+    publish_players(server, added, joined, left)
+    if server.history and (joined or left):
+        server.history.players_changed(joined, left)
 
-        if not player_found:
-            server.players.append(Player(
-                username=username,
-                is_online='(online)' in extra
-            ))
 
-    logger.info('Players states changed: {}'.format(server.players))
-
-
-def handle_admins(admin_data: str):
+@changes_state
+def handle_admins(server: Server, admin_data: bytes):
     admin_data = admin_data.decode('utf8')
 
+    admins = []
     for admin_line in admin_data.split('\n'):
         username, *extra = admin_line.strip().split(' ', 1)
-
-        player_found = False
-        for player in server.players:
-            if player.username == username:
-                player.is_admin = True
-                player_found = True
-
-        if not player_found:
-            server.players.append(Player(
-                username=username,
-                is_admin = True
-            ))
-
-    logger.info('Players admin changed: {}'.format(server.players))
-
-
-def handle_mods(mods_json, mod_settings_json, files):
-    mod_data = json.loads(mods_json)['mods']
-    mod_settings = json.loads(mod_settings_json)
-
-    parsed_files = []
-    files_by_name = {}
-    for file in files:
-        matches = re.match(r'(.*)_([0-9\.]*[0-9])\.zip', file.name)
-        if matches:
-            mod_name, version = matches.groups()
-            mod_name = mod_name.replace('_', ' ')
-            parsed_files.append((mod_name, version, file))
-            files_by_name[mod_name] = (version, file)
-
+        if username:
+            admins.append(username)
+
+    added = server.players.add(admins)
+    promoted, demoted = server.players.set_admins(set(admins))
+    log_changes('Players', added=[p.username for p in added], promoted=promoted, demoted=demoted)
+    publish_players(server, added, promoted, demoted)
+
+
+@changes_state
+def handle_player_list(server: Server, data: dict):
+    """Handle the structured player list returned by PLAYER_LIST_LUA"""
+    entries = data.get('players') or []
+    if isinstance(entries, dict):
+        # Lua serialises an empty table as an object
+        entries = entries.values()
+
+    usernames = []
+    online = set()
+    admins = set()
+    for entry in entries:
+        usernames.append(entry['name'])
+        if entry.get('online'):
+            online.add(entry['name'])
+        if entry.get('admin'):
+            admins.add(entry['name'])
+
+    added = server.players.add(usernames)
+    joined, left = server.players.set_online(online)
+    promoted, demoted = server.players.set_admins(admins)
+    log_changes('Players', added=[p.username for p in added], joined=joined, left=left,
+                promoted=promoted, demoted=demoted)
+    publish_players(server, added, joined, left, promoted, demoted)
+    if server.history and (joined or left):
+        server.history.players_changed(joined, left)
+
+
+def log_changes(what: str, **changes):
+    """Log only what has changed, e.g. which players joined, rather than everything"""
+    changes = ['{} {}'.format(change, ', '.join(sorted(names))) for change, names in changes.items() if names]
+    if changes:
+        logger.info('{} changed: {}'.format(what, '; '.join(changes)))
+
+
+def publish_players(server: Server, *changes):
+    """Publish the new state of every player in the given lists/sets of players or usernames"""
+    usernames = set()
+    for change in changes:
+        usernames.update(p.username if isinstance(p, Player) else p for p in change)
+    if usernames:
+        events.publish(server.slug, 'players', [server.players.get(username).as_dict() for username in sorted(usernames)])
+
+
+@changes_state
+def handle_mods(server: Server, mod_data: list, mod_settings: dict, infos: List[mod_info.ModInfo]):
+
+    resolved, unused = mod_info.resolve(mod_data, infos)
     mods = []
-    for mod in mod_data:
-        name = mod['name'].replace('_', ' ')
-        if name in files_by_name:
-            version, file = files_by_name[name]
-        else:
-            version, file = None, None
-
+    for mod in resolved:
+        info = mod['info']
         mods.append(Mod(
-            name=name,
+            name=mod['name'],
             enabled=mod['enabled'],
-            version=version,
-            file=file,
+            version=info.version if info else None,
+            file=info.file if info else None,
+            title=info.title if info else None,
+            dependents=tuple(mod['dependents']),
+            problems=tuple(mod['problems']),
         ))
 
+    previous = {mod.name: mod for mod in server.mods}
+    previous_unused = server.unused_mod_files
     server.mods = tuple(mods)
+    server.mods_by_file_name = {mod.file.name: mod for mod in mods if mod.file}
+    server.unused_mod_files = unused
     server.mod_settings = mod_settings
-    logger.info('Mods changed: {}'.format(', '.join(m.name for m in mods if m.enabled)))
-    logger.info('Mods changed (disabled): {}'.format(', '.join(m.name for m in mods if not m.enabled)))
-
-    refresh_all_mods_file()
-
-
-def refresh_all_mods_file():
-    # TODO: This is blocking, perhaps put it in a different executor
-    logger.info('Refreshing all mods zip file')
-    all_mods_dir = Path(tempfile.gettempdir()) / 'factorio-status-ui'
-    all_mods_dir.mkdir(exist_ok=True)
-    tmp_zip_path = all_mods_dir / 'tmp.zip'
-    with ZipFile(tmp_zip_path, mode='w') as tmp_zip:
-        for mod in server.mods:
-            if mod.file and mod.enabled:
-                tmp_zip.write(mod.file, arcname=Path('mods') / mod.file.name)
-
-        extras = [
-            application_config.mods_directory / 'mod-list.json',
-            application_config.mods_directory / 'mod-settings.json',
-        ]
-        for extra in extras:
-            if extra.exists():
-                tmp_zip.write(extra, arcname=Path('mods') / extra.name)
-
-    all_mods_file = all_mods_dir / 'all-mods-{}.zip'.format(datetime.now().strftime('%Y-%m-%d_%H-%m-%S'))
-    tmp_zip_path.rename(all_mods_file)
-    server.all_mods_file = all_mods_file
-    logger.info('Written all mods zip file to {}'.format(all_mods_file))
-
-
-def handle_mod_database(data):
-    tmp_database = {}
-    for mod in data['results']:
-        if 'name' in mod:
-            tmp_database[mod['name']] = mod
-    if tmp_database:
-        mod_database.update(tmp_database)
-    logger.info('Mod database changed. {} mods found.'.format(len(mod_database)))
-
-
-def handle_config(config: dict):
+
+    kept = [(previous[mod.name], mod) for mod in mods if mod.name in previous]
+    log_changes(
+        'Mods',
+        added=[mod.name for mod in mods if mod.name not in previous],
+        removed=set(previous) - {mod.name for mod in mods},
+        enabled=[mod.name for old, mod in kept if mod.enabled and not old.enabled],
+        disabled=[mod.name for old, mod in kept if old.enabled and not mod.enabled],
+        updated=['{} {}'.format(mod.name, mod.version) for old, mod in kept if mod.version != old.version],
+    )
+    for mod in mods:
+        if mod.problems and (mod.name not in previous or mod.problems != previous[mod.name].problems):
+            logger.warning('Mod {} has problems: {}'.format(mod.name, '; '.join(mod.problems)))
+    if unused and unused != previous_unused:
+        logger.info('Unused mod files: {}'.format(', '.join(file.name for file in unused)))
+    events.publish(server.slug, 'mods', [mod.as_dict() for mod in mods])
+    mod_portal.installed_mods_have_changed()
+
+    if not server.settings.stream_all_mods:
+        asyncio.ensure_future(handle_aio_exceptions(refresh_all_mods_file(server)))
+
+
+async def refresh_all_mods_file(server: Server):
+    """Make sure the all mods zip file for the server's current mods exists, building it if needed
+
+    Refreshes are serialised, and each one works from the latest state, so a
+    burst of changes results in at most one extra build. The archives are
+    keyed on their contents, so servers with the same mods share one file.
+    """
+    async with all_mods_lock:
+        loop = asyncio.get_event_loop()
+        store = mod_archive.ArchiveStore(
+            directory=application_config.all_mods_directory,
+            max_count=application_config.all_mods_max_count,
+            max_size=application_config.all_mods_max_size * 1024 * 1024 if application_config.all_mods_max_size else None,
+        )
+        entries = mod_archive.archive_entries(server.mods, server.settings.mods_directory)
+        key = await loop.run_in_executor(None, mod_archive.archive_key, entries)
+
+        all_mods_file = await loop.run_in_executor(None, store.get, key)
+        if all_mods_file:
+            logger.info('Reusing existing all mods zip file {}'.format(all_mods_file))
+        else:
+            logger.info('Building all mods zip file')
+            with metrics.ALL_MODS_BUILD_DURATION.time():
+                all_mods_file = await loop.run_in_executor(None, store.build, key, entries)
+            logger.info('Written all mods zip file to {}'.format(all_mods_file))
+
+        # Downloads are served the previous file until this point
+        server.all_mods_file = all_mods_file
+        metrics.ALL_MODS_SIZE.set(all_mods_file.stat().st_size, server=server.slug)
+        in_use = {s.all_mods_file for s in servers.values() if s.all_mods_file}
+        await loop.run_in_executor(None, store.evict, in_use)
+
+
+@changes_state
+def handle_saves(server: Server, saves: list):
+    """Handle the saves in the saves directory, newest first"""
+    previous = server.saves_by_file_name
+    server.saves = tuple(saves)
+    server.saves_by_file_name = {save.file.name: save for save in saves}
+    current = server.saves_by_file_name
+    log_changes(
+        'Saves',
+        added=[save.name for file_name, save in current.items() if file_name not in previous],
+        removed=[save.name for file_name, save in previous.items() if file_name not in current],
+        saved=[save.name for file_name, save in current.items()
+               if file_name in previous and save.modified != previous[file_name].modified],
+    )
+    events.publish(server.slug, 'saves', [save.as_dict() for save in saves])
+
+
+def handle_mod_database(data: dict):
+    """Handle the mod portal records of the mods installed on any server, keyed by mod_key()
+
+    The mod database is shared, so every server's state changes.
+    """
+    if data == mod_database:
+        return
+    with metrics.HANDLER_DURATION.time(handler='handle_mod_database'):
+        mod_database.clear()
+        mod_database.update(data)
+        logger.info('Mod database changed. {} installed mods found.'.format(len(mod_database)))
+        for server in servers.values():
+            server.state_version += 1
+            events.publish(server.slug, 'mods', [mod.as_dict() for mod in server.mods])
+
+
+@changes_state
+def handle_config(server: Server, config: dict):
     def munge_value(v: str):
         v = v.strip('.')
         if ':' in v:
@@ -151,11 +247,18 @@ def handle_config(config: dict):
         return v
 
     kwargs = {k.replace('-', '_'): munge_value(v.decode('utf8')) for k, v in config.items()}
+    previous = server.config.as_dict()
     server.config = ServerConfig(**kwargs)
-    logger.info('Server config changed: {}'.format(server.config))
-
-
-def handle_ip(ip):
-    if not application_config.server_host:
-        application_config.server_host = ip
-        logger.info('Server IP set: {}'.format(application_config.server_host))
+    changed = [k for k, v in kwargs.items() if previous.get(k) != v]
+    if server.history and previous:
+        server.history.config_changed(changed)
+    if changed:
+        logger.info('Server config changed: {}'.format(', '.join('{}={}'.format(k, kwargs[k]) for k in changed)))
+    events.publish(server.slug, 'config', server.config.as_dict())
+
+
+@changes_state
+def handle_ip(server: Server, ip):
+    if not server.settings.server_host:
+        server.settings.server_host = ip
+        logger.info('Server {} IP set: {}'.format(server.slug, server.settings.server_host))
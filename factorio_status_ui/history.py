@@ -0,0 +1,311 @@
+"""Compact on-disk history of a server's players, config & connection
+
+Everything is kept in fixed-width little-endian records, so the files can be
+memory mapped and never need parsing. All files have a fixed size, apart from
+the name & playtime tables which grow only with the number of distinct names:
+
+* ``events``: ring buffer of the latest join/leave/config/connection events
+* ``minute``, ``hour``, ``day``: ring buffers of players online, aggregated
+  incrementally as time passes
+* ``names``: interned player & config option names, one per line. Records
+  refer to a name by its line number.
+* ``playtime``: seconds online & last seen time of each name, indexed by its number
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+
+from factorio_status_ui.utils import prepare_private_directory
+
+logger = logging.getLogger(__name__)
+
+# magic, format version, record size, capacity, records ever written
+HEADER_STRUCT = struct.Struct('<4sHHIQ')
+MAGIC = b'FSUH'
+FORMAT_VERSION = 1
+
+EVENT_STRUCT = struct.Struct('<dB3xI')  # time, kind, name number
+BUCKET_STRUCT = struct.Struct('<dddI4x')  # start, seconds observed, player seconds, peak players
+PLAYTIME_STRUCT = struct.Struct('<dd')  # seconds online, last seen
+
+EVENT_JOIN = 1
+EVENT_LEAVE = 2
+EVENT_CONFIG = 3
+EVENT_CONNECTED = 4
+EVENT_DISCONNECTED = 5
+EVENT_NAMES = {
+    EVENT_JOIN: 'join',
+    EVENT_LEAVE: 'leave',
+    EVENT_CONFIG: 'config',
+    EVENT_CONNECTED: 'connected',
+    EVENT_DISCONNECTED: 'disconnected',
+}
+# Events which do not refer to a name use this number
+NO_NAME = 2 ** 32 - 1
+
+# Seconds per bucket, and how many buckets to keep
+RESOLUTIONS = {
+    'minute': (60, 60 * 24 * 7),
+    'hour': (60 * 60, 24 * 366 * 2),
+    'day': (60 * 60 * 24, 366 * 10),
+}
+
+
+class RingBuffer(object):
+    """A memory mapped file holding the latest ``capacity`` fixed-width records"""
+
+    def __init__(self, path: Path, record_struct: struct.Struct, capacity: int):
+        self.path = path
+        self.record_struct = record_struct
+        self.capacity = capacity
+        size = HEADER_STRUCT.size + record_struct.size * capacity
+
+        self._file = open(path, 'r+b' if path.exists() else 'w+b')
+        header = self._file.read(HEADER_STRUCT.size)
+        expected = (MAGIC, FORMAT_VERSION, record_struct.size, capacity)
+        if len(header) < HEADER_STRUCT.size or HEADER_STRUCT.unpack(header)[:4] != expected:
+            if header:
+                logger.warning('Discarding history file {} as its format or capacity has changed'.format(path))
+            self._file.truncate(0)
+            self._file.truncate(size)
+            self._file.seek(0)
+            self._file.write(HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, record_struct.size, capacity, 0))
+            self._file.flush()
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.written = HEADER_STRUCT.unpack_from(self._mmap)[4]
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def _offset(self, index: int) -> int:
+        return HEADER_STRUCT.size + (index % self.capacity) * self.record_struct.size
+
+    def append(self, *values):
+        self.record_struct.pack_into(self._mmap, self._offset(self.written), *values)
+        self.written += 1
+        HEADER_STRUCT.pack_into(self._mmap, 0, MAGIC, FORMAT_VERSION, self.record_struct.size, self.capacity,
+                                self.written)
+
+    def replace_last(self, *values):
+        self.record_struct.pack_into(self._mmap, self._offset(self.written - 1), *values)
+
+    def last(self, count: int) -> list:
+        """The latest count records, oldest first"""
+        count = min(count, len(self))
+        return [
+            self.record_struct.unpack_from(self._mmap, self._offset(index))
+            for index in range(self.written - count, self.written)
+        ]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class Aggregate(object):
+    """Players online over fixed width time buckets
+
+    Each bucket records how long it was observed for, the sum of players
+    online over that time and the peak. The current bucket is updated in place.
+    """
+
+    def __init__(self, ring: RingBuffer, resolution: int):
+        self.ring = ring
+        self.resolution = resolution
+        # The current bucket as [start, observed, player seconds, peak]
+        latest = ring.last(1)
+        self.bucket = list(latest[0]) if latest else None
+
+    def add(self, start: float, end: float, online: int):
+        """Record that ``online`` players were online from start until end"""
+        # Nothing older than the ring's capacity would be kept anyway
+        start = max(start, end - self.resolution * self.ring.capacity)
+        while start < end:
+            bucket_start = start - start % self.resolution
+            bucket_end = min(end, bucket_start + self.resolution)
+            if self.bucket is None or self.bucket[0] != bucket_start:
+                self.bucket = [bucket_start, 0.0, 0.0, 0]
+                self.ring.append(*self.bucket)
+            self.bucket[1] += bucket_end - start
+            self.bucket[2] += online * (bucket_end - start)
+            self.bucket[3] = max(self.bucket[3], online)
+            self.ring.replace_last(*self.bucket)
+            start = bucket_end
+
+    def series(self, limit: int) -> list:
+        return [
+            {
+                'start': start,
+                'average': player_seconds / observed if observed else 0,
+                'peak': peak,
+            }
+            for start, observed, player_seconds, peak in self.ring.last(limit)
+        ]
+
+
+class HistoryStore(object):
+    """Records the history of a single server in the given directory"""
+
+    def __init__(self, directory: Path, max_events=1000000, clock=time.time):
+        self.directory = directory
+        self.clock = clock
+        # Anyone able to write here could replace the files with links to others of this user's files
+        prepare_private_directory(directory)
+
+        self.events = RingBuffer(directory / 'events', EVENT_STRUCT, max_events)
+        self.aggregates = {
+            name: Aggregate(RingBuffer(directory / name, BUCKET_STRUCT, capacity), resolution)
+            for name, (resolution, capacity) in RESOLUTIONS.items()
+        }
+
+        self.names = []
+        self.name_numbers = {}
+        names_path = directory / 'names'
+        if names_path.exists():
+            with open(names_path, encoding='utf8') as f:
+                for line in f:
+                    self._add_name(line.rstrip('\n'))
+        self._names_file = open(names_path, 'a', encoding='utf8')
+
+        playtime_path = directory / 'playtime'
+        # Not opened for appending, as pwrite() ignores the offset when appending on Linux
+        self._playtime_file = open(playtime_path, 'r+b' if playtime_path.exists() else 'w+b')
+        data = self._playtime_file.read(PLAYTIME_STRUCT.size * len(self.names))
+        data = data[:len(data) - len(data) % PLAYTIME_STRUCT.size]
+        self.playtime = [list(record) for record in PLAYTIME_STRUCT.iter_unpack(data)]
+        self.playtime.extend([0.0, 0.0] for _ in range(len(self.names) - len(self.playtime)))
+
+        # Players online now, by name number, with when they joined
+        self.sessions = {}
+        self.last_update = clock()
+
+    def _add_name(self, name: str) -> int:
+        self.name_numbers[name] = len(self.names)
+        self.names.append(name)
+        return self.name_numbers[name]
+
+    def name_number(self, name: str) -> int:
+        number = self.name_numbers.get(name)
+        if number is None:
+            number = self._add_name(name)
+            self._names_file.write(name + '\n')
+            self._names_file.flush()
+            self.playtime.append([0.0, 0.0])
+        return number
+
+    def _save_playtime(self, number: int):
+        os.pwrite(self._playtime_file.fileno(), PLAYTIME_STRUCT.pack(*self.playtime[number]),
+                  number * PLAYTIME_STRUCT.size)
+
+    def tick(self):
+        """Bring the aggregates up to date. Call this regularly, e.g. every minute."""
+        now = self.clock()
+        if now > self.last_update:
+            for aggregate in self.aggregates.values():
+                aggregate.add(self.last_update, now, len(self.sessions))
+        self.last_update = now
+        return now
+
+    def _start_session(self, number: int, now: float):
+        self.sessions.setdefault(number, now)
+        self.playtime[number][1] = now
+        self._save_playtime(number)
+
+    def _end_session(self, number: int, now: float):
+        since = self.sessions.pop(number, None)
+        if since is not None:
+            self.playtime[number][0] += now - since
+        self.playtime[number][1] = now
+        self._save_playtime(number)
+
+    def players_changed(self, joined, left):
+        now = self.tick()
+        for username in sorted(left):
+            number = self.name_number(username)
+            self._end_session(number, now)
+            self.events.append(now, EVENT_LEAVE, number)
+        for username in sorted(joined):
+            number = self.name_number(username)
+            self._start_session(number, now)
+            self.events.append(now, EVENT_JOIN, number)
+
+    def config_changed(self, options):
+        now = self.tick()
+        for option in sorted(options):
+            self.events.append(now, EVENT_CONFIG, self.name_number(option))
+
+    def connection_changed(self, connected: bool, online=()):
+        """Record a change in the RCON connection
+
+        Nobody can be seen to be online while disconnected, so sessions are
+        suspended. On reconnecting, the sessions of the players who were last
+        seen online resume, and the next poll reports anyone who has left since.
+        """
+        now = self.tick()
+        self.events.append(now, EVENT_CONNECTED if connected else EVENT_DISCONNECTED, NO_NAME)
+        if connected:
+            for username in online:
+                self._start_session(self.name_number(username), now)
+        else:
+            for number in list(self.sessions):
+                self._end_session(number, now)
+
+    def close(self):
+        now = self.tick()
+        for number in list(self.sessions):
+            self._end_session(number, now)
+        for ring in [self.events] + [aggregate.ring for aggregate in self.aggregates.values()]:
+            ring.close()
+        self._names_file.close()
+        self._playtime_file.close()
+
+    def recent_events(self, limit: int) -> list:
+        return [
+            {
+                'time': event_time,
+                'event': EVENT_NAMES.get(kind),
+                'name': self.names[number] if number < len(self.names) else None,
+            }
+            for event_time, kind, number in reversed(self.events.last(limit))
+        ]
+
+    def series(self, resolution: str, limit: int) -> list:
+        self.tick()
+        return self.aggregates[resolution].series(limit)
+
+    def peak_hours(self, days: int) -> list:
+        """Average & peak players for each hour of the day (UTC) over the last few days"""
+        hours = [[0.0, 0.0, 0] for _ in range(24)]
+        for bucket in self.series('hour', days * 24):
+            hour = hours[int(bucket['start'] // 3600 % 24)]
+            hour[0] += bucket['average']
+            hour[1] += 1
+            hour[2] = max(hour[2], bucket['peak'])
+        return [
+            {'hour': hour, 'average': total / count if count else 0, 'peak': peak}
+            for hour, (total, count, peak) in enumerate(hours)
+        ]
+
+    def player_playtime(self, limit: int) -> list:
+        """The players who have played the longest, including any current session"""
+        now = self.clock()
+        totals = []
+        for number, (seconds, last_seen) in enumerate(self.playtime):
+            if number in self.sessions:
+                seconds += now - self.sessions[number]
+                last_seen = now
+            if last_seen:
+                totals.append((seconds, last_seen, number))
+        totals.sort(reverse=True)
+        return [
+            {
+                'username': self.names[number],
+                'seconds': seconds,
+                'last_seen': last_seen,
+                'is_online': number in self.sessions,
+            }
+            for seconds, last_seen, number in totals[:limit]
+        ]
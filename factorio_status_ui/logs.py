@@ -0,0 +1,99 @@
+"""Logging through a queue, so that writing log records never blocks the event loop
+
+Logging calls only put their records on a queue. A listener thread formats
+them, as text or one JSON object per line, and writes them to stderr. If the
+output cannot keep up (for example a container's blocked stdout) records are
+dropped rather than holding up the loop, and a count of them is logged once
+the queue has room again.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
+# Records waiting to be written beyond this many are dropped
+QUEUE_SIZE = 10000
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object, for log collectors"""
+
+    def format(self, record):
+        document = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread, dropping them if it has fallen too far behind"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only what must happen now: fixing the message before its arguments change. Unlike the
+        # default this leaves the formatting to the listener, so that JSON keeps the exception apart.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Dropped {} log records as logging could not keep up'.format(self.dropped),
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def logger_level(value: str) -> tuple:
+    """Parse a "logger=LEVEL" command line option"""
+    name, _, level = value.rpartition('=')
+    if not name or level.upper() not in LEVELS:
+        raise ValueError('Expected LOGGER=LEVEL, where LEVEL is one of {}'.format(', '.join(LEVELS)))
+    return name, level.upper()
+
+
+def setup_logging(level='INFO', log_format='text', logger_levels=()) -> logging.handlers.QueueListener:
+    """Send all logging through a queue to stderr
+
+    Our own loggers log at ``level``, and other libraries' at WARNING.
+    ``logger_levels`` are (logger name, level) pairs overriding particular loggers.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(logging.WARNING)
+    logging.getLogger('factorio_status_ui').setLevel(level)
+    for name, override in logger_levels:
+        logging.getLogger(name).setLevel(override)
+
+    listener.start()
+    # Write out whatever is still queued on exit
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,185 @@
+"""Minimal Prometheus metrics, exposed in the text format at /metrics
+
+Only what this application needs is implemented, so no extra dependency is
+required.
+"""
+import time
+from contextlib import contextmanager
+
+from factorio_status_ui.state import servers
+
+registry = []
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        for labelvalues, value in self.values.items():
+            yield self.name, format_labels(self.labelnames, labelvalues), value
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        lines.extend('{}{} {}'.format(name, labels, float(value)) for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function:
+            # The function returns a value for each combination of label values
+            self.values = self.function()
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            # Per-bucket counts, followed by the sum
+            self.values[key] = [0] * len(self.buckets) + [0.0]
+        counts = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for labelvalues, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '{}_bucket'.format(self.name), format_labels(self.labelnames, labelvalues, [('le', le)]), cumulative
+            yield '{}_sum'.format(self.name), format_labels(self.labelnames, labelvalues), counts[-1]
+            yield '{}_count'.format(self.name), format_labels(self.labelnames, labelvalues), cumulative
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# The commands sent by the pollers. Anything else (such as whatever an admin types
+# into the console) is labelled "other", to keep the number of series bounded.
+LABELLED_COMMANDS = {'/players', '/admins', '/config', '/silent-command'}
+
+
+def command_label(command: str) -> str:
+    """Label RCON commands by name only"""
+    name = command.split(' ', 1)[0]
+    return name if name in LABELLED_COMMANDS else 'other'
+
+
+def per_server(function):
+    """Make a gauge function which returns function(server) for each server"""
+    return lambda: {(slug,): function(server) for slug, server in servers.items()}
+
+
+RCON_COMMAND_DURATION = Histogram(
+    'factorio_status_ui_rcon_command_duration_seconds', 'RCON command round trip time.', ['server', 'command']
+)
+RCON_COMMAND_FAILURES = Counter(
+    'factorio_status_ui_rcon_command_failures_total', 'RCON commands which failed or timed out.',
+    ['server', 'command']
+)
+RCON_QUEUE_WAIT = Histogram(
+    'factorio_status_ui_rcon_queue_wait_seconds', 'Time RCON commands waited to be sent, by priority.',
+    ['server', 'priority']
+)
+ADMIN_COMMANDS = Counter(
+    'factorio_status_ui_admin_commands_total', 'Commands sent from the admin console, by result.',
+    ['server', 'result']
+)
+RCON_RECONNECTS = Counter(
+    'factorio_status_ui_rcon_reconnects_total', 'Times the RCON connection was lost and re-established.', ['server']
+)
+RCON_CONNECTED = Gauge(
+    'factorio_status_ui_rcon_connected', 'Whether the RCON connection is currently open.', ['server'],
+    function=per_server(lambda server: 1 if server.rcon_health.is_connected else 0)
+)
+# The server label is empty for sources shared by all servers (i.e. the mod portal)
+POLL_LAST_SUCCESS = Gauge(
+    'factorio_status_ui_poll_last_success_timestamp_seconds', 'When each poller last succeeded.',
+    ['server', 'source']
+)
+HANDLER_DURATION = Histogram(
+    'factorio_status_ui_handler_duration_seconds', 'Time taken to process changed state.', ['handler']
+)
+ALL_MODS_BUILD_DURATION = Histogram(
+    'factorio_status_ui_all_mods_build_duration_seconds', 'Time taken to build the all mods zip file.',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600)
+)
+ALL_MODS_SIZE = Gauge(
+    'factorio_status_ui_all_mods_size_bytes', 'Size of the current all mods zip file.', ['server']
+)
+PAGE_RENDER_DURATION = Histogram(
+    'factorio_status_ui_page_render_duration_seconds', 'Time taken to render the status page.'
+)
+PLAYERS_ONLINE = Gauge(
+    'factorio_status_ui_players_online', 'Players currently online.', ['server'],
+    function=per_server(lambda server: len(server.players.online))
+)
+PLAYERS_KNOWN = Gauge(
+    'factorio_status_ui_players_known', 'Players who have ever joined the server.', ['server'],
+    function=per_server(lambda server: len(server.players))
+)
+MODS_ENABLED = Gauge(
+    'factorio_status_ui_mods_enabled', 'Mods currently enabled.', ['server'],
+    function=per_server(lambda server: sum(1 for mod in server.mods if mod.enabled))
+)
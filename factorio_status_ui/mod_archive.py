@@ -0,0 +1,215 @@
+"""Building the archive offered by the 'Download all mods' button
+
+Writing the archive is blocking, so everything here is intended to run in an
+executor. Mods are already zip files, so they are stored as-is rather than
+being compressed a second time.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTRAS = ('mod-list.json', 'mod-settings.json')
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def archive_entries(mods, mods_directory: Path) -> List[Tuple[Path, str]]:
+    """Get the (path, archive name) of every file belonging in the archive"""
+    entries = [(mod.file, 'mods/{}'.format(mod.file.name)) for mod in mods if mod.file and mod.enabled]
+    for name in ARCHIVE_EXTRAS:
+        extra = mods_directory / name
+        if extra.exists():
+            entries.append((extra, 'mods/{}'.format(name)))
+    return entries
+
+
+def archive_key(entries) -> str:
+    """Identify an archive by its contents
+
+    Mod file names include the version, so mods are identified by name, size
+    and modification time (a local mod may be rebuilt in place under the same
+    name and size). The (small) json files are hashed in full.
+    """
+    digest = hashlib.sha256()
+    for path, arcname in entries:
+        digest.update(arcname.encode('utf8'))
+        if path.suffix == '.zip':
+            stat = path.stat()
+            digest.update('{}-{}'.format(stat.st_size, stat.st_mtime_ns).encode('utf8'))
+        else:
+            digest.update(path.read_bytes())
+        digest.update(b'\x00')
+    return digest.hexdigest()[:16]
+
+
+def write_archive(fileobj, entries):
+    """Write the archive to a path or file-like object (which need not be seekable)"""
+    with ZipFile(fileobj, mode='w') as archive:
+        for path, arcname in entries:
+            compress_type = ZIP_STORED if path.suffix == '.zip' else ZIP_DEFLATED
+            archive.write(path, arcname=arcname, compress_type=compress_type)
+
+
+def build_archive_file(entries, destination: Path):
+    """Write the archive to destination, which only appears once complete"""
+    tmp_path = destination.with_name('{}.tmp'.format(destination.name))
+    write_archive(tmp_path, entries)
+    tmp_path.rename(destination)
+
+
+class ArchiveStore(object):
+    """Keeps built archives on disk, named by their key
+
+    An archive which has already been built (even by a previous run) is reused
+    rather than built again. The least recently used archives are deleted once
+    there are more than max_count of them, or their total size exceeds
+    max_size bytes.
+    """
+
+    def __init__(self, directory: Path, max_count: int = 3, max_size: int = None):
+        self.directory = directory
+        self.max_count = max_count
+        self.max_size = max_size
+
+    def path(self, key: str) -> Path:
+        return self.directory / 'all-mods-{}.zip'.format(key)
+
+    def get(self, key: str) -> Path:
+        """Get the archive with the given key, if it exists, marking it as recently used"""
+        path = self.path(key)
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def build(self, key: str, entries) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        build_archive_file(entries, path)
+        return path
+
+    def evict(self, keep: set):
+        """Delete least recently used archives until within the limits, except those in keep"""
+        archives = []
+        for path in self.directory.glob('all-mods-*'):
+            if path.suffix == '.tmp':
+                # Left over from an interrupted build
+                path.unlink()
+                continue
+            stat = path.stat()
+            archives.append((stat.st_mtime, stat.st_size, path))
+
+        archives.sort(reverse=True)
+        count = 0
+        total_size = 0
+        for mtime, size, path in archives:
+            count += 1
+            total_size += size
+            too_many = self.max_count and count > self.max_count
+            too_big = self.max_size and total_size > self.max_size
+            if path not in keep and (too_many or too_big):
+                logger.info('Deleting old all mods zip file {}'.format(path))
+                path.unlink()
+
+
+class StreamsBusyError(Exception): pass
+
+
+class StreamExecutor(object):
+    """Threads dedicated to streaming archives
+
+    Each stream keeps a thread busy for as long as its download takes, so
+    streams get their own threads rather than starving the default executor
+    (which everything else uses for short blocking calls). Once all of them
+    are in use, further streams are refused.
+    """
+
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self.active = 0
+        self._executor = ThreadPoolExecutor(max_streams, thread_name_prefix='all-mods-stream')
+
+    def submit(self, loop, fn, *args) -> asyncio.Future:
+        if self.active >= self.max_streams:
+            raise StreamsBusyError('All {} archive streams are in use'.format(self.max_streams))
+        self.active += 1
+        future = loop.run_in_executor(self._executor, fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        self.active -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class ArchiveStream(object):
+    """Stream an archive from a worker thread into the event loop, chunk by chunk
+
+    The worker blocks whenever the queue is full, so a slow download never
+    buffers more than a few chunks in memory.
+    """
+
+    def __init__(self, loop, max_chunks=8):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_chunks)
+        self.cancelled = False
+        self._buffer = bytearray()
+        self._future = None
+
+    def write(self, data):
+        if self.cancelled:
+            raise ConnectionAbortedError('Archive download cancelled')
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _put(self, chunk):
+        asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
+    def _run(self, entries):
+        try:
+            write_archive(self, entries)
+            self._put(bytes(self._buffer))
+        except ConnectionAbortedError:
+            if not self.cancelled:
+                raise
+        finally:
+            if not self.cancelled:
+                self._put(None)
+
+    def start(self, entries, executor: StreamExecutor):
+        """Start building the archive, raising StreamsBusyError if the executor has no free thread
+
+        Once started, the stream must be closed.
+        """
+        self._future = executor.submit(self.loop, self._run, entries)
+
+    async def chunks(self):
+        """Generate the archive's bytes"""
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None:
+                break
+            yield chunk
+
+    async def close(self):
+        """Stop building the archive if it is not finished, and wait for its thread to be free"""
+        self.cancelled = True
+        # Unblock the worker if it is waiting on a full queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        await self._future
@@ -0,0 +1,195 @@
+"""Reading mod archives' info.json, and resolving the installed mods' versions & dependencies
+
+Each archive is only opened when it is new or its size or modification time
+has changed, so a rescan of a large mods directory opens nothing at all.
+"""
+import asyncio
+import json
+import logging
+import re
+import zipfile
+from pathlib import Path
+from typing import List
+
+from factorio_status_ui.state import State
+from factorio_status_ui.utils import mod_key
+
+logger = logging.getLogger(__name__)
+
+# Mods which are part of the game, so have no archive
+BUILTIN_MODS = {'base', 'core', 'space-age', 'quality', 'elevated-rails'}
+
+DEPENDENCY_RE = re.compile(
+    r'^\s*(?P<prefix>!|\?|\(\?\)|~)?\s*(?P<name>.+?)(?:\s*(?P<operator><=|>=|<|>|=)\s*(?P<version>[0-9.]+))?\s*$'
+)
+FILE_NAME_RE = re.compile(r'(.*)_([0-9\.]*[0-9])\.zip')
+OPERATORS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '=': lambda a, b: a == b,
+    '>=': lambda a, b: a >= b,
+    '>': lambda a, b: a > b,
+}
+
+
+def parse_version(version: str) -> tuple:
+    try:
+        return tuple(int(part) for part in version.split('.'))
+    except (AttributeError, ValueError):
+        return ()
+
+
+class Dependency(State):
+    name: str
+    kind: str  # required, optional or incompatible
+    operator: str = None
+    version: str = None
+
+    def __repr__(self):
+        return '<Dependency: {} {} {} {}>'.format(self.kind, self.name, self.operator or '', self.version or '')
+
+    def __str__(self):
+        return '{} {} {}'.format(self.name, self.operator, self.version) if self.operator else self.name
+
+    def allows(self, version: str) -> bool:
+        if not self.operator or not version:
+            return True
+        return OPERATORS[self.operator](parse_version(version), parse_version(self.version))
+
+
+def parse_dependency(dependency: str) -> Dependency:
+    match = DEPENDENCY_RE.match(dependency)
+    if not match:
+        return None
+    prefix = match.group('prefix')
+    kind = {'!': 'incompatible', '?': 'optional', '(?)': 'optional'}.get(prefix, 'required')
+    return Dependency(name=match.group('name'), kind=kind, operator=match.group('operator'),
+                      version=match.group('version'))
+
+
+class ModInfo(State):
+    """A mod archive, and what its info.json says about it"""
+    file: Path
+    name: str
+    version: str
+    title: str = None
+    factorio_version: str = None
+    dependencies: list = ()
+    error: str = None
+
+    def __repr__(self):
+        return '<ModInfo: {} {}, file={}>'.format(self.name, self.version, self.file.name)
+
+
+def read_info(path: Path) -> ModInfo:
+    """Read a mod archive's info.json. This is blocking, so run it in an executor."""
+    # Fall back to the file name if info.json can't be read
+    matches = FILE_NAME_RE.match(path.name)
+    name, version = matches.groups() if matches else (path.stem, None)
+    try:
+        with zipfile.ZipFile(str(path)) as zip_file:
+            info_file = next(
+                (member for member in zip_file.namelist() if member.count('/') == 1 and member.endswith('/info.json')),
+                None
+            )
+            if info_file is None:
+                raise ValueError('No info.json in archive')
+            info = json.loads(zip_file.read(info_file).decode('utf8'))
+    except (OSError, zipfile.BadZipFile, ValueError) as e:
+        logger.warning('Could not read info.json from mod {}: {}'.format(path.name, e))
+        return ModInfo(file=path, name=name, version=version, error=str(e))
+
+    dependencies = info.get('dependencies', ['base'])
+    if isinstance(dependencies, str):
+        dependencies = [dependencies]
+    return ModInfo(
+        file=path,
+        name=info.get('name', name),
+        version=info.get('version', version),
+        title=info.get('title'),
+        factorio_version=info.get('factorio_version'),
+        dependencies=tuple(d for d in map(parse_dependency, dependencies) if d),
+    )
+
+
+class ModInfoCache(object):
+    """The info of every mod archive, read again only when an archive changes"""
+
+    def __init__(self):
+        self._infos = {}  # path -> ((size, mtime), ModInfo)
+
+    def changed(self, files: List[Path]):
+        """Get the stats of the files, and those which need reading. Blocking."""
+        stats = {}
+        for path in files:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+        changed = [path for path, stat in stats.items() if path not in self._infos or self._infos[path][0] != stat]
+        return stats, changed
+
+    async def read(self, files: List[Path], loop=None) -> List[ModInfo]:
+        """Get the info of each of the files, reading changed archives concurrently in the executor"""
+        loop = loop or asyncio.get_event_loop()
+        stats, changed = await loop.run_in_executor(None, self.changed, files)
+        infos = await asyncio.gather(*[loop.run_in_executor(None, read_info, path) for path in changed])
+        for path, info in zip(changed, infos):
+            self._infos[path] = (stats[path], info)
+        for path in set(self._infos) - set(stats):
+            del self._infos[path]
+        return [self._infos[path][1] for path in files if path in self._infos]
+
+
+def resolve(mod_list: list, infos: List[ModInfo]):
+    """Match the mod list against the archives, checking each enabled mod's dependencies
+
+    Where there are several archives of a mod the highest version is used.
+    Returns (mods, unused archives), where each mod is a dict of its name,
+    enabled, info (None if there is no archive), the names of the enabled mods
+    which depend upon it, and a list of problems.
+    """
+    archives = {}
+    for info in infos:
+        archives.setdefault(mod_key(info.name), []).append(info)
+    for versions in archives.values():
+        versions.sort(key=lambda info: parse_version(info.version), reverse=True)
+
+    mods = []
+    for entry in mod_list:
+        versions = archives.get(mod_key(entry['name']), [])
+        mods.append({
+            'name': mod_key(entry['name']),
+            'enabled': entry['enabled'],
+            'info': versions[0] if versions else None,
+            'dependents': [],
+            'problems': [],
+        })
+    enabled = {mod['name']: mod for mod in mods if mod['enabled']}
+
+    for mod in enabled.values():
+        info = mod['info']
+        if info is None:
+            if mod['name'] not in BUILTIN_MODS:
+                mod['problems'].append('No archive in the mods directory')
+            continue
+        if info.error:
+            mod['problems'].append('Unreadable info.json: {}'.format(info.error))
+        for dependency in info.dependencies:
+            target = enabled.get(mod_key(dependency.name))
+            target_version = target['info'].version if target and target['info'] else None
+            if dependency.kind == 'incompatible':
+                if target:
+                    mod['problems'].append('Incompatible with {}'.format(target['name']))
+                continue
+            if target:
+                target['dependents'].append(mod['name'])
+                if not dependency.allows(target_version):
+                    mod['problems'].append('Requires {}, but {} is installed'.format(dependency, target_version))
+            elif dependency.kind == 'required' and dependency.name not in ('base', 'core'):
+                mod['problems'].append('Requires {}, which is missing'.format(dependency))
+
+    used = {mod['info'].file for mod in enabled.values() if mod['info']}
+    unused = sorted(info.file for info in infos if info.file not in used)
+    return mods, unused
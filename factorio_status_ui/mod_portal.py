@@ -0,0 +1,220 @@
+"""A slim, persistent copy of the mods.factorio.com mod database
+
+The full catalogue is large, so it is parsed as a stream and only the fields
+shown on the status page are kept. These slim records are cached on disk,
+which makes them available immediately on startup and lets refreshes use
+conditional requests. Only the records of the installed mods are kept in
+memory; the cache file is read again when other mods are installed, or when
+the file changes.
+"""
+import asyncio
+import codecs
+import json
+import logging
+from pathlib import Path
+
+import aiohttp
+
+from factorio_status_ui.utils import mod_key
+
+logger = logging.getLogger(__name__)
+
+MOD_PORTAL_URL = 'https://mods.factorio.com/api/mods?page_size=100000'
+MOD_FIELDS = ('name', 'owner', 'summary', 'downloads_count')
+CHUNK_SIZE = 64 * 1024
+
+# Set whenever the installed mods change, so their records can be loaded. An event
+# belongs to the event loop it is used in, so each run of the poller makes its own.
+installed_mods_changed = None
+
+
+def watch_installed_mods() -> asyncio.Event:
+    global installed_mods_changed
+    installed_mods_changed = asyncio.Event()
+    return installed_mods_changed
+
+
+def installed_mods_have_changed():
+    if installed_mods_changed is not None:
+        installed_mods_changed.set()
+
+
+class ResultsParser(object):
+    """Incrementally parse the items of the "results" array in a JSON document
+
+    Feed it chunks of bytes as they arrive, and it returns each item as soon
+    as it is complete, so the document never needs to be held in memory.
+    """
+
+    def __init__(self, key='results'):
+        self.key = '"{}"'.format(key)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf8')()
+        self.buffer = ''
+        self.in_array = False
+        self.done = False
+
+    def feed(self, chunk: bytes) -> list:
+        self.buffer += self.text_decoder.decode(chunk)
+        if self.done:
+            return []
+
+        if not self.in_array:
+            key_start = self.buffer.find(self.key)
+            if key_start == -1:
+                # Keep enough to match the key if it is split across chunks
+                self.buffer = self.buffer[-len(self.key):]
+                return []
+            array_start = self.buffer.find('[', key_start)
+            if array_start == -1:
+                self.buffer = self.buffer[key_start:]
+                return []
+            self.buffer = self.buffer[array_start + 1:]
+            self.in_array = True
+
+        items = []
+        buffer = self.buffer
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                self.done = True
+                break
+            try:
+                item, position = self.decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Incomplete item, wait for more data
+                break
+            items.append(item)
+
+        self.buffer = '' if self.done else buffer[position:]
+        return items
+
+    def close(self):
+        if not self.done:
+            raise ValueError('Mod database ended unexpectedly')
+
+
+def slim_record(mod: dict) -> dict:
+    return {field: mod.get(field) for field in MOD_FIELDS}
+
+
+class ModPortalCache(object):
+    """The slim mod database, stored on disk along with the validators needed for conditional requests"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.etag = None
+        self.last_modified = None
+        self.source_mtime = None
+        self._keys = set()  # of the mods whose records were last loaded, found or not
+        self._mods = {}  # mod key -> record, for just those mods
+        self._mtime = None  # of the file self._mods was read from
+        self._read(set())
+
+    def _mtime_now(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self, keys: set):
+        """Read the cache file, keeping only the records for the given mod keys. Blocking."""
+        try:
+            mtime = self.path.stat().st_mtime_ns
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data, mtime = {}, None
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.source_mtime = data.get('source_mtime')
+        self._keep(data.get('mods', {}), keys)
+        self._mtime = mtime
+
+    def _keep(self, mods: dict, keys: set):
+        self._keys = keys
+        self._mods = {}
+        for name, mod in mods.items():
+            key = mod_key(name)
+            if key in keys:
+                self._mods[key] = mod
+
+    def load(self, names) -> dict:
+        """Load the records for the given mod names, keyed by mod_key(). Blocking."""
+        keys = {mod_key(name) for name in names}
+        if not keys <= self._keys or self._mtime_now() != self._mtime:
+            self._read(keys)
+        else:
+            # Forget any mods which are no longer installed
+            self._keys = keys
+            self._mods = {key: self._mods[key] for key in keys if key in self._mods}
+        return dict(self._mods)
+
+    def save(self, mods: dict, etag=None, last_modified=None, source_mtime=None):
+        """Atomically replace the cache. Blocking."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name('{}.tmp'.format(self.path.name))
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'etag': etag,
+                'last_modified': last_modified,
+                'source_mtime': source_mtime,
+                'mods': mods,
+            }, f)
+        tmp_path.rename(self.path)
+        self.etag = etag
+        self.last_modified = last_modified
+        self.source_mtime = source_mtime
+        self._keep(mods, self._keys)
+        self._mtime = self._mtime_now()
+
+
+async def download(cache: ModPortalCache, session: aiohttp.ClientSession, url=MOD_PORTAL_URL) -> bool:
+    """Refresh the cache from the mod portal, returning False if nothing has changed"""
+    headers = {}
+    if cache.etag:
+        headers['If-None-Match'] = cache.etag
+    if cache.last_modified:
+        headers['If-Modified-Since'] = cache.last_modified
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            logger.info('Mod database not modified')
+            return False
+        response.raise_for_status()
+
+        parser = ResultsParser()
+        mods = {}
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            for mod in parser.feed(chunk):
+                if 'name' in mod:
+                    mods[mod['name']] = slim_record(mod)
+        parser.close()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    await asyncio.get_event_loop().run_in_executor(None, cache.save, mods, etag, last_modified)
+    return True
+
+
+def load_file(cache: ModPortalCache, path: Path) -> bool:
+    """Refresh the cache from a local copy of the mod database, if it has changed. Blocking."""
+    mtime = path.stat().st_mtime_ns
+    if mtime == cache.source_mtime:
+        return False
+
+    parser = ResultsParser()
+    mods = {}
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            for mod in parser.feed(chunk):
+                if 'name' in mod:
+                    mods[mod['name']] = slim_record(mod)
+    parser.close()
+    cache.save(mods, source_mtime=mtime)
+    return True
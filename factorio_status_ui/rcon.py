@@ -1,124 +1,474 @@
 #!/usr/bin/python
 
 import asyncio
-import socket
+import heapq
+import itertools
+import random
 import struct
-import sys
+import time
+from collections import Counter
+from datetime import datetime
 
 import logging
 
-from factorio_status_ui.state import application_config
+from factorio_status_ui import events, metrics
+from factorio_status_ui.state import Server
 
 MESSAGE_TYPE_AUTH = 3
 MESSAGE_TYPE_AUTH_RESP = 2
 MESSAGE_TYPE_COMMAND = 2
 MESSAGE_TYPE_RESP = 0
-MESSAGE_ID = 0
+MESSAGE_ID_AUTH = 0
+MESSAGE_ID_MAX = 2 ** 31 - 1
+
+# All RCON integers are signed 32-bit little-endian
+SIZE_STRUCT = struct.Struct('<i')
+PACKET_HEADER_STRUCT = struct.Struct('<iii')  # size, id, type
+RESPONSE_HEADER_STRUCT = struct.Struct('<ii')  # id, type
+# id + type + the two null bytes terminating the body and the packet
+MIN_FRAME_SIZE = RESPONSE_HEADER_STRUCT.size + 2
+# Guards against allocating absurd amounts of memory on a corrupt size field.
+# Generous enough for /players on servers with many thousands of players.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Commands & answers are truncated to this many characters in debug logging
+LOGGED_COMMAND_LENGTH = 200
+
+# Lower goes first
+PRIORITY_ADMIN = 0
+PRIORITY_POLL = 1
+PRIORITY_NAMES = {PRIORITY_ADMIN: 'admin', PRIORITY_POLL: 'poll'}
 
 logger = logging.getLogger(__name__)
 
 
-class RconConnectionError(Exception): pass
-class RconTimeoutError(Exception): pass
-class RconAuthenticatedFailed(Exception): pass
+class RconError(Exception): pass
+class RconConnectionError(RconError): pass
+class RconTimeoutError(RconError): pass
+class RconAuthenticatedFailed(RconError): pass
+class RconProtocolError(RconError): pass
+class RconBusyError(RconError): pass
 
 
-async def send_message(writer, command_string, message_type):
+async def send_message(writer, command_string, message_type, message_id=MESSAGE_ID_AUTH, timeout=None):
     """Packages up a command string into a message and sends it"""
-    logger.debug('Send message to RCON server: {}'.format(command_string))
+    if logger.isEnabledFor(logging.DEBUG) and message_type != MESSAGE_TYPE_AUTH:
+        logger.debug('Send message to RCON server: {}'.format(command_string[:LOGGED_COMMAND_LENGTH]))
 
     try:
-        # size of message in bytes:
-        # id=4 + type=4 + body=variable + null terminator=2 (1 for python string and 1 for message terminator)
-        message_size = (4 + 4 + len(command_string) + 2)
-        message_format = ''.join(['=lll', str(len(command_string)), 's2s'])
-        packed_message = struct.pack(
-            message_format, message_size, MESSAGE_ID, message_type, command_string.encode('utf8'), b'\x00\x00'
-        )
-        writer.write(packed_message)
-        response_data = await asyncio.wait_for(
-            writer.drain(),
-            timeout=application_config.rcon_timeout
-        )
+        body = command_string.encode('utf8')
+        # size of message in bytes: id=4 + type=4 + body=variable + body & packet null terminators=2
+        message_size = RESPONSE_HEADER_STRUCT.size + len(body) + 2
+        writer.write(b''.join([
+            PACKET_HEADER_STRUCT.pack(message_size, message_id, message_type),
+            body,
+            b'\x00\x00',
+        ]))
+        await asyncio.wait_for(writer.drain(), timeout=timeout)
 
     except asyncio.TimeoutError:
         raise RconTimeoutError('Timeout sending RCON message. type={}, command={}'.format(message_type, command_string))
 
 
-async def get_response(reader):
-    """Gets the message response to a sent command and unpackages it"""
-    response_id = -1
-    response_type = -1
+def decode_response(frame: bytes):
+    """Unpackage a single response frame (everything after the size field)
+
+    The header is unpacked in place and the body is copied out exactly once.
+    """
+    response_id, response_type = RESPONSE_HEADER_STRUCT.unpack_from(frame)
+    # Equivalent to frame[8:].rstrip(b'\x00\n'), but without the intermediate copy
+    end = len(frame)
+    start = RESPONSE_HEADER_STRUCT.size
+    while end > start and frame[end - 1] in (0, 10):
+        end -= 1
+    response_string = frame[start:end]
+    return response_string, response_id, response_type
+
+
+async def get_response(reader, timeout=None):
+    """Gets the message response to a sent command and unpackages it
+
+    Waits indefinitely for a frame to start (the connection may be idle), but
+    the remainder of the frame must arrive within the timeout.
+    """
     try:
-        response_size, = struct.unpack('=l', await reader.read(4))
-        message_format = ''.join(['=ll', str(response_size - 9), 's1s'])
-
-        response_data = await asyncio.wait_for(
-            reader.read(response_size),
-            timeout=application_config.rcon_timeout
-        )
-        response_id, response_type, response_string, response_dummy \
-            = struct.unpack(message_format, response_data)
-        response_string = response_string.rstrip(b'\x00\n')
-        return response_string, response_id, response_type
+        response_size, = SIZE_STRUCT.unpack(await reader.readexactly(SIZE_STRUCT.size))
+        if not MIN_FRAME_SIZE <= response_size <= MAX_FRAME_SIZE:
+            raise RconProtocolError('Invalid RCON response size: {} bytes'.format(response_size))
+
+        frame = await asyncio.wait_for(reader.readexactly(response_size), timeout=timeout)
+        return decode_response(frame)
 
+    except asyncio.IncompleteReadError:
+        raise RconConnectionError('RCON connection closed mid-response')
     except asyncio.TimeoutError:
         raise RconTimeoutError('Timeout receiving RCON response')
 
 
 class RconConnection():
+    """A single RCON connection to a server, shared by all of its pollers
+
+    Every command is sent with its own message ID, so any number of commands
+    may be outstanding at once. A background task reads responses and hands
+    each one to the caller waiting on the matching ID.
+    """
+
+    def __init__(self, server: Server):
+        self.server = server
+        self.settings = server.settings
+        self.reader = None
+        self.writer = None
+        self._last_message_id = MESSAGE_ID_AUTH
+        self._pending = {}
+        self._write_lock = asyncio.Lock()
+        self._read_task = None
 
     async def __aenter__(self):
-        logger.debug('Authenticating with RCON server {}:{} using password "{}"'.format(
-            application_config.rcon_host,
-            application_config.rcon_port,
-            application_config.rcon_password,
-        ))
+        settings = self.settings
+        logger.debug('Authenticating with RCON server {}:{}'.format(settings.rcon_host, settings.rcon_port))
 
         try:
             self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(application_config.rcon_host, application_config.rcon_port),
-                timeout=application_config.rcon_timeout
+                asyncio.open_connection(settings.rcon_host, settings.rcon_port),
+                timeout=settings.rcon_timeout
             )
         except asyncio.TimeoutError:
             raise RconTimeoutError('Timeout connecting to RCON server {}:{}'.format(
-                application_config.rcon_host,
-                application_config.rcon_port
+                settings.rcon_host,
+                settings.rcon_port
             ))
         except ConnectionRefusedError:
             raise RconConnectionError('Server {} refused attempted RCON connection on port {}'.format(
-                application_config.rcon_host,
-                application_config.rcon_port
+                settings.rcon_host,
+                settings.rcon_port
+            ))
+        except OSError as e:
+            raise RconConnectionError('Could not connect to RCON server {}:{}: {}'.format(
+                settings.rcon_host,
+                settings.rcon_port,
+                e
             ))
 
-        await send_message(self.writer, application_config.rcon_password, MESSAGE_TYPE_AUTH)
-        response_string, response_id, response_type = await get_response(self.reader)
+        try:
+            # A server which accepts the connection but never answers (wrong port, half-open socket,
+            # or too busy) would otherwise leave us waiting forever for the first frame
+            response_string, response_id, response_type = await asyncio.wait_for(
+                self._authenticate(),
+                timeout=settings.rcon_timeout
+            )
+        except asyncio.TimeoutError:
+            self.writer.close()
+            raise RconTimeoutError('Timeout authenticating with RCON server {}:{}'.format(
+                settings.rcon_host,
+                settings.rcon_port
+            ))
+        except RconError:
+            self.writer.close()
+            raise
 
         if response_id == -1:
-            raise RconAuthenticatedFailed('Failed to authenticate with RCON server {}:{} using password "{}"'.format(
-                application_config.rcon_host,
-                application_config.rcon_port,
-                application_config.rcon_password,
+            self.writer.close()
+            raise RconAuthenticatedFailed('Failed to authenticate with RCON server {}:{}, check the password'.format(
+                settings.rcon_host,
+                settings.rcon_port,
             ))
         else:
             logger.debug('Successfully authenticated with RCON server')
 
+        self._read_task = asyncio.ensure_future(self._read_responses())
         return self
 
+    async def _authenticate(self):
+        settings = self.settings
+        await send_message(self.writer, settings.rcon_password, MESSAGE_TYPE_AUTH, MESSAGE_ID_AUTH,
+                           settings.rcon_timeout)
+        return await get_response(self.reader, settings.rcon_timeout)
+
     async def __aexit__(self, exc_type, exc, tb):
-        self.writer.close()
+        self.close()
+
+    @property
+    def is_open(self):
+        return self._read_task is not None and not self._read_task.done()
+
+    def close(self):
+        if self._read_task:
+            self._read_task.cancel()
+        if self.writer:
+            self.writer.close()
+        self._fail_pending(RconConnectionError('RCON connection closed'))
+
+    async def wait_closed(self):
+        """Wait until the connection is lost or closed"""
+        if self._read_task:
+            await asyncio.wait([self._read_task])
+
+    def _next_message_id(self):
+        # IDs are signed 32-bit ints. Skip the auth ID (and -1, which
+        # signals auth failure) when wrapping around.
+        self._last_message_id = self._last_message_id % MESSAGE_ID_MAX + 1
+        return self._last_message_id
+
+    def _fail_pending(self, exc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+    async def _read_responses(self):
+        """Read responses forever, resolving the future waiting on each message ID"""
+        try:
+            while True:
+                response_string, response_id, response_type = await get_response(
+                    self.reader, self.settings.rcon_timeout
+                )
+                future = self._pending.pop(response_id, None)
+                if future is None:
+                    # See: https://developer.valvesoftware.com/wiki/Source_RCON_Protocol#Multiple-packet_Responses
+                    # Some commands (e.g. /config) are followed by an empty packet carrying
+                    # the same ID. The caller already has its answer, so just drop it.
+                    logger.debug('Discarding RCON packet for completed message ID {}'.format(response_id))
+                elif not future.done():
+                    future.set_result(response_string)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('RCON connection lost: {}'.format(e))
+            self._fail_pending(RconConnectionError('RCON connection lost: {}'.format(e)))
 
     async def run_command(self, command: str):
-        await send_message(self.writer, command, MESSAGE_TYPE_COMMAND)
-        response_string, response_id, response_type = await get_response(self.reader)
+        if not self.is_open:
+            raise RconConnectionError('RCON connection is not open')
+
+        message_id = self._next_message_id()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[message_id] = future
 
-        # See: https://developer.valvesoftware.com/wiki/Source_RCON_Protocol#Multiple-packet_Responses
-        # Basically we get an empty packet after each response
-        if command.startswith('/config'):
-            # ServerConfig commands seem to be multi-packet responses
-            await get_response(self.reader)
+        labels = {'server': self.server.slug, 'command': metrics.command_label(command)}
+        try:
+            with metrics.RCON_COMMAND_DURATION.time(**labels):
+                # Serialise writes so that concurrent drain() calls do not collide
+                async with self._write_lock:
+                    await send_message(self.writer, command, MESSAGE_TYPE_COMMAND, message_id,
+                                       self.settings.rcon_timeout)
+                response_string = await asyncio.wait_for(future, timeout=self.settings.rcon_timeout)
+        except asyncio.TimeoutError:
+            metrics.RCON_COMMAND_FAILURES.inc(**labels)
+            raise RconTimeoutError('Timeout waiting for RCON response to command "{}"'.format(command))
+        except RconError:
+            metrics.RCON_COMMAND_FAILURES.inc(**labels)
+            raise
+        finally:
+            self._pending.pop(message_id, None)
 
-        logger.debug('RCON command "{}" executed, answer : {}'.format(command, response_string))
+        if logger.isEnabledFor(logging.DEBUG):
+            # Answers can list thousands of players
+            logger.debug('RCON command "{}" executed, answer ({} bytes): {}'.format(
+                command[:LOGGED_COMMAND_LENGTH], len(response_string), response_string[:LOGGED_COMMAND_LENGTH]
+            ))
         return response_string
 
 
+class CommandQueue(object):
+    """Limits the commands in flight to a server, letting higher priority commands go first
+
+    Up to ``max_in_flight`` commands are sent at once. Others wait, in order
+    of priority and then of arrival, so an admin's command only ever waits
+    for the commands already sent. If ``max_waiting`` commands of the same
+    priority are already waiting, RconBusyError is raised rather than adding
+    to the backlog, so a backlog of polls never shuts out admins.
+    """
+
+    def __init__(self, max_in_flight=4, max_waiting=100):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.waiting = Counter()  # priority -> commands waiting
+        self._heap = []  # (priority, sequence, future)
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.in_flight < self.max_in_flight and not sum(self.waiting.values()):
+            self.in_flight += 1
+            return
+        if self.waiting[priority] >= self.max_waiting:
+            raise RconBusyError('Too many RCON commands waiting')
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._sequence), future))
+        self.waiting[priority] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Still waiting, so release() will skip it
+                self.waiting[priority] -= 1
+            else:
+                # Handed a slot just as it was cancelled
+                self.release()
+            raise
+
+    def release(self):
+        """Hand the slot to the first waiting command, if any"""
+        while self._heap:
+            priority, _, future = heapq.heappop(self._heap)
+            if not future.cancelled():
+                self.waiting[priority] -= 1
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class RconPool():
+    """Supervises a server's shared RCON connection, reconnecting whenever it drops
+
+    Failed connection attempts are retried with jittered exponential backoff,
+    as are connections lost within ``min_uptime`` seconds (e.g. a server which
+    accepts the connection but keeps crashing). Failures are only forgotten
+    once a connection has stayed up that long. After ``failure_threshold``
+    consecutive failures (connection attempts, quickly lost connections or
+    rounds of command timeouts) the circuit opens and nothing is sent to the
+    server for ``reset_timeout`` seconds, giving it room to finish loading a large save.
+    The current state is published on ``server.rcon_health`` for display.
+    """
+
+    def __init__(self, server: Server, min_backoff=1, max_backoff=60, failure_threshold=5, reset_timeout=120,
+                 min_uptime=10):
+        self.server = server
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_uptime = min_uptime
+        self.queue = CommandQueue(server.settings.rcon_max_in_flight, server.settings.rcon_max_queue)
+
+        self.connection = None
+        self._connected_at = None
+        self._failures = 0
+        self._last_timeout = 0
+
+    @property
+    def health(self):
+        return self.server.rcon_health
+
+    def _set_status(self, status, error=None):
+        if status != self.health.status:
+            self.health.status_since = datetime.now()
+            self.server.state_version += 1
+            if self.server.history and 'connected' in (status, self.health.status):
+                self.server.history.connection_changed(status == 'connected', self.server.players.online)
+        self.health.status = status
+        if error is not None:
+            self.health.last_error = str(error)
+        events.publish(self.server.slug, 'status', self.health.as_dict())
+
+    def _backoff_delay(self):
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self._failures - 1))
+        # Equal jitter, so that several status UIs don't reconnect in lockstep
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def run(self):
+        """Keep a connection open forever. Run this as a background task."""
+        logger.info('Setting up RCON connection pool for server {}'.format(self.server.slug))
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                connection = RconConnection(self.server)
+                try:
+                    self._set_status('connecting')
+                    await connection.__aenter__()
+                except RconError as e:
+                    self._failures += 1
+                    await self._wait_before_retry(e)
+                    continue
+
+                logger.info('Connected to RCON server {}:{}'.format(
+                    self.server.settings.rcon_host,
+                    self.server.settings.rcon_port,
+                ))
+                self.connection = connection
+                self._connected_at = loop.time()
+                self._set_status('connected')
+
+                await connection.wait_closed()
+
+                uptime = loop.time() - self._connected_at
+                self.connection = None
+                connection.close()
+                self.health.reconnects += 1
+                metrics.RCON_RECONNECTS.inc(server=self.server.slug)
+                self._set_status('disconnected', 'Connection lost')
+                if uptime < self.min_uptime:
+                    self._failures += 1
+                    await self._wait_before_retry('Connection lost after {:.1f}s'.format(uptime))
+                elif self._failures >= self.failure_threshold:
+                    await self._wait_before_retry(self.health.last_error)
+                else:
+                    self._failures = 0
+        finally:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+    @property
+    def _is_stable(self):
+        """Whether the connection has been up long enough for its failures to be forgotten"""
+        return asyncio.get_event_loop().time() - self._connected_at >= self.min_uptime
+
+    async def _wait_before_retry(self, error):
+        if self._failures >= self.failure_threshold:
+            logger.warning('RCON circuit open after {} consecutive failures, pausing for {}s: {}'.format(
+                self._failures, self.reset_timeout, error
+            ))
+            self._set_status('circuit_open', error)
+            await asyncio.sleep(self.reset_timeout)
+            # Half-open: allow a single attempt, and reopen immediately if it fails
+            self._failures = self.failure_threshold - 1
+        else:
+            delay = self._backoff_delay()
+            logger.warning('RCON connection failed, retrying in {:.1f}s: {}'.format(delay, error))
+            self._set_status('disconnected', error)
+            await asyncio.sleep(delay)
+
+    @property
+    def is_connected(self):
+        return self.connection is not None
+
+    async def run_command(self, command: str, priority=PRIORITY_POLL):
+        """Run a command, after any waiting commands of the same or a higher priority"""
+        if self.connection is None:
+            raise RconConnectionError('Not connected to RCON server')
+
+        queued = time.perf_counter()
+        await self.queue.acquire(priority)
+        try:
+            metrics.RCON_QUEUE_WAIT.observe(time.perf_counter() - queued, server=self.server.slug,
+                                            priority=PRIORITY_NAMES[priority])
+            return await self._run_command(command, queued)
+        finally:
+            self.queue.release()
+
+    async def _run_command(self, command: str, queued: float):
+        # The connection may have dropped while queued
+        connection = self.connection
+        if connection is None:
+            raise RconConnectionError('Not connected to RCON server')
+
+        try:
+            response = await connection.run_command(command)
+        except RconTimeoutError as e:
+            # Pollers send many commands at once, which all time out together when the server stalls.
+            # Count those as one failure: only a command queued after the last timeout adds another.
+            if queued <= self._last_timeout:
+                raise
+            self._last_timeout = time.perf_counter()
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                # The server is up but not answering, most likely busy loading a save.
+                # Drop the connection so that run() backs off before trying again.
+                logger.warning('RCON server stopped responding, dropping connection')
+                self.health.last_error = str(e)
+                connection.close()
+            raise
+        if self._is_stable:
+            self._failures = 0
+        return response
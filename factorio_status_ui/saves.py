@@ -0,0 +1,230 @@
+"""Listing the saves directory, with metadata read from each save's header
+
+Saves can be hundreds of megabytes, so only the start of the uncompressed
+header (``level-init.dat``, or ``level.dat`` in older saves) is ever read, and
+each save is read only once per size & modification time.
+"""
+import asyncio
+import logging
+import os
+import struct
+import zipfile
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+from factorio_status_ui.state import State
+
+logger = logging.getLogger(__name__)
+
+HEADER_FILES = ('level-init.dat', 'level.dat')
+# Plenty for the header of a save with hundreds of mods
+MAX_HEADER_SIZE = 256 * 1024
+
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+VERSION_STRUCT = struct.Struct('<HHHH')
+
+
+class SaveFormatError(ValueError): pass
+
+
+# Raised by saves which are truncated or still being written
+READ_ERRORS = (OSError, EOFError, KeyError, struct.error, zlib.error, zipfile.BadZipFile, SaveFormatError)
+
+
+class Save(State):
+    file: Path
+    size: int
+    modified: datetime
+    factorio_version: str = None
+    scenario: str = None
+    base_mod: str = None
+    mods: list = ()
+    error: str = None
+
+    @property
+    def name(self):
+        return self.file.stem
+
+    def __repr__(self):
+        return '<Save: {}, version={}, mods={}>'.format(self.name, self.factorio_version, len(self.mods))
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'file_name': self.file.name,
+            'size': self.size,
+            'modified': self.modified.isoformat(),
+            'factorio_version': self.factorio_version,
+            'scenario': self.scenario,
+            'base_mod': self.base_mod,
+            'mods': [{'name': name, 'version': version} for name, version in self.mods],
+            'error': self.error,
+        }
+
+
+class HeaderReader(object):
+    """Reads the primitive types used in Factorio's save header"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, struct_: struct.Struct):
+        if self.offset + struct_.size > len(self.data):
+            raise SaveFormatError('Save header ended unexpectedly')
+        values = struct_.unpack_from(self.data, self.offset)
+        self.offset += struct_.size
+        return values
+
+    def u8(self) -> int:
+        return self.unpack(U8)[0]
+
+    def u16(self) -> int:
+        return self.unpack(U16)[0]
+
+    def u32(self) -> int:
+        return self.unpack(U32)[0]
+
+    def bool(self) -> bool:
+        return self.u8() != 0
+
+    def optimized_u16(self) -> int:
+        value = self.u8()
+        return self.u16() if value == 255 else value
+
+    def optimized_u32(self) -> int:
+        value = self.u8()
+        return self.u32() if value == 255 else value
+
+    def string(self, optimized=True) -> str:
+        length = self.optimized_u32() if optimized else self.u32()
+        if self.offset + length > len(self.data):
+            raise SaveFormatError('Save header ended unexpectedly')
+        value = self.data[self.offset:self.offset + length].decode('utf8', 'replace')
+        self.offset += length
+        return value
+
+
+def parse_header(data: bytes) -> dict:
+    """Parse as much of a save header as is understood
+
+    The layout differs between Factorio versions. Saves from 0.16 onwards
+    are supported; for anything else just the version is returned.
+    """
+    reader = HeaderReader(data)
+    version = reader.unpack(VERSION_STRUCT)
+    info = {'factorio_version': '.'.join(str(part) for part in version[:3])}
+    if version < (0, 16):
+        return info
+
+    if version >= (0, 17):
+        reader.u8()  # Unknown, always zero so far
+    info['scenario'] = reader.string()
+    info['level_name'] = reader.string()
+    info['base_mod'] = reader.string()
+    reader.u8()  # Difficulty
+    reader.bool()  # Finished
+    reader.bool()  # Player won
+    reader.string()  # Next level
+    reader.bool()  # Can continue
+    reader.bool()  # Finished but continuing
+    reader.bool()  # Saving replay
+    reader.bool()  # Allow non-admin debug options
+    reader.u8(), reader.u8(), reader.u8()  # Loaded from version
+    reader.u16()  # Loaded from build
+    reader.u8()  # Allowed commands
+
+    mods = []
+    for _ in range(reader.optimized_u32()):
+        name = reader.string()
+        mod_version = '.'.join(str(reader.optimized_u16()) for _ in range(3))
+        reader.u32()  # CRC
+        mods.append((name, mod_version))
+    info['mods'] = mods
+    return info
+
+
+def read_save(path: Path) -> Save:
+    """Read a save's metadata, or None if it has been deleted. This is blocking, so run it in an executor.
+
+    If the save can't be read (e.g. it is part way through being written)
+    only its name, size & time are given, along with the error.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    save = Save(file=path, size=stat.st_size, modified=datetime.fromtimestamp(stat.st_mtime))
+    try:
+        with zipfile.ZipFile(str(path)) as zip_file:
+            members = {info.filename.rsplit('/', 1)[-1]: info for info in zip_file.infolist()}
+            header_file = next((members[name] for name in HEADER_FILES if name in members), None)
+            if header_file is None:
+                raise SaveFormatError('No level-init.dat or level.dat in save')
+            # Only the start of the member is decompressed
+            with zip_file.open(header_file) as f:
+                info = parse_header(f.read(MAX_HEADER_SIZE))
+    except READ_ERRORS as e:
+        logger.warning('Could not read save {}: {}'.format(path.name, e))
+        save.error = str(e)
+        return save
+
+    save.factorio_version = info['factorio_version']
+    save.scenario = info.get('level_name') or info.get('scenario')
+    save.base_mod = info.get('base_mod')
+    save.mods = tuple(info.get('mods', ()))
+    return save
+
+
+class SaveDirectoryScanner(object):
+    """Keeps the metadata of every save in a directory, reading only new or changed saves"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._saves = {}  # name -> ((size, mtime), Save)
+        self._scanned = False
+
+    def changed(self):
+        """Get the stats of every save, and the names of those which need reading. Blocking."""
+        stats = {}
+        try:
+            with os.scandir(str(self.directory)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.name.endswith('.zip') and entry.is_file():
+                            stat = entry.stat()
+                            stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                    except FileNotFoundError:
+                        # Deleted since the listing
+                        continue
+        except FileNotFoundError:
+            # No saves yet
+            pass
+        changed = [name for name, stat in stats.items() if name not in self._saves or self._saves[name][0] != stat]
+        return stats, changed
+
+    async def scan(self, loop=None):
+        """Get all saves, newest first, if anything has changed, otherwise None
+
+        Changed saves are read concurrently in the loop's executor.
+        """
+        loop = loop or asyncio.get_event_loop()
+        stats, changed = await loop.run_in_executor(None, self.changed)
+        if self._scanned and not changed and stats.keys() == self._saves.keys():
+            return None
+
+        saves = await asyncio.gather(*[
+            loop.run_in_executor(None, read_save, self.directory / name) for name in changed
+        ])
+        for name, save in zip(changed, saves):
+            if save is None:
+                del stats[name]
+            else:
+                self._saves[name] = (stats[name], save)
+        for name in set(self._saves) - set(stats):
+            del self._saves[name]
+        self._scanned = True
+        return sorted((save for stat, save in self._saves.values()), key=lambda save: save.modified, reverse=True)
@@ -0,0 +1,137 @@
+"""Runs the polling jobs, adapting how often they run to demand and load
+
+Each job has a base interval, which is stretched:
+
+* by ``idle_factor`` when nobody is viewing the status page
+* to ``load_factor`` times the job's recent run time, so that a slow source
+  (e.g. an overloaded game server answering RCON slowly) is polled less often
+
+Jobs start staggered across their interval rather than all at once, and run
+at their base interval for the first ``idle_after`` seconds while the state
+warms up. When a viewer arrives after a quiet period, any job which is
+overdue at its base interval runs immediately.
+
+The clock is injectable and run_pending() does all the scheduling without
+waiting, so the scheduler can be driven by a fake clock.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+
+    def __init__(self, name: str, func, interval: float, adaptive=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.adaptive = adaptive
+        self.next_run = None
+        self.last_started = None
+        self.duration = 0.0
+        self.running = False
+
+    def __repr__(self):
+        return '<Job: {}, interval={}, next_run={}>'.format(self.name, self.interval, self.next_run)
+
+
+class Scheduler(object):
+
+    def __init__(self, idle_factor=10, idle_after=60, load_factor=4, clock=time.monotonic):
+        self.idle_factor = idle_factor
+        self.idle_after = idle_after
+        self.load_factor = load_factor
+        self.clock = clock
+        self.jobs = []
+        # Returns the number of viewers currently connected (e.g. to /events)
+        self.viewers = lambda: 0
+        self.last_viewed = None
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+
+    def add(self, name: str, func, interval: float, adaptive=True) -> Job:
+        """Add a job. func is a coroutine function, called with no arguments."""
+        job = Job(name, func, interval, adaptive)
+        self.jobs.append(job)
+        return job
+
+    def is_idle(self) -> bool:
+        if self.viewers():
+            return False
+        return self.last_viewed is None or self.clock() - self.last_viewed > self.idle_after
+
+    def viewed(self):
+        """Record that someone is looking at the status page"""
+        now = self.clock()
+        was_idle = self.is_idle()
+        self.last_viewed = now
+        if was_idle:
+            # Bring anything stale up to date right away
+            for job in self.jobs:
+                if job.next_run is not None and job.last_started is not None:
+                    job.next_run = min(job.next_run, job.last_started + job.interval)
+            self._wakeup.set()
+
+    def interval(self, job: Job) -> float:
+        interval = job.interval
+        if job.adaptive:
+            if self.is_idle():
+                interval *= self.idle_factor
+            interval = max(interval, job.duration * self.load_factor)
+        return interval
+
+    def stagger(self):
+        """Spread the first runs of the jobs across their intervals"""
+        now = self.clock()
+        for i, job in enumerate(self.jobs):
+            job.next_run = now + job.interval * i / len(self.jobs)
+
+    def run_pending(self) -> float:
+        """Start every job which is due, returning the seconds until the next is due (or None)"""
+        now = self.clock()
+        for job in self.jobs:
+            if not job.running and job.next_run <= now:
+                self._start(job)
+
+        waiting = [job.next_run for job in self.jobs if not job.running]
+        return max(0.0, min(waiting) - now) if waiting else None
+
+    def _start(self, job: Job):
+        job.running = True
+        job.last_started = self.clock()
+        task = asyncio.ensure_future(self._run_job(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, job: Job):
+        try:
+            await job.func()
+        except Exception:
+            logger.exception('Polling job {} failed'.format(job.name))
+        finally:
+            duration = self.clock() - job.last_started
+            # Smooth out the odd slow run
+            job.duration = duration if not job.duration else job.duration * 0.7 + duration * 0.3
+            job.running = False
+            job.next_run = job.last_started + self.interval(job)
+            self._wakeup.set()
+
+    async def run(self):
+        logger.info('Starting polling scheduler with jobs: {}'.format(', '.join(job.name for job in self.jobs)))
+        if self.last_viewed is None:
+            # Count starting up as a view, so that everything warms up at the full rate
+            self.last_viewed = self.clock()
+        self.stagger()
+        try:
+            while True:
+                self._wakeup.clear()
+                delay = self.run_pending()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
@@ -1,35 +1,36 @@
 import argparse
+import asyncio
 import logging
+import multiprocessing
+import os
 import signal
-import sys
+import tempfile
 from pathlib import Path
 
 from aiohttp import web
 
-from factorio_status_ui.state import application_config
+from factorio_status_ui import admin, assets, logs
+from factorio_status_ui.mod_portal import MOD_PORTAL_URL
+from factorio_status_ui.snapshot import CONTROL_SOCKET
+from factorio_status_ui.state import application_config, configure_servers
+from factorio_status_ui.utils import handle_aio_exceptions, prepare_private_directory
 from factorio_status_ui.web import setup_routes, setup_templates, start_background_tasks, cleanup_background_tasks, \
-    get_version
+    get_version, setup_control_routes, start_worker_tasks, cleanup_worker_tasks
 
+logger = logging.getLogger('factorio_status_ui')
 
-def main():
-    print(sys.argv)
-
-    # Logging
-    logger = logging.getLogger('factorio_status_ui')
-    logger.setLevel(logging.DEBUG)
+# For the default locations of files which only this user should be able to change
+PRIVATE_DIRECTORY = Path(tempfile.gettempdir()) / 'factorio-status-ui-{}'.format(os.getuid())
 
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.DEBUG)
-    handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s | %(msg)s'))
-    logger.addHandler(handler)
 
-    # Arguments
+def get_parser():
     parser = argparse.ArgumentParser(
         description='Factorio status UI',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
-    required = parser.add_argument_group('required arguments')
+    required = parser.add_argument_group('required arguments', 'Required unless --servers-file is given, in '
+                                                               'which case they are defaults for every server.')
 
     parser.add_argument('--port', help='The port on which to serve the status page.', type=int, default=8080)
     parser.add_argument('--host', help='The IP on which to serve the status page.', default='0.0.0.0')
@@ -39,31 +40,221 @@ def main():
                                               'Will attempt to autodetect.')
     parser.add_argument('--server-port', help='Factorio server port. For display purposes only.', default=34197)
 
-    required.add_argument('--rcon-host', help='RCON host address.', required=True)
-    required.add_argument('--rcon-port', help='RCON port.', type=int, required=True, default=27015)
-    required.add_argument('--rcon-password', help='RCON password.', required=True)
+    required.add_argument('--rcon-host', help='RCON host address.')
+    required.add_argument('--rcon-port', help='RCON port.', type=int, default=27015)
+    required.add_argument('--rcon-password', help='RCON password.')
     parser.add_argument('--rcon-timeout', help='RCON timeout in seconds.', default=1, type=int)
+    parser.add_argument('--rcon-lua-batching', help='Fetch all player state in a single Lua command rather than '
+                                                    'separate /players and /admins commands. Note that running '
+                                                    'Lua commands disables achievements for the save.',
+                        action='store_true')
+    parser.add_argument('--rcon-max-in-flight', help='Most RCON commands to send to a server at once. Others '
+                                                     'wait, with admin console commands going first.',
+                        type=int, default=4)
+    parser.add_argument('--rcon-max-queue', help='Most RCON commands which may wait to be sent to a server, '
+                                                 'beyond which commands are refused.', type=int, default=100)
+
+    required.add_argument('--mods-directory', help='Path to factorio mods directory.', type=Path)
+    required.add_argument('--saves-directory', help='Path to factorio saves directory.', type=Path)
+    parser.add_argument('--mods-watcher', help='How to detect changes to the mods & saves directories. "auto" '
+                                               'uses inotify where available. Use "poll" for network filesystems '
+                                               'where changes are made from another host.',
+                        choices=['auto', 'inotify', 'poll'], default='auto')
+    parser.add_argument('--mods-accel-redirect', help='Have a front proxy serve mod downloads by responding with '
+                                                      'an X-Accel-Redirect header pointing to this location '
+                                                      '(e.g. /protected-mods/) rather than sending the file.')
+    parser.add_argument('--stream-all-mods', help='Generate the "download all mods" zip file on the fly for each '
+                                                  'download, rather than keeping a copy on disk.',
+                        action='store_true')
+    parser.add_argument('--all-mods-directory', help='Where to keep "download all mods" zip files.', type=Path,
+                        default=Path(tempfile.gettempdir()) / 'factorio-status-ui')
+    parser.add_argument('--all-mods-max-count', help='Maximum number of "download all mods" zip files to keep. '
+                                                     'Least recently used files are deleted first.',
+                        type=int, default=3)
+    parser.add_argument('--all-mods-max-size', help='Maximum total size in MB of "download all mods" zip files '
+                                                    'to keep. Unlimited if not set.', type=int)
+    parser.add_argument('--all-mods-max-streams', help='Most "download all mods" zip files to generate at once '
+                                                       'with --stream-all-mods. Further downloads are refused '
+                                                       'until one finishes.', type=int, default=4)
+    parser.add_argument('--poll-players-interval', help='Seconds between polls of player state via RCON.',
+                        type=float, default=1)
+    parser.add_argument('--poll-config-interval', help='Seconds between polls of server config via RCON.',
+                        type=float, default=10)
+    parser.add_argument('--poll-mods-interval', help='Seconds between scans of the mods directory, when it cannot '
+                                                     'be watched with inotify.', type=float, default=1)
+    parser.add_argument('--poll-saves-interval', help='Seconds between scans of the saves directory, when it '
+                                                      'cannot be watched with inotify.', type=float, default=5)
+    parser.add_argument('--poll-mod-portal-interval', help='Seconds between refreshes of mod portal information.',
+                        type=float, default=60 * 60 * 24)
+    parser.add_argument('--poll-idle-factor', help='How many times less often to poll via RCON when nobody is '
+                                                   'viewing the status page.', type=float, default=10)
+    parser.add_argument('--mod-portal-cache', help='Where to cache information from the Factorio mod portal.',
+                        type=Path, default=Path(tempfile.gettempdir()) / 'factorio-status-ui' / 'mod-portal.json')
+    parser.add_argument('--mod-portal-file', help='Read mod portal information from this local copy of '
+                                                  'https://mods.factorio.com/api/mods rather than downloading it.',
+                        type=Path)
+    parser.add_argument('--history-directory', help='Where to record the history of players & server config. '
+                                                    'Each server is recorded in its own subdirectory, which is '
+                                                    'created private to this user if it does not exist, and '
+                                                    'refused if anyone else could write to it.',
+                        type=Path, default=PRIVATE_DIRECTORY / 'history')
+    parser.add_argument('--history-max-events', help='Number of player/config events to keep per server. Each '
+                                                     'takes 16 bytes on disk.', type=int, default=1000000)
+    parser.add_argument('--servers-file', help='Monitor several Factorio servers, as listed in this JSON file. '
+                                               'Each server is an object with a unique "slug" plus any of the '
+                                               'above options (with underscores) which differ for that server, '
+                                               'e.g. [{"slug": "vanilla", "rcon_host": "10.0.0.2", ...}]',
+                        type=Path)
+    parser.add_argument('--mod-portal-url', help='Where to download mod portal information from.',
+                        default=MOD_PORTAL_URL)
+    parser.add_argument('--workers', help='Serve pages from this many worker processes, sharing the port, while '
+                                          'the main process does all the polling. 0 does everything in a single '
+                                          'process.', type=int, default=0)
+    parser.add_argument('--snapshot-directory', help='Where the last known state is saved, to be served '
+                                                     'straight away after a restart. Also where the polling '
+                                                     'process shares its state with the workers, when using '
+                                                     '--workers. Use persistent storage to survive a reboot. '
+                                                     'Created private to this user if it does not exist, and '
+                                                     'refused if anyone else could write to it.',
+                        type=Path, default=PRIVATE_DIRECTORY)
+
+    parser.add_argument('--admin-tokens-file', help='Enables the admin console at /api/admin/command. A JSON '
+                                                    'object of admin user names to their secret tokens.',
+                        type=Path)
+    parser.add_argument('--admin-rate-limit', help='Admin console commands allowed per admin per minute.',
+                        type=float, default=30)
+    parser.add_argument('--admin-rate-burst', help='Admin console commands each admin may send in quick '
+                                                   'succession.', type=int, default=5)
+
+    parser.add_argument('--log-level', help='Level of our own logging.', choices=logs.LEVELS, default='INFO')
+    parser.add_argument('--log-format', help='Log as text, or as one JSON object per line for log collectors.',
+                        choices=['text', 'json'], default='text')
+    parser.add_argument('--logger-level', help='Set the level of a particular logger, e.g. '
+                                               '"factorio_status_ui.rcon=DEBUG" or "aiohttp.access=INFO". '
+                                               'May be given several times.',
+                        dest='logger_levels', metavar='LOGGER=LEVEL', type=logs.logger_level, action='append',
+                        default=[])
+    return parser
+
+
+def setup_logging():
+    logs.setup_logging(application_config.log_level, application_config.log_format,
+                       application_config.logger_levels)
+
+
+def run_worker(options: dict):
+    """Serve pages from the polling process's snapshots. Runs in each worker process."""
+    for option, value in options.items():
+        setattr(application_config, option, value)
+    setup_logging()
+    configure_servers()
+
+    app = web.Application()
+    setup_routes(app, worker=True)
+    setup_templates(app)
+    app.on_startup.append(start_worker_tasks)
+    app.on_startup.append(get_version)
+    app.on_cleanup.append(cleanup_worker_tasks)
+    web.run_app(app, host=application_config.host, port=application_config.port, reuse_port=True, print=None)
+
 
-    required.add_argument('--mods-directory', help='Path to factorio mods directory.', type=Path, required=True)
-    required.add_argument('--saves-directory', help='Path to factorio saves directory.', type=Path, required=True)
+def start_worker(context, number: int):
+    process = context.Process(target=run_worker, args=(dict(application_config.__dict__),),
+                              name='factorio-status-ui-worker-{}'.format(number), daemon=True)
+    process.start()
+    logger.info('Started worker {} (pid {})'.format(number, process.pid))
+    return process
 
+
+async def supervise_workers(app, interval=5):
+    """Restart any worker which exits"""
+    while True:
+        await asyncio.sleep(interval)
+        for number, process in enumerate(app['workers']):
+            if not process.is_alive():
+                logger.warning('Worker {} (pid {}) exited with code {}, restarting'.format(
+                    number, process.pid, process.exitcode
+                ))
+                app['workers'][number] = start_worker(app['worker_context'], number)
+
+
+async def start_workers(app):
+    # Forking a process with a running event loop is unsafe, so start afresh
+    context = app['worker_context'] = multiprocessing.get_context('spawn')
+    app['workers'] = [start_worker(context, number) for number in range(application_config.workers)]
+    app['supervisor'] = asyncio.ensure_future(handle_aio_exceptions(supervise_workers(app)))
+
+
+async def stop_workers(app):
+    app['supervisor'].cancel()
+    for process in app['workers']:
+        process.terminate()
+    for process in app['workers']:
+        process.join(10)
+
+
+def main():
+    # Arguments
+    parser = get_parser()
     args = parser.parse_args()
+    if not args.servers_file:
+        for option in ('rcon_host', 'rcon_password', 'mods_directory', 'saves_directory'):
+            if getattr(args, option) is None:
+                parser.error('--{} is required unless --servers-file is given'.format(option.replace('_', '-')))
+
     for option in dir(application_config):
         if option.startswith('_'):
             continue
         setattr(application_config, option, getattr(args, option))
 
+    # Logging
+    setup_logging()
+
+    try:
+        configure_servers()
+    except (OSError, ValueError) as e:
+        parser.error('Invalid servers file: {}'.format(e))
+    if args.admin_tokens_file:
+        try:
+            admin.load_tokens(args.admin_tokens_file)
+        except (OSError, ValueError) as e:
+            parser.error('Invalid admin tokens file: {}'.format(e))
+    try:
+        prepare_private_directory(application_config.snapshot_directory)
+    except OSError as e:
+        parser.error('Unusable snapshot directory: {}'.format(e))
+
     logger.info('Starting up')
-    logger.info('Arguments: {}'.format(args.__dict__))
+    logger.info('Arguments: {}'.format(
+        {option: '***' if option == 'rcon_password' else value for option, value in args.__dict__.items()}
+    ))
 
     # App
     app = web.Application()
-    setup_routes(app)
-    setup_templates(app)
-    app.on_startup.append(start_background_tasks)
-    app.on_startup.append(get_version)
-    app.on_cleanup.append(cleanup_background_tasks)
-    web.run_app(app, host=application_config.host, port=application_config.port)
+    if application_config.workers:
+        # This process just polls, and serves the workers over a Unix socket
+        setup_control_routes(app)
+        # Before the workers start, so that they don't all build the assets at once
+        assets.ensure_built()
+        app.on_startup.append(start_background_tasks)
+        app.on_startup.append(start_workers)
+        app.on_cleanup.append(stop_workers)
+        app.on_cleanup.append(cleanup_background_tasks)
+
+        socket_path = application_config.snapshot_directory / CONTROL_SOCKET
+        if socket_path.exists():
+            socket_path.unlink()
+        logger.info('Serving on http://{}:{} with {} workers'.format(
+            application_config.host, application_config.port, application_config.workers
+        ))
+        web.run_app(app, path=str(socket_path), print=None)
+    else:
+        setup_routes(app)
+        setup_templates(app)
+        app.on_startup.append(start_background_tasks)
+        app.on_startup.append(get_version)
+        app.on_cleanup.append(cleanup_background_tasks)
+        web.run_app(app, host=application_config.host, port=application_config.port)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,295 @@
+"""A simulated Factorio server & mod portal, for benchmarking and local development
+
+``FakeFactorio`` answers RCON as a headless server does: authentication,
+``/players``, ``/admins``, ``/config get`` & ``/config set``, and the Lua
+player list used with ``--rcon-lua-batching``. As with Factorio, each
+``/config`` reply is followed by an empty packet carrying the same message ID.
+Replies can be delayed and connections dropped at random, to see how the UI
+copes with a struggling server.
+
+``FakeModPortal`` serves a generated mod database in the format of
+https://mods.factorio.com/api/mods, supporting conditional requests.
+
+Both listen on localhost, on a random free port unless one is given::
+
+    factorio = FakeFactorio(players=5000, online=500)
+    port = await factorio.start()
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import socket
+import zipfile
+from collections import Counter
+from pathlib import Path
+
+from aiohttp import web
+
+from factorio_status_ui import rcon
+
+logger = logging.getLogger(__name__)
+
+# As printed by /config get
+DEFAULT_CONFIG = {
+    'afk-auto-kick': '0',
+    'allow-commands': 'admins-only',
+    'autosave-interval': 'Autosave every 10 minutes',
+    'autosave-only-on-server': 'true',
+    'ignore-player-limit-for-returning-players': 'false',
+    'max-players': '0',
+    'max-upload-speed': '0',
+    'only-admins-can-pause': 'true',
+    'password': "The server currently doesn't have a password",
+    'require-user-verification': 'true',
+    'visibility-lan': 'true',
+    'visibility-public': 'true',
+}
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    return sock
+
+
+class FakeFactorio(object):
+    """An RCON server with a population of simulated players
+
+    ``latency`` (plus up to ``jitter``) seconds pass before each reply, and
+    each command has a ``drop_rate`` chance of the connection being closed
+    instead. These may be changed at any time.
+    """
+
+    def __init__(self, password='password', players=100, online=10, admins=2, latency=0.0, jitter=0.0,
+                 drop_rate=0.0, seed=None):
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        self.players = ['player-{}'.format(i) for i in range(players)]
+        self.online = set(self.random.sample(self.players, min(online, players)))
+        self.admins = set(self.players[:admins])
+        self.config = dict(DEFAULT_CONFIG)
+        # Commands received, by their first word
+        self.commands = Counter()
+        self.connections = 0
+
+        self._server = None
+        self._writers = set()
+        self._tasks = set()
+
+    async def start(self, host='127.0.0.1', port=0) -> int:
+        """Start listening, returning the port"""
+        sock = bind_socket(host, port)
+        self._server = await asyncio.start_server(self._handle, sock=sock)
+        return sock.getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        self.disconnect_all()
+        for task in list(self._tasks):
+            task.cancel()
+        await self._server.wait_closed()
+
+    def disconnect_all(self):
+        for writer in list(self._writers):
+            writer.close()
+        self._writers.clear()
+
+    def join(self, username: str):
+        if username not in self.players:
+            self.players.append(username)
+        self.online.add(username)
+
+    def leave(self, username: str):
+        self.online.discard(username)
+
+    def churn(self, count: int):
+        """Have ``count`` random players join or leave"""
+        for username in self.random.sample(self.players, min(count, len(self.players))):
+            if username in self.online:
+                self.leave(username)
+            else:
+                self.join(username)
+
+    def players_output(self) -> str:
+        lines = ['Players ({}):'.format(len(self.players))]
+        lines.extend(
+            '  {}{}'.format(username, ' (online)' if username in self.online else '') for username in self.players
+        )
+        return '\n'.join(lines)
+
+    def admins_output(self) -> str:
+        return '\n'.join(
+            '  {}{}'.format(username, ' (online)' if username in self.online else '')
+            for username in self.players if username in self.admins
+        )
+
+    def player_list_json(self) -> str:
+        return json.dumps({'players': [
+            {'name': username, 'online': username in self.online, 'admin': username in self.admins}
+            for username in self.players
+        ]})
+
+    def execute(self, command: str) -> list:
+        """Run a command, returning the bodies of the response packets"""
+        name, _, argument = command.partition(' ')
+        self.commands[name] += 1
+
+        if name == '/players':
+            return [self.players_output()]
+        if name == '/admins':
+            return [self.admins_output()]
+        if name == '/config':
+            action, _, rest = argument.partition(' ')
+            option, _, value = rest.partition(' ')
+            if option not in self.config:
+                reply = 'Unknown option {}.'.format(option)
+            elif action == 'set':
+                self.config[option] = value
+                reply = ''
+            else:
+                reply = '{}: {}'.format(option, self.config[option])
+            return [reply, '']
+        if name in ('/silent-command', '/sc', '/command', '/c'):
+            return [self.player_list_json() if 'game.players' in argument else '']
+        if name.startswith('/'):
+            return ['Unknown command "{}".'.format(name[1:])]
+        # Anything else is chat
+        return ['']
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        self.connections += 1
+        authenticated = False
+        try:
+            while True:
+                size, = rcon.SIZE_STRUCT.unpack(await reader.readexactly(rcon.SIZE_STRUCT.size))
+                frame = await reader.readexactly(size)
+                message_id, message_type = rcon.RESPONSE_HEADER_STRUCT.unpack_from(frame)
+                body = frame[rcon.RESPONSE_HEADER_STRUCT.size:-2].decode('utf8')
+
+                if message_type == rcon.MESSAGE_TYPE_AUTH:
+                    authenticated = body == self.password
+                    self._send(writer, message_id if authenticated else -1, rcon.MESSAGE_TYPE_AUTH_RESP, '')
+                elif not authenticated:
+                    break
+                else:
+                    # Replied to independently, so pipelined commands each see the latency once
+                    task = asyncio.ensure_future(self._reply(writer, message_id, body))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _reply(self, writer, message_id: int, command: str):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.drop_rate:
+            logger.debug('Dropping RCON connection on command {}'.format(command))
+            writer.close()
+            return
+        for body in self.execute(command):
+            self._send(writer, message_id, rcon.MESSAGE_TYPE_RESP, body)
+
+    def _send(self, writer, message_id: int, message_type: int, body: str):
+        if writer.transport.is_closing():
+            return
+        data = body.encode('utf8')
+        writer.write(b''.join([
+            rcon.PACKET_HEADER_STRUCT.pack(rcon.RESPONSE_HEADER_STRUCT.size + len(data) + 2, message_id, message_type),
+            data,
+            b'\x00\x00',
+        ]))
+
+
+class FakeModPortal(object):
+    """Serves /api/mods for the given mod names"""
+
+    def __init__(self, names, seed=None):
+        generator = random.Random(seed)
+        self.mods = [
+            {
+                'name': name,
+                'title': name.replace('-', ' ').title(),
+                'owner': 'owner-{}'.format(generator.randrange(100)),
+                'summary': 'Summary of {}'.format(name),
+                'downloads_count': generator.randrange(1000000),
+                'category': 'content',
+            }
+            for name in names
+        ]
+        self.requests = 0
+        self.url = None
+        self._runner = None
+
+    def document(self) -> bytes:
+        return json.dumps({
+            'pagination': {'count': len(self.mods), 'page': 1, 'page_count': 1, 'page_size': len(self.mods)},
+            'results': self.mods,
+        }).encode('utf8')
+
+    async def handle_mods(self, request):
+        self.requests += 1
+        body = self.document()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def start(self, host='127.0.0.1', port=0) -> int:
+        """Start listening, returning the port"""
+        app = web.Application()
+        app.router.add_get('/api/mods', self.handle_mods)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        sock = bind_socket(host, port)
+        port = sock.getsockname()[1]
+        await web.SockSite(self._runner, sock).start()
+        self.url = 'http://{}:{}/api/mods?page_size=max'.format(host, port)
+        return port
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+def make_mods_directory(directory: Path, count: int, disabled=0, seed=None) -> list:
+    """Fill a mods directory with small mod archives, each depending on an earlier mod
+
+    Returns the names of the mods.
+    """
+    generator = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    names = ['mod-{}'.format(i) for i in range(count)]
+    for i, name in enumerate(names):
+        version = '1.{}.{}'.format(generator.randrange(10), generator.randrange(100))
+        dependencies = ['base >= 1.1']
+        if i:
+            dependencies.append('{} >= 1.0.0'.format(names[generator.randrange(i)]))
+        top = '{}_{}'.format(name, version)
+        with zipfile.ZipFile(str(directory / '{}.zip'.format(top)), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('{}/info.json'.format(top), json.dumps({
+                'name': name,
+                'version': version,
+                'title': name.title(),
+                'factorio_version': '1.1',
+                'dependencies': dependencies,
+            }))
+            zip_file.writestr('{}/data.lua'.format(top), '-- {}\n'.format(name) * generator.randrange(1, 200))
+
+    mod_list = [{'name': 'base', 'enabled': True}]
+    mod_list.extend({'name': name, 'enabled': i < count - disabled} for i, name in enumerate(names))
+    with open(directory / 'mod-list.json', 'w') as f:
+        json.dump({'mods': mod_list}, f)
+    with open(directory / 'mod-settings.json', 'w') as f:
+        json.dump({'startup': {}, 'runtime-global': {}, 'runtime-per-user': {}}, f)
+    return names
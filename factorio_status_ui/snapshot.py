@@ -0,0 +1,327 @@
+"""Saving state, to restore after a restart and to share with web worker processes
+
+The state of all servers is saved to a snapshot file as it changes, so that
+after a restart the last known state can be served straight away (marked as
+stale) while the pollers catch up.
+
+With ``--workers``, one process runs every poller (so there is still exactly
+one RCON connection per server) and publishes the state of all servers as an
+immutable, versioned snapshot file. Each web worker reads the latest
+snapshot and serves requests from it, without any connections of its own.
+
+Snapshots are written to a temporary file and renamed into place, so a
+worker only ever sees a complete snapshot. Workers turn the differences
+between successive snapshots into the usual server-sent events.
+
+Snapshots are pickled, so anyone able to write one could run code as this
+process. The snapshot directory must therefore belong to this user and be
+writable by nobody else, and only snapshots belonging to this user are read.
+
+The polling process also listens on a Unix socket in the snapshot directory,
+where workers report their viewers (so that polling still adapts to demand)
+and to which they forward the requests which need the history store or the
+poller's metrics.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import time
+from pathlib import Path
+
+import aiohttp
+
+from factorio_status_ui import events
+from factorio_status_ui.state import Server, ServerConfig, servers, mod_database
+from factorio_status_ui.utils import check_private, prepare_private_directory
+
+logger = logging.getLogger(__name__)
+
+# magic, snapshot version
+HEADER_STRUCT = struct.Struct('<4sQ')
+MAGIC = b'FSUS'
+
+SNAPSHOT_FILE = 'state'
+CONTROL_SOCKET = 'control.sock'
+
+# The parts of each server's state which workers need
+SERVER_ATTRIBUTES = (
+    'players', 'mods', 'mods_by_file_name', 'unused_mod_files', 'mod_settings', 'saves', 'saves_by_file_name',
+    'all_mods_file', 'config', 'rcon_health', 'sources', 'state_version',
+)
+# The attributes restored from each source of state after a restart. RCON health is always fresh.
+RESTORED_SOURCES = {
+    'players': ('players',),
+    'config': ('config',),
+    'mods': ('mods', 'mods_by_file_name', 'unused_mod_files', 'mod_settings', 'all_mods_file'),
+    'saves': ('saves', 'saves_by_file_name'),
+}
+
+
+class SnapshotError(Exception): pass
+
+
+# Raised by snapshots which are empty, corrupt, or from a version with different state classes
+SNAPSHOT_READ_ERRORS = (
+    OSError, SnapshotError, pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError
+)
+
+
+def server_state(server: Server) -> dict:
+    state = {attribute: getattr(server, attribute) for attribute in SERVER_ATTRIBUTES}
+    # Set once the server's public IP is known
+    state['server_host'] = server.settings.server_host
+    return state
+
+
+def take_snapshot() -> dict:
+    return {
+        'servers': {slug: server_state(server) for slug, server in servers.items()},
+        'mod_database': mod_database,
+        'saved_at': time.time(),
+    }
+
+
+def write_snapshot(path: Path, version: int, data: bytes):
+    """Atomically replace the snapshot. Blocking."""
+    tmp_path = path.with_name('{}.tmp'.format(path.name))
+    with open(tmp_path, 'wb') as f:
+        os.fchmod(f.fileno(), 0o600)
+        f.write(HEADER_STRUCT.pack(MAGIC, version))
+        f.write(data)
+    os.replace(str(tmp_path), str(path))
+
+
+def read_snapshot(path: Path):
+    """Read the snapshot, returning (version, data). Blocking."""
+    with open(path, 'rb') as f:
+        # Checked on the open file, so that it can't be swapped after the check
+        check_private(path, os.fstat(f.fileno()))
+        data = f.read()
+    if len(data) < HEADER_STRUCT.size:
+        raise SnapshotError('Snapshot {} is truncated'.format(path))
+    magic, version = HEADER_STRUCT.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError('{} is not a snapshot'.format(path))
+    return version, pickle.loads(memoryview(data)[HEADER_STRUCT.size:])
+
+
+def restore(data: dict):
+    """Restore the last known state from a previous run's snapshot, marked as stale until refreshed"""
+    mod_database.update(data['mod_database'])
+    for slug, state in data['servers'].items():
+        server = servers.get(slug)
+        if server is None:
+            continue
+        for source, attributes in RESTORED_SOURCES.items():
+            value = state[attributes[0]]
+            if source not in server.sources or not (value.as_dict() if isinstance(value, ServerConfig) else value):
+                continue
+            for attribute in attributes:
+                setattr(server, attribute, state[attribute])
+            server.sources[source].restored = True
+        if server.all_mods_file and not server.all_mods_file.exists():
+            # Since evicted
+            server.all_mods_file = None
+        # Carry on from the previous run's versions, so that no worker's cached page is mistaken for the new state
+        server.state_version = state['state_version'] + 1
+
+
+class SnapshotWriter(object):
+    """Publishes a new snapshot whenever any server's state version changes"""
+
+    def __init__(self, directory: Path, interval=0.1):
+        self.path = directory / SNAPSHOT_FILE
+        self.interval = interval
+        # Start from the time, so that a restarted poller's snapshots never reuse a version
+        self.version = int(time.time() * 1000000)
+        self._published = None
+
+    async def run(self):
+        logger.info('Publishing state snapshots to {}'.format(self.path))
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, prepare_private_directory, self.path.parent)
+        except OSError as e:
+            logger.error('Not saving state snapshots: {}'.format(e))
+            return
+        try:
+            while True:
+                state_versions = tuple(server.state_version for server in servers.values())
+                if state_versions != self._published:
+                    # Pickled here, as the state may change while another thread writes
+                    data = pickle.dumps(take_snapshot(), protocol=pickle.HIGHEST_PROTOCOL)
+                    self.version += 1
+                    await loop.run_in_executor(None, write_snapshot, self.path, self.version, data)
+                    self._published = state_versions
+                await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            return
+
+
+def publish_changes(server: Server, previous: dict, current: dict):
+    """Send the events for what has changed between a server's snapshots
+
+    The previous mods are given already converted to dicts, as they include
+    records from the previous mod database.
+    """
+    slug = server.slug
+    if previous['rcon_health'].as_dict() != current['rcon_health'].as_dict():
+        events.publish(slug, 'status', current['rcon_health'].as_dict())
+
+    old_players, new_players = previous['players'], current['players']
+    changed = (old_players.online ^ new_players.online) | (old_players.admins ^ new_players.admins)
+    if len(new_players) != len(old_players):
+        changed.update(player.username for player in new_players if player.username not in old_players)
+    if changed:
+        events.publish(slug, 'players', [new_players.get(username).as_dict() for username in sorted(changed)])
+
+    stale = [name for name, status in current['sources'].items() if status.is_stale]
+    if stale != [name for name, status in previous['sources'].items() if status.is_stale]:
+        events.publish(slug, 'sources', {name: status.as_dict() for name, status in current['sources'].items()})
+
+    if previous['config'].as_dict() != current['config'].as_dict():
+        events.publish(slug, 'config', current['config'].as_dict())
+    mods = [mod.as_dict() for mod in current['mods']]
+    if mods != previous['mods']:
+        events.publish(slug, 'mods', mods)
+    # Compared as dicts, as the saves are new objects in every snapshot
+    saves = [save.as_dict() for save in current['saves']]
+    if saves != [save.as_dict() for save in previous['saves']]:
+        events.publish(slug, 'saves', saves)
+
+
+class SnapshotReader(object):
+    """Keeps a worker's state up to date with the latest snapshot"""
+
+    def __init__(self, directory: Path, interval=0.1):
+        self.path = directory / SNAPSHOT_FILE
+        self.interval = interval
+        self.version = None
+        self._stat = None
+
+    def apply(self, data: dict):
+        # Only servers which someone is watching need their changes turned into events
+        watched = [slug for slug in servers if events.subscriber_count(slug)]
+        previous = {}
+        for slug in watched:
+            previous[slug] = server_state(servers[slug])
+            previous[slug]['mods'] = [mod.as_dict() for mod in servers[slug].mods]
+
+        mod_database.clear()
+        mod_database.update(data['mod_database'])
+        for slug, state in data['servers'].items():
+            server = servers.get(slug)
+            if server is None:
+                continue
+            server.settings.server_host = state.pop('server_host')
+            if slug in previous:
+                publish_changes(server, previous[slug], state)
+            for attribute, value in state.items():
+                setattr(server, attribute, value)
+
+    def check(self):
+        """Read the snapshot if it has been replaced, returning (version, data) or None. Blocking."""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat == self._stat:
+            return None
+        # Set first, so that a bad snapshot is only reported once rather than retried until replaced
+        self._stat = stat
+        version, data = read_snapshot(self.path)
+        return (version, data) if version != self.version else None
+
+    async def run(self):
+        logger.info('Reading state snapshots from {}'.format(self.path))
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    snapshot = await loop.run_in_executor(None, self.check)
+                except SNAPSHOT_READ_ERRORS as e:
+                    logger.warning('Could not read state snapshot: {}'.format(e))
+                    snapshot = None
+                if snapshot:
+                    version, data = snapshot
+                    self.apply(data)
+                    self.version = version
+                await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            return
+
+
+class WorkerViewers(object):
+    """The viewers of each server, as last reported by each worker. Used in the polling process."""
+    # Reports from workers which have stopped reporting are ignored after this many seconds
+    expire_after = 30
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.reports = {}  # pid -> (time, {slug: viewers})
+
+    def report(self, pid: int, viewers: dict):
+        self.reports[pid] = (self.clock(), viewers)
+
+    def count(self, slug: str) -> int:
+        now = self.clock()
+        return sum(
+            viewers.get(slug, 0) for reported, viewers in self.reports.values() if now - reported < self.expire_after
+        )
+
+
+class RemoteScheduler(object):
+    """Stands in for a server's scheduler in a worker, passing page views on to the polling process"""
+
+    def __init__(self, reporter: 'ViewerReporter', slug: str):
+        self.reporter = reporter
+        self.slug = slug
+
+    def viewed(self):
+        self.reporter.viewed.add(self.slug)
+
+
+class ViewerReporter(object):
+    """Reports a worker's viewers & page views to the polling process
+
+    A report is sent whenever something has changed, and at least every
+    ``heartbeat`` seconds so that the report does not expire.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, interval=1, heartbeat=10):
+        self.session = session
+        self.url = url
+        self.interval = interval
+        self.heartbeat = heartbeat
+        # Servers whose pages have been viewed since the last report
+        self.viewed = set()
+
+    def scheduler(self, slug: str) -> RemoteScheduler:
+        return RemoteScheduler(self, slug)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        url = '{}/workers/{}/viewers'.format(self.url, os.getpid())
+        last_viewers = None
+        last_sent = None
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                viewers = {slug: events.subscriber_count(slug) for slug in servers}
+                if viewers == last_viewers and not self.viewed and loop.time() - last_sent < self.heartbeat:
+                    continue
+
+                viewed, self.viewed = self.viewed, set()
+                try:
+                    async with self.session.post(url, json={'viewers': viewers, 'viewed': sorted(viewed)}) as response:
+                        response.raise_for_status()
+                except (aiohttp.ClientError, OSError) as e:
+                    logger.debug('Could not report viewers to the polling process: {}'.format(e))
+                    continue
+                last_viewers = viewers
+                last_sent = loop.time()
+        except asyncio.CancelledError:
+            return
@@ -1,5 +1,11 @@
+import json
+import re
+import time
+from datetime import datetime
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Dict
+
+from factorio_status_ui.utils import mod_key
 
 
 class State(object):
@@ -9,10 +15,14 @@ class State(object):
             setattr(self, k, v)
 
 
-class Player(State):
-    username: str
-    is_online: bool = False
-    is_admin: bool = False
+class Player(object):
+    # Long running servers can know of many thousands of players, so keep them small
+    __slots__ = ('username', 'is_online', 'is_admin')
+
+    def __init__(self, username: str, is_online: bool = False, is_admin: bool = False):
+        self.username = username
+        self.is_online = is_online
+        self.is_admin = is_admin
 
     def __repr__(self):
         return '<Player: {}, is_online={}, is_admin={}>'.format(
@@ -21,12 +31,88 @@ class Player(State):
             self.is_admin,
         )
 
+    def as_dict(self):
+        return {
+            'username': self.username,
+            'is_online': self.is_online,
+            'is_admin': self.is_admin,
+        }
+
+
+class PlayerRegistry(object):
+    """Every player the server has reported, indexed by username
+
+    Players are kept in the order they were first seen. The usernames of
+    online players and of admins are also kept as sets, so that each poll can
+    be applied as a diff against the previous one.
+    """
+
+    def __init__(self):
+        self._players = {}
+        self.online = set()
+        self.admins = set()
+
+    def __iter__(self):
+        return iter(self._players.values())
+
+    def __len__(self):
+        return len(self._players)
+
+    def __contains__(self, username):
+        return username in self._players
+
+    def __repr__(self):
+        return '<PlayerRegistry: {} players, {} online, {} admins>'.format(
+            len(self._players), len(self.online), len(self.admins)
+        )
+
+    def get(self, username: str) -> Player:
+        return self._players.get(username)
+
+    def add(self, usernames) -> List[Player]:
+        """Add any players not seen before, returning the new players"""
+        added = []
+        for username in usernames:
+            if username not in self._players:
+                player = self._players[username] = Player(username)
+                added.append(player)
+        return added
+
+    def set_online(self, usernames: set):
+        """Set exactly which players are online, returning the (joined, left) usernames"""
+        self.add(usernames)
+        joined = usernames - self.online
+        left = self.online - usernames
+        for username in joined:
+            self._players[username].is_online = True
+        for username in left:
+            self._players[username].is_online = False
+        self.online = set(usernames)
+        return joined, left
+
+    def set_admins(self, usernames: set):
+        """Set exactly which players are admins, returning the (promoted, demoted) usernames"""
+        self.add(usernames)
+        promoted = usernames - self.admins
+        demoted = self.admins - usernames
+        for username in promoted:
+            self._players[username].is_admin = True
+        for username in demoted:
+            self._players[username].is_admin = False
+        self.admins = set(usernames)
+        return promoted, demoted
+
 
 class Mod(State):
     file: Path
     enabled: bool
     name: str
     version: str
+    title: str = None
+    # Enabled mods which depend on this one
+    dependents: list = ()
+    # Missing or incompatible dependencies etc, if enabled
+    problems: list = ()
 
     def __repr__(self):
         return '<Mod: {}, enabled={}, file={}, version={}>'.format(
@@ -36,6 +122,22 @@ class Mod(State):
             self.version,
         )
 
+    def as_dict(self):
+        mod_data = get_mod_data(self.name)
+        return {
+            'name': self.name,
+            'enabled': self.enabled,
+            'version': self.version,
+            'file_name': self.file.name if self.file else None,
+            'owner': mod_data.get('owner'),
+            'portal_name': mod_data.get('name'),
+            'summary': mod_data.get('summary'),
+            'downloads_count': mod_data.get('downloads_count'),
+            'title': self.title,
+            'dependents': list(self.dependents),
+            'problems': list(self.problems),
+        }
+
 
 class ServerConfig(State):
     afk_auto_kick: bool
@@ -58,13 +160,103 @@ class ServerConfig(State):
         return self.__dict__
 
 
+class RconHealth(State):
+    status: str = 'connecting'  # connecting, connected, disconnected or circuit_open
+    status_since: datetime = None
+    last_error: str = None
+    reconnects: int = 0
+
+    @property
+    def is_connected(self):
+        return self.status == 'connected'
+
+    def __repr__(self):
+        return '<RconHealth: {}, since={}, last_error={}>'.format(
+            self.status,
+            self.status_since,
+            self.last_error,
+        )
+
+    def as_dict(self):
+        return {
+            'status': self.status,
+            'last_error': self.last_error,
+        }
+
+
+class SourceStatus(State):
+    """How fresh one source of a server's state (e.g. its players) is"""
+    # When it was last refreshed, in this run
+    updated: float = None
+    # Whether refreshing it has been tried yet in this run, successfully or not
+    attempted: bool = False
+    # Whether its state was restored from disk at startup
+    restored: bool = False
+
+    @property
+    def is_stale(self):
+        """Only the state restored from disk is available"""
+        return self.restored and self.updated is None
+
+    @property
+    def is_warm(self):
+        """There is state worth serving, or there is no point waiting for it"""
+        return self.attempted or self.restored
+
+    def __repr__(self):
+        return '<SourceStatus: updated={}, attempted={}, restored={}>'.format(
+            self.updated, self.attempted, self.restored
+        )
+
+    def as_dict(self):
+        return {
+            'updated': self.updated,
+            'age': time.time() - self.updated if self.updated else None,
+            'stale': self.is_stale,
+            'warm': self.is_warm,
+        }
+
+
 class Server(State):
+    slug: str = 'default'
+    # This server's options, i.e. the command line options overridden by its servers file entry
+    settings: 'ApplicationConfig' = None
     description: str
-    players: List[Player] = []
-    mods: List[Mod] = []
-    mod_settings: dict = {}
-    all_mods_file: Path
-    config: ServerConfig = ServerConfig()
+    players: PlayerRegistry
+    mods: List[Mod]
+    mods_by_file_name: Dict[str, Mod]
+    # Mod archives which are superseded by a newer version, or whose mod is disabled or not listed
+    unused_mod_files: List[Path]
+    mod_settings: dict
+    saves: tuple
+    saves_by_file_name: dict
+    all_mods_file: Path = None
+    config: ServerConfig
+    rcon_health: RconHealth
+    history: 'HistoryStore' = None
+    # The freshness of each source of the above, by name
+    sources: Dict[str, SourceStatus]
+    # Incremented whenever any of the above changes
+    state_version: int = 0
+
+    def __init__(self, **kwargs):
+        self.players = PlayerRegistry()
+        self.mods = ()
+        self.mods_by_file_name = {}
+        self.unused_mod_files = []
+        self.mod_settings = {}
+        self.saves = ()
+        self.saves_by_file_name = {}
+        self.config = ServerConfig()
+        self.rcon_health = RconHealth()
+        super().__init__(**kwargs)
+        names = ['players', 'config', 'mods']
+        if self.settings and self.settings.saves_directory:
+            names.append('saves')
+        self.sources = {name: SourceStatus() for name in names}
+
+    def stale_sources(self) -> List[str]:
+        return [name for name, status in self.sources.items() if status.is_stale]
 
 
 class ApplicationConfig(State):
@@ -75,9 +267,42 @@ class ApplicationConfig(State):
     rcon_port: int = None
     rcon_password: str = None
     rcon_timeout: int = None
+    rcon_lua_batching: bool = None
+    rcon_max_in_flight: int = None
+    rcon_max_queue: int = None
+
+    stream_all_mods: bool = None
+    all_mods_directory: Path = None
+    all_mods_max_count: int = None
+    all_mods_max_size: int = None
+    all_mods_max_streams: int = None
 
     mods_directory: Path = None
+    mods_watcher: str = None
+    mods_accel_redirect: str = None
+
+    poll_players_interval: float = None
+    poll_config_interval: float = None
+    poll_mods_interval: float = None
+    poll_saves_interval: float = None
+    poll_mod_portal_interval: float = None
+    poll_idle_factor: float = None
+
+    mod_portal_cache: Path = None
+    mod_portal_file: Path = None
+    mod_portal_url: str = None
     saves_directory: Path = None
+    servers_file: Path = None
+    history_directory: Path = None
+    history_max_events: int = None
+    workers: int = None
+    snapshot_directory: Path = None
+    admin_tokens_file: Path = None
+    admin_rate_limit: float = None
+    admin_rate_burst: int = None
+    log_level: str = None
+    log_format: str = None
+    logger_levels: list = None
 
     server_name: str = None
     server_host: str = None
@@ -87,6 +312,65 @@ class ApplicationConfig(State):
         return '<ApplicationConfig: {}>'.format(self.__dict__)
 
 
-server = Server()
+# Options which are shared by all servers, so cannot be set per server
+SHARED_OPTIONS = {
+    'host', 'port', 'servers_file', 'all_mods_directory', 'all_mods_max_count', 'all_mods_max_size',
+    'all_mods_max_streams', 'mod_portal_cache', 'mod_portal_file', 'mod_portal_url', 'poll_mod_portal_interval',
+    'workers', 'snapshot_directory', 'admin_tokens_file', 'admin_rate_limit', 'admin_rate_burst', 'log_level',
+    'log_format', 'logger_levels',
+}
+
+servers = {}
+# Mod portal records of the installed mods, keyed by mod_key()
 mod_database = {}
 application_config = ApplicationConfig()
+
+
+def server_settings(**options) -> ApplicationConfig:
+    """Copy the application config, overriding the given options"""
+    settings = ApplicationConfig(**application_config.__dict__)
+    for option, value in options.items():
+        if option in SHARED_OPTIONS or option.startswith('_') or not hasattr(ApplicationConfig, option):
+            raise ValueError('"{}" cannot be set per server'.format(option))
+        if ApplicationConfig.__annotations__[option] is Path and value is not None:
+            value = Path(value)
+        setattr(settings, option, value)
+    return settings
+
+
+def configure_servers():
+    """Set up the servers to monitor
+
+    Without a servers file there is a single server, configured entirely from
+    the command line. Otherwise the file holds a JSON list of servers, each
+    with a unique "slug" plus any options which differ from the command line
+    ones (e.g. "rcon_host", "mods_directory"), for example::
+
+        [{"slug": "vanilla", "server_name": "Vanilla", "rcon_host": "10.0.0.2", "rcon_password": "...",
+          "mods_directory": "/srv/vanilla/mods", "saves_directory": "/srv/vanilla/saves"}]
+    """
+    servers.clear()
+    if not application_config.servers_file:
+        servers['default'] = Server(slug='default', settings=application_config)
+        return
+
+    with open(application_config.servers_file) as f:
+        entries = json.load(f)
+
+    for entry in entries:
+        entry = dict(entry)
+        slug = entry.pop('slug', None)
+        if not slug or not re.match(r'^[a-z0-9_-]+$', slug):
+            raise ValueError('Each server needs a slug made of lowercase letters, numbers, - and _. Got: {}'.format(slug))
+        if slug in servers:
+            raise ValueError('Server slug "{}" is used more than once'.format(slug))
+        settings = server_settings(**entry)
+        for option in ('rcon_host', 'rcon_port', 'rcon_password', 'mods_directory'):
+            if getattr(settings, option) is None:
+                raise ValueError('Server "{}" has no {}'.format(slug, option))
+        servers[slug] = Server(slug=slug, settings=settings)
+
+
+def get_mod_data(name: str) -> dict:
+    """Get a mod's entry in the mod portal database, if any"""
+    return mod_database.get(mod_key(name), {})
@@ -1,5 +1,10 @@
 import asyncio
+import hashlib
+import os
+import stat
 import traceback
+from functools import partial
+from pathlib import Path
 
 
 async def handle_aio_exceptions(coroutine):
@@ -9,3 +14,63 @@ async def handle_aio_exceptions(coroutine):
         pass
     except Exception:
         traceback.print_exc()
+
+
+def mod_key(name: str) -> str:
+    """Mod names are matched treating underscores & spaces as the same"""
+    return name.replace('_', ' ')
+
+
+def check_private(path: Path, st: os.stat_result):
+    """Refuse a file or directory which isn't this user's, or which anyone else could write to"""
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError('{} must belong to this user and be writable by nobody else'.format(path))
+
+
+def prepare_private_directory(directory: Path):
+    """Create a directory accessible only to this user, or check an existing one. Blocking."""
+    directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+    check_private(directory, directory.stat())
+
+
+def file_etag(path: Path) -> str:
+    """Get a strong ETag for a file based on its contents. Blocking."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return '"{}"'.format(digest.hexdigest())
+
+
+class FileEtags(object):
+    """Caches the ETags of files, until their size or modification time changes
+
+    Hashing large files is slow, so it happens in an executor, and requests
+    for a file which is already being hashed wait for that hash rather than
+    starting another (as when many clients download a newly installed mod at
+    once). Whenever a file is hashed, the ETags of files which ``keep()`` no
+    longer returns are forgotten.
+    """
+
+    def __init__(self, keep):
+        self.keep = keep
+        self._etags = {}  # path -> ((size, mtime), future ETag)
+
+    async def get(self, path: Path) -> str:
+        loop = asyncio.get_event_loop()
+        st = await loop.run_in_executor(None, path.stat)
+        version = (st.st_size, st.st_mtime_ns)
+        cached = self._etags.get(path)
+        if cached is None or cached[0] != version:
+            keep = self.keep()
+            for other in [other for other in self._etags if other not in keep]:
+                del self._etags[other]
+            cached = self._etags[path] = (version, loop.run_in_executor(None, file_etag, path))
+            cached[1].add_done_callback(partial(self._hashed, path, cached))
+        # Shielded, so that one client giving up doesn't cancel the others' hash
+        return await asyncio.shield(cached[1])
+
+    def _hashed(self, path: Path, cached, future):
+        # Failures are not cached, so the next request tries again
+        if (future.cancelled() or future.exception()) and self._etags.get(path) is cached:
+            del self._etags[path]
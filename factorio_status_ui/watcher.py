@@ -0,0 +1,179 @@
+"""Watching the mods directory for changes
+
+On Linux the directory is watched with inotify (via ctypes, so no extra
+dependencies are needed), otherwise it is polled. Either way, changes are
+detected by comparing file sizes & modification times, and only files which
+have changed are read.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+MOD_JSON_FILES = ('mod-list.json', 'mod-settings.json')
+
+
+class Inotify(object):
+    """Minimal wrapper around the Linux inotify API, watching a single directory"""
+
+    def __init__(self, directory: Path, mask: int = WATCH_MASK):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        if libc.inotify_add_watch(self.fd, str(directory).encode('utf8'), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed for {}'.format(directory))
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """Discard all pending events. We only care that something happened."""
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+async def watch_directory(directory: Path, mode='auto', interval=1, rescan_interval=60, debounce=0.5):
+    """Yield once at the start, and then whenever the directory may have changed
+
+    In inotify mode, bursts of changes (e.g. a mod sync writing many files)
+    are collapsed into one by waiting until the directory has been quiet for
+    ``debounce`` seconds. A full rescan still happens every ``rescan_interval``
+    seconds, as inotify misses changes made by other hosts on network filesystems.
+    """
+    inotify = None
+    if mode != 'poll':
+        try:
+            inotify = Inotify(directory)
+        except OSError as e:
+            if mode == 'inotify':
+                raise
+            logger.info('Cannot watch {} with inotify ({}), polling instead'.format(directory, e))
+
+    if inotify is None:
+        while True:
+            yield
+            await asyncio.sleep(interval)
+
+    loop = asyncio.get_event_loop()
+    changed = asyncio.Event()
+
+    def on_readable():
+        inotify.read_events()
+        changed.set()
+
+    loop.add_reader(inotify.fileno(), on_readable)
+    try:
+        while True:
+            yield
+            try:
+                await asyncio.wait_for(changed.wait(), rescan_interval)
+            except asyncio.TimeoutError:
+                continue
+
+            while changed.is_set():
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), debounce)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        loop.remove_reader(inotify.fileno())
+        inotify.close()
+
+
+class ModDirectoryScanner(object):
+    """Detects changes to the mods directory using only directory listings & stats"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._stats = {}
+        self._json = {}
+        self._scanned = False
+        self._problem = None
+
+    def scan(self):
+        """Get (mod list, mod settings, zip files) if anything has changed, otherwise None
+
+        Until mod-list.json can be read (e.g. the directory does not exist yet,
+        or a mod sync is half way through writing the file) this also returns
+        None, so the current mods are kept, and the next scan tries again.
+
+        This is blocking, so run it in an executor.
+        """
+        stats = {}
+        try:
+            with os.scandir(str(self.directory)) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.zip') or entry.name in MOD_JSON_FILES:
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            # Deleted since the listing, so treat it as removed
+                            continue
+                        stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            # Treat a missing directory (e.g. not yet created by the server) as empty
+            pass
+
+        if self._scanned and stats == self._stats:
+            return None
+
+        try:
+            mod_list = self._read_json('mod-list.json', stats)['mods']
+            if not isinstance(mod_list, list):
+                raise ValueError('"mods" is not a list')
+            mod_settings = self._read_json('mod-settings.json', stats, default={})
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            problem = '{}: {}'.format(type(e).__name__, e)
+            if problem != self._problem:
+                logger.warning('Cannot read the mod list in {} ({}), keeping the current mods until it '
+                               'can be read'.format(self.directory, problem))
+            self._problem = problem
+            # Leave the previous stats, so that the next scan tries again
+            return None
+
+        if self._problem:
+            logger.info('The mod list in {} can be read again'.format(self.directory))
+            self._problem = None
+        self._stats = stats
+        self._scanned = True
+        files = sorted(self.directory / name for name in stats if name.endswith('.zip'))
+        return mod_list, mod_settings, files
+
+    def _read_json(self, name, stats, default=None):
+        """Parse one of the JSON files, only reading it again if it has changed"""
+        if name not in stats:
+            if default is None:
+                raise FileNotFoundError('{} does not exist'.format(self.directory / name))
+            return default
+        if name not in self._json or stats[name] != self._stats.get(name):
+            with open(self.directory / name) as f:
+                self._json[name] = json.load(f)
+        return self._json[name]
@@ -1,176 +1,1064 @@
 import asyncio
+import gzip
+import hashlib
+import json
 import logging
+import math
+import time
+from functools import partial
 from pathlib import Path
+from urllib.parse import quote
 
 import aiohttp
 import aiohttp_jinja2
-import async_timeout
 import jinja2
 from aiohttp import web
 
-from factorio_status_ui import handlers
-from factorio_status_ui.rcon import RconConnection
-from factorio_status_ui.state import server, mod_database, application_config
-from factorio_status_ui.utils import handle_aio_exceptions
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+from factorio_status_ui import admin, assets, events, handlers, metrics, mod_archive, mod_info, mod_portal, saves, snapshot
+from factorio_status_ui.history import HistoryStore
+from factorio_status_ui.rcon import RconPool, RconError, RconBusyError, PRIORITY_ADMIN
+from factorio_status_ui.scheduler import Scheduler
+from factorio_status_ui.state import Server, servers, application_config, get_mod_data
+from factorio_status_ui.utils import handle_aio_exceptions, FileEtags
+from factorio_status_ui.watcher import ModDirectoryScanner, watch_directory
 
 ROOT_DIR = Path(__file__).parent.parent
+# Requests to the polling process's Unix socket still need a host
+CONTROL_URL = 'http://poller'
+# Pages are compressed on the event loop whenever state changes. Brotli's default (and
+# maximum) quality takes far too long on large pages, while 5 still beats gzip.
+PAGE_BROTLI_QUALITY = 5
+# Seconds after which to retry an all mods download refused as too many are being streamed
+ARCHIVE_STREAMS_RETRY_AFTER = 30
 
 logger = logging.getLogger(__name__)
 
 
-class IndexView(web.View):
+def choose_encoding(request, bodies: dict):
+    """The best of the encodings we have which the client accepts, or None for no encoding"""
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    for encoding in ('br', 'gzip'):
+        if encoding in accept_encoding and encoding in bodies:
+            return encoding
+    return None
+
+
+class CachedPage(object):
+    """A rendered page, precompressed with each encoding we can serve"""
+
+    def __init__(self, state_version: int, body: bytes):
+        self.state_version = state_version
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.bodies = {'gzip': gzip.compress(body), None: body}
+        if brotli:
+            self.bodies['br'] = brotli.compress(body, quality=PAGE_BROTLI_QUALITY)
+
+    def response(self, request):
+        headers = {
+            'ETag': self.etag,
+            'Vary': 'Accept-Encoding',
+            # Allow caching, but always revalidate as state changes frequently
+            'Cache-Control': 'no-cache',
+        }
+        if self.etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+
+        encoding = choose_encoding(request, self.bodies)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=self.bodies[encoding], content_type='text/html', charset='utf-8', headers=headers)
+
+
+def is_multi_server() -> bool:
+    return bool(application_config.servers_file)
+
+
+def server_path(server: Server) -> str:
+    """The path under which a server's pages are served"""
+    return '/servers/{}'.format(server.slug) if is_multi_server() else ''
+
+
+class ServerView(web.View):
+    """A view of a single server, given by the URL in multi-server mode"""
+
+    @property
+    def server(self) -> Server:
+        if not is_multi_server():
+            return servers['default']
+        try:
+            return servers[self.request.match_info['server']]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+    def viewed(self):
+        scheduler = self.request.app['schedulers'].get(self.server.slug)
+        if scheduler:
+            scheduler.viewed()
+
+
+class IndexView(ServerView):
+    """Render a server's status page, re-rendering only when its state has changed"""
+
     async def get(self):
-        return aiohttp_jinja2.render_template(
-            'index.jinja2',
-            self.request,
-            {
-                'server': server,
-                'application_config': application_config,
-                'get_mod_data': lambda name: (
-                    mod_database.get(name, None) or
-                    mod_database.get(name.replace(' ', '_'), None) or
-                    mod_database.get(name.replace('_', ' '), None) or
-                    {}),
-                'version': self.request.app['version'],
-            }
-        )
+        server = self.server
+        self.viewed()
+        page = self.request.app['index_pages'].get(server.slug)
+        if page is None or page.state_version != server.state_version:
+            page = self.request.app['index_pages'][server.slug] = self.render(server)
+        return page.response(self.request)
+
+    def render(self, server: Server):
+        state_version = server.state_version
+        with metrics.PAGE_RENDER_DURATION.time():
+            html = aiohttp_jinja2.render_string(
+                'index.jinja2',
+                self.request,
+                {
+                    'server': server,
+                    'application_config': server.settings,
+                    'base_path': server_path(server),
+                    'overview': is_multi_server(),
+                    'get_mod_data': get_mod_data,
+                    'version': self.request.app['version'],
+                }
+            )
+        return CachedPage(state_version, html.encode('utf8'))
+
+
+class OverviewView(web.View):
+    """Summarise every server, in multi-server mode"""
+
+    async def get(self):
+        state_version = tuple(server.state_version for server in servers.values())
+        page = self.request.app['index_pages'].get(None)
+        if page is None or page.state_version != state_version:
+            with metrics.PAGE_RENDER_DURATION.time():
+                html = aiohttp_jinja2.render_string(
+                    'overview.jinja2',
+                    self.request,
+                    {
+                        'servers': servers.values(),
+                        'server_path': server_path,
+                        'application_config': application_config,
+                        'version': self.request.app['version'],
+                    }
+                )
+            page = self.request.app['index_pages'][None] = CachedPage(state_version, html.encode('utf8'))
+        return page.response(self.request)
+
+
+def sources_dict(server: Server) -> dict:
+    return {name: status.as_dict() for name, status in server.sources.items()}
 
 
-class ModDownloadView(web.View):
+def all_warm() -> bool:
+    return all(status.is_warm for server in servers.values() for status in server.sources.values())
+
+
+def source_refreshed(server: Server, source: str, success=True):
+    """Record an attempt to refresh one of a server's sources of state"""
+    status = server.sources[source]
+    was_stale, was_warm = status.is_stale, status.is_warm
+    status.attempted = True
+    if success:
+        status.updated = time.time()
+    if (status.is_stale, status.is_warm) != (was_stale, was_warm):
+        server.state_version += 1
+        events.publish(server.slug, 'sources', sources_dict(server))
+
+
+async def warmed_up(timeout=30, interval=0.5):
+    """Wait until every source of every server has been tried once, or the timeout passes
+
+    Used to hold back slow network fetches, so that they do not compete with
+    the servers' own state on startup.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not all_warm() and loop.time() < deadline:
+        await asyncio.sleep(interval)
+
+
+def api_documents(server: Server):
+    """Build the documents served by the JSON API"""
+    return {
+        'status': {
+            'slug': server.slug,
+            'server_name': server.settings.server_name,
+            'server_host': server.settings.server_host,
+            'server_port': server.settings.server_port,
+            'rcon': server.rcon_health.as_dict(),
+            'config': server.config.as_dict(),
+            'players_online': len(server.players.online),
+            'players_known': len(server.players),
+            'mods_enabled': sum(1 for mod in server.mods if mod.enabled),
+            'mods_with_problems': sum(1 for mod in server.mods if mod.problems),
+            'unused_mod_files': [file.name for file in server.unused_mod_files],
+            'sources': sources_dict(server),
+            'state_version': server.state_version,
+        },
+        'players': [player.as_dict() for player in server.players],
+        'mods': [mod.as_dict() for mod in server.mods],
+        'saves': [save.as_dict() for save in server.saves],
+    }
+
+
+class ApiSnapshot(object):
+    """A server's API documents at a given state version, each encoded (and hashed) only once"""
+
+    def __init__(self, server: Server):
+        self.state_version = server.state_version
+        self.documents = api_documents(server)
+        self._encoded = {}
+
+    def encoded(self, name: str, format: str) -> tuple:
+        """Get (body, ETag) for a document in the given format"""
+        key = (name, format)
+        if key not in self._encoded:
+            if format == 'msgpack':
+                body = msgpack.packb(self.documents[name], use_bin_type=True)
+            else:
+                body = json.dumps(self.documents[name]).encode('utf8')
+            self._encoded[key] = body, '"{}-{}"'.format(hashlib.sha1(body).hexdigest(), format)
+        return self._encoded[key]
+
+
+class ApiView(ServerView):
+    """Serve one of the API's documents as JSON, or as msgpack if requested & available"""
+    document = None
+    content_types = {
+        'json': 'application/json',
+        'msgpack': 'application/msgpack',
+    }
+
     async def get(self):
+        server = self.server
+        snapshot = self.request.app['api_snapshots'].get(server.slug)
+        if snapshot is None or snapshot.state_version != server.state_version:
+            snapshot = self.request.app['api_snapshots'][server.slug] = ApiSnapshot(server)
+
+        format = 'json'
+        if msgpack and (self.request.query.get('format') == 'msgpack' or
+                        'msgpack' in self.request.headers.get('Accept', '')):
+            format = 'msgpack'
+
+        body, etag = snapshot.encoded(self.document, format)
+        headers = {
+            'ETag': etag,
+            'Vary': 'Accept',
+            'Cache-Control': 'no-cache',
+        }
+        if headers['ETag'] in self.request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=self.content_types[format], headers=headers)
+
+
+class ApiStatusView(ApiView):
+    document = 'status'
+
+
+class ApiPlayersView(ApiView):
+    document = 'players'
+
+
+class ApiModsView(ApiView):
+    document = 'mods'
+
+
+class ApiSavesView(ApiView):
+    document = 'saves'
+
+
+class HistoryView(ServerView):
+    """Serve part of a server's recorded history as JSON"""
+
+    async def get(self):
+        history = self.server.history
+        if history is None:
+            raise web.HTTPNotFound()
+        try:
+            data = self.query(history, self.request.query)
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest()
+        return web.json_response(data, headers={'Cache-Control': 'no-cache'})
+
+    def query(self, history: HistoryStore, query):
+        raise NotImplementedError()
+
+
+class HistoryOnlineView(HistoryView):
+    """Players online per minute, hour or day"""
+
+    def query(self, history, query):
+        return history.series(query.get('resolution', 'hour'), int(query.get('limit', 48)))
+
+
+class HistoryPeakHoursView(HistoryView):
+    def query(self, history, query):
+        return history.peak_hours(int(query.get('days', 7)))
+
+
+class HistoryPlaytimeView(HistoryView):
+    def query(self, history, query):
+        return history.player_playtime(int(query.get('limit', 10)))
+
+
+class HistoryEventsView(HistoryView):
+    def query(self, history, query):
+        return history.recent_events(int(query.get('limit', 100)))
+
+
+class EventsView(ServerView):
+    """Stream a server's state changes to the browser as server-sent events
+
+    A snapshot of the current state is sent first, so that a client which
+    reconnects after missing some events is brought back up to date.
+    """
+    keepalive_interval = 15
+
+    async def get(self):
+        server = self.server
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            # Stop nginx from buffering the stream
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(self.request)
+        self.viewed()
+
+        with events.Subscription(server.slug) as subscription:
+            await response.write(b''.join([
+                events.encode_event('status', server.rcon_health.as_dict()),
+                events.encode_event('players', [player.as_dict() for player in server.players]),
+                events.encode_event('config', server.config.as_dict()),
+                events.encode_event('mods', [mod.as_dict() for mod in server.mods]),
+                events.encode_event('saves', [save.as_dict() for save in server.saves]),
+                events.encode_event('sources', sources_dict(server)),
+            ]))
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), self.keepalive_interval)
+                except asyncio.TimeoutError:
+                    message = b': keepalive\n\n'
+
+                if message is None:
+                    logger.debug('Events client fell too far behind, disconnecting')
+                    break
+                try:
+                    await response.write(message)
+                except (ConnectionError, RuntimeError):
+                    # Client went away
+                    break
+
+        return response
+
+
+class MetricsView(web.View):
+    async def get(self):
+        return web.Response(body=metrics.render().encode('utf8'), headers={
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+            'Cache-Control': 'no-cache',
+        })
+
+
+class AssetView(web.View):
+    """Serve the built CSS & JavaScript bundles, and the files they refer to
+
+    Their names include a hash of their content, so they can be cached forever.
+    """
+
+    async def get(self):
+        asset = self.request.app['assets'].files.get(self.request.match_info['name'])
+        if asset is None:
+            return web.HTTPNotFound()
+        headers = {
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': 'public, max-age=31536000, immutable',
+        }
+        encoding = choose_encoding(self.request, asset.bodies)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=asset.bodies[encoding], content_type=asset.content_type, charset=asset.charset,
+                            headers=headers)
+
+
+class HealthView(web.View):
+    """Liveness: the event loop is responding and the background tasks are still running"""
+
+    async def get(self):
+        tasks = self.request.app.get('tasks')
+        alive = tasks is not None and not tasks.done()
+        return web.json_response({'alive': alive}, status=200 if alive else 503,
+                                 headers={'Cache-Control': 'no-cache'})
+
+
+class ReadyView(web.View):
+    """Readiness: every server has state worth serving
+
+    That is, each source of state has been restored from disk or tried once
+    since starting (so an unreachable server does not hold up readiness).
+    Reports the freshness of every source either way.
+    """
+
+    async def get(self):
+        reader = self.request.app.get('snapshot_reader')
+        ready = all_warm() and (reader is None or reader.version is not None)
+        return web.json_response({
+            'ready': ready,
+            'servers': {slug: sources_dict(server) for slug, server in servers.items()},
+        }, status=200 if ready else 503, headers={'Cache-Control': 'no-cache'})
+
+
+class ControlProxyView(web.View):
+    """Forward a request to the polling process, in a worker
+
+    Used for what only the polling process has, i.e. the history store, RCON
+    metrics & the RCON connections used by the admin console.
+    """
+
+    # Passed through in each direction, as they matter to the admin console
+    request_headers = ('Authorization', 'Content-Type')
+    response_headers = ('Retry-After', 'WWW-Authenticate')
+
+    async def get(self):
+        return await self.forward()
+
+    async def post(self):
+        return await self.forward(await self.request.read())
+
+    async def forward(self, body=None):
+        session = self.request.app['control_session']
+        headers = {name: self.request.headers[name] for name in self.request_headers if name in self.request.headers}
+        try:
+            async with session.request(self.request.method, CONTROL_URL + self.request.path_qs,
+                                       data=body, headers=headers) as response:
+                headers = {name: response.headers[name] for name in self.response_headers if name in response.headers}
+                headers['Content-Type'] = response.headers.get('Content-Type', 'application/octet-stream')
+                headers['Cache-Control'] = 'no-cache'
+                return web.Response(body=await response.read(), status=response.status, headers=headers)
+        except (aiohttp.ClientError, OSError) as e:
+            logger.warning('Could not reach the polling process: {}'.format(e))
+            raise web.HTTPServiceUnavailable()
+
+
+class AdminCommandView(ServerView):
+    """Run an RCON command for an admin, ahead of the background polls
+
+    Takes a JSON object with the "command" (or chat message) to run, and
+    returns the server's response and how long it took, in seconds.
+    """
+
+    def error(self, result: str, message: str, status: int, headers=None):
+        metrics.ADMIN_COMMANDS.inc(server=self.server.slug, result=result)
+        return web.json_response({'error': message}, status=status, headers=headers)
+
+    async def post(self):
+        server = self.server
+        console = self.request.app['admin_console']
+        user = console.authenticate(self.request.headers.get('Authorization', ''))
+        if user is None:
+            return self.error('unauthorized', 'A valid admin token is required', 401,
+                              headers={'WWW-Authenticate': 'Bearer'})
+        retry_after = console.limiter.check(user)
+        if retry_after:
+            return self.error('rate_limited', 'Too many commands, try again shortly', 429,
+                              headers={'Retry-After': str(math.ceil(retry_after))})
+        try:
+            command = (await self.request.json())['command'].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            command = None
+        if not command:
+            return self.error('invalid', 'Expected a JSON object with a "command"', 400)
+
+        logger.info('Admin {} running on server {}: {}'.format(user, server.slug, command))
+        start = time.perf_counter()
+        try:
+            response = await self.request.app['rcon'][server.slug].run_command(command, priority=PRIORITY_ADMIN)
+        except RconBusyError as e:
+            return self.error('busy', str(e), 503, headers={'Retry-After': '1'})
+        except RconError as e:
+            return self.error('failed', str(e), 502)
+
+        metrics.ADMIN_COMMANDS.inc(server=server.slug, result='ok')
+        return web.json_response({
+            'response': response.decode('utf8', 'replace'),
+            'seconds': time.perf_counter() - start,
+        }, headers={'Cache-Control': 'no-cache'})
+
+
+class WorkerViewersView(web.View):
+    """Receive a worker's report of its viewers, in the polling process"""
+
+    async def post(self):
+        data = await self.request.json()
+        self.request.app['worker_viewers'].report(int(self.request.match_info['pid']), data['viewers'])
+        for slug in data['viewed']:
+            scheduler = self.request.app['schedulers'].get(slug)
+            if scheduler:
+                scheduler.viewed()
+        return web.Response(status=204)
+
+
+class WholeFileResponse(web.FileResponse):
+    """Sends the whole file, whatever range was requested"""
+
+    async def prepare(self, request):
+        headers = request.headers.copy()
+        headers.popall('Range', None)
+        return await super().prepare(request.clone(headers=headers))
+
+
+def download_response(request, file: Path, etag: str, accel_redirect: str = None):
+    """Serve a zip file as an attachment, supporting revalidation & resumed downloads (via Range & If-Range)"""
+    headers = {
+        'ETag': etag,
+        'Content-Disposition': 'attachment; filename="{}"'.format(file.name),
+    }
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+
+    if accel_redirect:
+        headers['X-Accel-Redirect'] = '{}/{}'.format(accel_redirect.rstrip('/'), quote(file.name))
+        return web.Response(content_type='application/zip', headers=headers)
+
+    if_range = request.headers.get('If-Range', '')
+    if 'Range' in request.headers and if_range.startswith(('"', 'W/')) and if_range != etag:
+        # The client's partial copy is out of date, so it needs the whole file.
+        # FileResponse only understands If-Range dates, so it is told to ignore the Range.
+        return WholeFileResponse(file, headers=headers)
+
+    return web.FileResponse(file, headers=headers)
+
+
+class ModDownloadView(ServerView):
+    """Serve a single mod file
+
+    Mod files are identified by a hash of their content, so clients can
+    revalidate them or resume interrupted downloads.
+    """
+
+    async def get(self):
+        server = self.server
+        mod = server.mods_by_file_name.get(self.request.match_info['file_name'])
+        if mod is None:
+            return web.HTTPNotFound()
+
+        try:
+            etag = await self.request.app['file_etags'].get(mod.file)
+        except OSError:
+            return web.HTTPNotFound()
+        return download_response(self.request, mod.file, etag, server.settings.mods_accel_redirect)
+
+
+class SaveDownloadView(ServerView):
+    """Serve a single save file, or the latest one
+
+    Saves are too big to hash, and are rewritten in full by every save, so
+    they are identified by their size & modification time.
+    """
+
+    async def get(self):
+        server = self.server
         file_name = self.request.match_info['file_name']
-        for mod in server.mods:
-            if mod.file and mod.file.name == file_name:
-                return web.FileResponse(mod.file)
-        return web.HTTPNotFound()
+        if file_name == 'latest' and server.saves:
+            latest = server.saves[0].file.name
+            raise web.HTTPFound('{}/saves/download/{}'.format(server_path(server), quote(latest)))
 
+        save = server.saves_by_file_name.get(file_name)
+        try:
+            stat = save.file.stat()
+        except (AttributeError, OSError):
+            return web.HTTPNotFound()
+        # The same form as aiohttp's own file ETags
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        return download_response(self.request, save.file, etag)
 
-class ModDownloadAllView(web.View):
+
+class ModDownloadAllView(ServerView):
     async def get(self):
-        if server.all_mods_file:
+        server = self.server
+        if server.settings.stream_all_mods:
+            return await self.stream(server)
+        elif server.all_mods_file:
             return web.FileResponse(server.all_mods_file, headers={
                 'Content-Disposition': 'attachment; filename="{}"'.format(server.all_mods_file.name)
             })
         else:
             return web.HTTPServiceUnavailable(reason='File still being generated')
 
+    async def stream(self, server: Server):
+        entries = mod_archive.archive_entries(server.mods, server.settings.mods_directory)
+        stream = mod_archive.ArchiveStream(asyncio.get_event_loop())
+        try:
+            stream.start(entries, self.request.app['archive_streams'])
+        except mod_archive.StreamsBusyError as e:
+            logger.warning('Refusing all mods download: {}'.format(e))
+            return web.HTTPServiceUnavailable(reason='Too many downloads in progress',
+                                              headers={'Retry-After': str(ARCHIVE_STREAMS_RETRY_AFTER)})
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'application/zip',
+            'Content-Disposition': 'attachment; filename="all-mods.zip"',
+        })
+        try:
+            await response.prepare(self.request)
+            async for chunk in stream.chunks():
+                await response.write(chunk)
+        except ConnectionResetError:
+            logger.debug('All mods download cancelled by client')
+            return response
+        finally:
+            await stream.close()
+        await response.write_eof()
+        return response
+
+
+def server_prefix() -> str:
+    """The route prefix of each server's pages"""
+    return '/servers/{server}' if is_multi_server() else ''
+
+
+def add_history_routes(app, view=None):
+    """Add the history API, served by the given view rather than the history store if given"""
+    prefix = server_prefix()
+    app.router.add_get(prefix + '/api/history/online', view or HistoryOnlineView)
+    app.router.add_get(prefix + '/api/history/peak-hours', view or HistoryPeakHoursView)
+    app.router.add_get(prefix + '/api/history/playtime', view or HistoryPlaytimeView)
+    app.router.add_get(prefix + '/api/history/events', view or HistoryEventsView)
+
+
+def add_admin_routes(app, view=None):
+    """Add the admin console if enabled, served by the given view rather than over RCON if given"""
+    if not application_config.admin_tokens_file:
+        return
+    if view is None:
+        app['admin_console'] = admin.AdminConsole(application_config.admin_tokens_file,
+                                                  application_config.admin_rate_limit,
+                                                  application_config.admin_rate_burst)
+    app.router.add_post(server_prefix() + '/api/admin/command', view or AdminCommandView)
+
+
+def installed_mod_files() -> set:
+    return {mod.file for server in servers.values() for mod in server.mods if mod.file}
+
 
-def setup_routes(app):
-    app.router.add_static('/static', ROOT_DIR / 'static', append_version=True)
-    app.router.add_static('/lib', ROOT_DIR / 'node_modules', append_version=True)
-    app.router.add_get('/', IndexView)
-    app.router.add_get('/mods/download/all', ModDownloadAllView)
-    app.router.add_get('/mods/download/{file_name}', ModDownloadView)
+def setup_routes(app, worker=False):
+    """Add the public routes. Workers forward what they cannot serve from the snapshot to the polling process."""
+    # Rendered pages & snapshots, by server slug
+    app['index_pages'] = {}
+    app['api_snapshots'] = {}
+    app['schedulers'] = {}
+    app['archive_streams'] = mod_archive.StreamExecutor(application_config.all_mods_max_streams)
+    app['file_etags'] = FileEtags(installed_mod_files)
+    app.on_cleanup.append(stop_archive_streams)
+
+    app.router.add_get('/assets/{name}', AssetView)
+    app.router.add_get('/metrics', ControlProxyView if worker else MetricsView)
+    app.router.add_get('/healthz', HealthView)
+    app.router.add_get('/readyz', ReadyView)
+    add_history_routes(app, ControlProxyView if worker else None)
+    add_admin_routes(app, ControlProxyView if worker else None)
+
+    prefix = server_prefix()
+    if is_multi_server():
+        app.router.add_get('/', OverviewView)
+        app.router.add_get(prefix, IndexView)
+    app.router.add_get(prefix + '/', IndexView)
+    app.router.add_get(prefix + '/events', EventsView)
+    app.router.add_get(prefix + '/api/status', ApiStatusView)
+    app.router.add_get(prefix + '/api/players', ApiPlayersView)
+    app.router.add_get(prefix + '/api/mods', ApiModsView)
+    app.router.add_get(prefix + '/api/saves', ApiSavesView)
+    app.router.add_get(prefix + '/mods/download/all', ModDownloadAllView)
+    app.router.add_get(prefix + '/mods/download/{file_name}', ModDownloadView)
+    app.router.add_get(prefix + '/saves/download/{file_name}', SaveDownloadView)
+
+
+async def stop_archive_streams(app):
+    app['archive_streams'].shutdown()
+
+
+def setup_control_routes(app):
+    """Add the routes of the polling process's Unix socket, used by the workers"""
+    app['schedulers'] = {}
+    app['worker_viewers'] = snapshot.WorkerViewers()
+    app.router.add_get('/metrics', MetricsView)
+    add_history_routes(app)
+    add_admin_routes(app)
+    app.router.add_post('/workers/{pid}/viewers', WorkerViewersView)
 
 
 def setup_templates(app):
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(str(ROOT_DIR / 'templates')), autoescape=True)
+    """Set up the templates, and the assets which they use"""
+    if assets.ensure_built():
+        app['assets'] = assets.Assets()
+    else:
+        app['assets'] = assets.UnbundledAssets()
+        app.router.add_static('/static', ROOT_DIR / 'static')
+        if (ROOT_DIR / 'node_modules').is_dir():
+            app.router.add_static('/lib', ROOT_DIR / 'node_modules')
+    environment = aiohttp_jinja2.setup(
+        app, loader=jinja2.FileSystemLoader(str(ROOT_DIR / 'templates')), autoescape=True
+    )
+    environment.globals['asset_urls'] = app['assets'].urls
+
+
+async def poll_local_mods(server: Server, handler, interval=1):
+    logger.info('Setting up monitor: Local mods (via filesystem) for server {}'.format(server.slug))
+    loop = asyncio.get_event_loop()
+    scanner = ModDirectoryScanner(server.settings.mods_directory)
+    info_cache = mod_info.ModInfoCache()
+    changes = watch_directory(server.settings.mods_directory, mode=server.settings.mods_watcher,
+                              interval=interval)
+    try:
+        async for _ in changes:
+            value = await loop.run_in_executor(None, scanner.scan)
+            if value is not None:
+                mod_data, mod_settings, files = value
+                handler(mod_data, mod_settings, await info_cache.read(files))
+            source_refreshed(server, 'mods')
+            metrics.POLL_LAST_SUCCESS.set(time.time(), server=server.slug, source='mods')
+    except asyncio.CancelledError:
+        return
+    finally:
+        await changes.aclose()
+
+
+async def poll_saves(server: Server, handler, interval=5):
+    logger.info('Setting up monitor: Saves (via filesystem) for server {}'.format(server.slug))
+    scanner = saves.SaveDirectoryScanner(server.settings.saves_directory)
+    changes = watch_directory(server.settings.saves_directory, mode=server.settings.mods_watcher,
+                              interval=interval)
+    try:
+        async for _ in changes:
+            value = await scanner.scan()
+            if value is not None:
+                handler(value)
+            source_refreshed(server, 'saves')
+            metrics.POLL_LAST_SUCCESS.set(time.time(), server=server.slug, source='saves')
+    except asyncio.CancelledError:
+        return
+    finally:
+        await changes.aclose()
+
+
+class RconPoller(object):
+    """Runs an RCON command each time it is called, passing changed output to the handler"""
 
+    def __init__(self, rcon, command, handler):
+        self.rcon = rcon
+        self.command = command
+        self.handler = handler
+        self.previous_value = None
 
-async def poll_local_mods(handler, interval=1):
-    logger.info('Setting up monitor: Local mods (via filesystem)')
-    previous_value = None
-    while True:
+    async def __call__(self) -> bool:
+        """Poll, returning whether it succeeded"""
+        if not self.rcon.is_connected:
+            # The pool takes care of reconnecting, just try again next time round
+            return False
         try:
-            try:
-                with open(application_config.mods_directory / 'mod-list.json') as f:
-                    mod_list = f.read()
-            except OSError:
-                mod_list = '{}'
+            value = await self.rcon.run_command(self.command)
+        except RconError as e:
+            logger.warning('RCON command {} failed: {}'.format(self.command.split(' ', 1)[0], e))
+            return False
 
-            try:
-                with open(application_config.mods_directory / 'mod-settings.json') as f:
-                    mod_settings = f.read()
-            except OSError:
-                mod_settings = '{}'
+        if value != self.previous_value:
+            self.previous_value = value
+            self.handle(value)
+        metrics.POLL_LAST_SUCCESS.set(time.time(), server=self.rcon.server.slug,
+                                      source=metrics.command_label(self.command))
+        return True
 
-            value = mod_list, mod_settings, list(application_config.mods_directory.glob('*.zip'))
+    def handle(self, value):
+        self.handler(value)
 
-            if value != previous_value:
-                handler(*value)
-            previous_value = value
-            await asyncio.sleep(interval)
-        except asyncio.CancelledError:
+
+class RconJsonPoller(RconPoller):
+    """Polls a scripted RCON command which prints JSON
+
+    The first scripted command a server receives is answered with a warning
+    that it will disable achievements, and only runs once repeated, so a
+    response which isn't JSON is retried straight away. If the retry does not
+    give JSON either (for example because commands are disabled) it is marked
+    as unsupported, so that the caller can fall back to plain commands.
+    """
+    unsupported = False
+    attempts = 2
+
+    def __init__(self, rcon, command, handler):
+        super().__init__(rcon, command, handler)
+        self.invalid_value = None
+
+    async def __call__(self) -> bool:
+        for _ in range(self.attempts):
+            self.invalid_value = None
+            success = await super().__call__()
+            if not success or self.invalid_value is None:
+                return success
+            logger.info('Scripted RCON command did not return JSON: {}'.format(self.invalid_value[:200]))
+
+        logger.warning('Scripted RCON command did not return JSON after {} attempts, falling back'.format(
+            self.attempts
+        ))
+        self.unsupported = True
+        return False
+
+    def handle(self, value):
+        try:
+            data = json.loads(value.decode('utf8'))
+        except ValueError:
+            self.invalid_value = value
+            # A repeat of the same response still needs checking
+            self.previous_value = None
             return
+        self.handler(data)
 
 
-async def poll_rcon(command, handler, interval=1):
-    """More specific version of monitor_coroutine() for rcon commands"""
-    async with RconConnection() as rcon:
-        previous_value = None
-        while True:
-            try:
-                value = await rcon.run_command(command)
-                if value != previous_value:
-                    handler(value)
-                previous_value = value
-                await asyncio.sleep(interval)
-            except asyncio.CancelledError:
-                return
-
-
-async def poll_config(handler, interval=10):
-    """Execute the config command multiple times in order to get all config options"""
-    logger.info('Setting up monitor: Server config polling (via RCON)')
+# Returns every player along with their online & admin status as a single JSON
+# document, replacing the separate /players and /admins commands.
+# helpers.table_to_json() replaced game.table_to_json() in Factorio 2.0
+PLAYER_LIST_LUA = (
+    '/silent-command '
+    'local players = {} '
+    'for _, p in pairs(game.players) do '
+    'players[#players + 1] = {name = p.name, online = p.connected, admin = p.admin} '
+    'end '
+    'rcon.print((helpers or game).table_to_json({players = players}))'
+)
+
+
+class PlayersPoller(object):
+    """Polls player & admin state, via a single Lua script if enabled"""
+
+    def __init__(self, server: Server, rcon):
+        self.server = server
+        self.rcon = rcon
+        self.lua = RconJsonPoller(rcon, PLAYER_LIST_LUA, partial(handlers.handle_player_list, server))
+        self.players = RconPoller(rcon, '/players', partial(handlers.handle_players, server))
+        self.admins = RconPoller(rcon, '/admins', partial(handlers.handle_admins, server))
+
+    async def __call__(self):
+        if not self.rcon.is_connected:
+            if self.rcon.health.status != 'connecting':
+                # Unreachable, so there is no point waiting for the players to warm up
+                source_refreshed(self.server, 'players', success=False)
+            return
+
+        if self.server.settings.rcon_lua_batching and not self.lua.unsupported:
+            success = await self.lua() and not self.lua.unsupported
+        else:
+            success = all(await asyncio.gather(self.players(), self.admins()))
+        source_refreshed(self.server, 'players', success)
+
+
+class ConfigPoller(object):
+    """Execute the config command multiple times in order to get all config options
+
+    The commands are pipelined over the shared connection, so a full cycle
+    costs a single round trip rather than one per option.
+    """
     options = ['afk-auto-kick', 'allow-commands', 'autosave-interval', 'autosave-only-on-server',
                'ignore-player-limit-for-returning-players', 'max-players', 'max-upload-speed', 'only-admins-can-pause',
                'password', 'require-user-verification', 'visibility-lan', 'visibility-public']
-    async with RconConnection() as rcon:
-        previous_config = None
-        while True:
-            try:
-                server_config = {}
-                for option in options:
-                    server_config[option] = await rcon.run_command('/config get {}'.format(option))
 
-                if server_config != previous_config:
-                    handler(server_config)
-                previous_config = server_config.copy()
-                await asyncio.sleep(interval)
-            except asyncio.CancelledError:
-                return
+    def __init__(self, rcon, handler):
+        self.rcon = rcon
+        self.handler = handler
+        self.previous_config = None
+
+    async def __call__(self):
+        server = self.rcon.server
+        if not self.rcon.is_connected:
+            if self.rcon.health.status != 'connecting':
+                source_refreshed(server, 'config', success=False)
+            return
+
+        values = await asyncio.gather(*[
+            self.rcon.run_command('/config get {}'.format(option)) for option in self.options
+        ], return_exceptions=True)
+        errors = [v for v in values if isinstance(v, Exception)]
+        source_refreshed(server, 'config', success=not errors)
+        if errors:
+            logger.warning('RCON config polling failed: {}'.format(errors[0]))
+            return
+        server_config = dict(zip(self.options, values))
+
+        if server_config != self.previous_config:
+            self.handler(server_config)
+        self.previous_config = server_config
+        metrics.POLL_LAST_SUCCESS.set(time.time(), server=server.slug, source='/config')
 
 
-async def poll_mod_database(handler):
+async def poll_mod_database(handler, interval=60*60*24):
+    """Keep the records of mods installed on any server from the mod portal up to date
+
+    Cached records are used immediately, the cache is refreshed every
+    ``interval`` seconds, and records are reloaded whenever the installed mods change.
+    """
     logger.info('Setting up monitor: Mod database polling')
-    previous_value = None
+    loop = asyncio.get_event_loop()
+    cache = mod_portal.ModPortalCache(application_config.mod_portal_cache)
+    installed_mods_changed = mod_portal.watch_installed_mods()
 
-    async with aiohttp.ClientSession() as session, async_timeout.timeout(60):
-        while True:
-            try:
-                async with session.get('https://mods.factorio.com/api/mods?page_size=100000') as response:
-                    value = await response.json()
+    async def load_installed():
+        # Cleared first, so that changes made while loading trigger another load
+        installed_mods_changed.clear()
+        names = {mod.name for server in servers.values() for mod in server.mods}
+        handler(await loop.run_in_executor(None, cache.load, names))
 
-                if value != previous_value:
-                    handler(value)
-                previous_value = value
-                await asyncio.sleep(60*60*24)
-            except asyncio.CancelledError:
-                return
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        try:
+            # The cached records are used right away, but downloading waits for the servers to warm up
+            await load_installed()
+            await warmed_up()
+            while True:
+                try:
+                    if application_config.mod_portal_file:
+                        updated = await loop.run_in_executor(
+                            None, mod_portal.load_file, cache, application_config.mod_portal_file
+                        )
+                    else:
+                        updated = await mod_portal.download(cache, session, application_config.mod_portal_url)
+                    if updated:
+                        await load_installed()
+                    metrics.POLL_LAST_SUCCESS.set(time.time(), server='', source='mod_portal')
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+                    logger.warning('Failed to refresh mod database: {}'.format(e))
+
+                deadline = loop.time() + interval
+                while loop.time() < deadline:
+                    try:
+                        await asyncio.wait_for(installed_mods_changed.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    await load_installed()
+        except asyncio.CancelledError:
+            return
 
 
 async def determine_ip(handler):
+    if all(server.settings.server_host for server in servers.values()):
+        return
+    await warmed_up()
     logger.info('Determining server public IP address')
-    with async_timeout.timeout(10):
-        async with aiohttp.ClientSession() as session:
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
             async with session.get('https://api.ipify.org?format=json') as response:
-                handler((await response.json())['ip'])
+                ip = (await response.json())['ip']
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+        logger.warning('Failed to determine server public IP address: {}'.format(e))
+        return
+    for server in servers.values():
+        handler(server, ip)
+
+
+async def tick_history(history: HistoryStore):
+    history.tick()
 
 
 async def start_background_tasks(app):
+    """Restore the last known state, then start polling
+
+    The servers' own state is fetched first. The mod portal & public IP
+    lookups are held back until every server has warmed up.
+    """
+    directory = application_config.snapshot_directory
+    try:
+        data = await asyncio.get_event_loop().run_in_executor(
+            None, snapshot.read_snapshot, directory / snapshot.SNAPSHOT_FILE
+        )
+    except FileNotFoundError:
+        pass
+    except snapshot.SNAPSHOT_READ_ERRORS + (KeyError,) as e:
+        logger.warning('Could not restore the last known state: {}'.format(e))
+    else:
+        version, data = data
+        snapshot.restore(data)
+        logger.info('Restored the last known state, saved {:.0f}s ago'.format(time.time() - data['saved_at']))
+
+    # The mod portal is shared by all servers
     coroutines = [
-        poll_rcon('/players', handlers.handle_players),
-        poll_rcon('/admins', handlers.handle_admins),
-        poll_local_mods(handlers.handle_mods),
-        poll_config(handlers.handle_config),
         determine_ip(handlers.handle_ip),
-        poll_mod_database(handlers.handle_mod_database),
+        poll_mod_database(handlers.handle_mod_database, application_config.poll_mod_portal_interval),
     ]
+    app['rcon'] = {}
+
+    for server in servers.values():
+        rcon = app['rcon'][server.slug] = RconPool(server)
+
+        # The mods directory is watched by its own loop, as it is driven by
+        # filesystem events rather than by viewers
+        settings = server.settings
+        scheduler = app['schedulers'][server.slug] = Scheduler(idle_factor=settings.poll_idle_factor)
+        if 'worker_viewers' in app:
+            # The viewers are connected to the workers
+            scheduler.viewers = partial(app['worker_viewers'].count, server.slug)
+        else:
+            scheduler.viewers = partial(events.subscriber_count, server.slug)
+        scheduler.add('players', PlayersPoller(server, rcon), settings.poll_players_interval)
+        scheduler.add('config', ConfigPoller(rcon, partial(handlers.handle_config, server)),
+                      settings.poll_config_interval)
+        if settings.history_directory:
+            try:
+                server.history = HistoryStore(settings.history_directory / server.slug, settings.history_max_events)
+            except OSError as e:
+                logger.error('Not recording history for server {}: {}'.format(server.slug, e))
+        if server.history:
+            scheduler.add('history', partial(tick_history, server.history), 60, adaptive=False)
+
+        coroutines.extend([
+            rcon.run(),
+            scheduler.run(),
+            poll_local_mods(server, partial(handlers.handle_mods, server), settings.poll_mods_interval),
+        ])
+        if settings.saves_directory:
+            coroutines.append(poll_saves(server, partial(handlers.handle_saves, server), settings.poll_saves_interval))
+
+    # Workers need changes straight away, otherwise the snapshot is just for restarts
+    coroutines.append(snapshot.SnapshotWriter(directory, interval=0.1 if application_config.workers else 5).run())
 
     app['tasks'] = asyncio.gather(
-        *map(handle_aio_exceptions, coroutines),
-        loop=app.loop
+        *map(handle_aio_exceptions, coroutines)
+    )
+
+
+async def start_worker_tasks(app):
+    """Keep a worker's state up to date from the polling process's snapshots"""
+    directory = application_config.snapshot_directory
+    session = app['control_session'] = aiohttp.ClientSession(
+        connector=aiohttp.UnixConnector(path=str(directory / snapshot.CONTROL_SOCKET))
     )
+    reporter = snapshot.ViewerReporter(session, CONTROL_URL)
+    for slug in servers:
+        app['schedulers'][slug] = reporter.scheduler(slug)
+    reader = app['snapshot_reader'] = snapshot.SnapshotReader(directory)
+
+    app['tasks'] = asyncio.gather(
+        handle_aio_exceptions(reader.run()),
+        handle_aio_exceptions(reporter.run())
+    )
+
+
+async def cleanup_worker_tasks(app):
+    app['tasks'].cancel()
+    try:
+        await app['tasks']
+    except asyncio.CancelledError:
+        pass
+    await app['control_session'].close()
 
 
 async def get_version(app):
@@ -180,4 +1068,11 @@ async def get_version(app):
 
 async def cleanup_background_tasks(app):
     app['tasks'].cancel()
-    await app['tasks']
+    try:
+        await app['tasks']
+    except asyncio.CancelledError:
+        pass
+    for server in servers.values():
+        if server.history:
+            server.history.close()
+            server.history = None
@@ -19,6 +19,13 @@ setup(
         'aiohttp==3.6.2',
         'aiohttp_jinja2==1.2.0',
     ],
+    extras_require={
+        # Serve brotli-compressed pages to browsers which support it
+        'brotli': ['brotli'],
+        # Serve the JSON API as msgpack to clients which ask for it
+        'msgpack': ['msgpack'],
+        'test': ['pytest'],
+    },
     # Ensure we include files from the manifest
     include_package_data=True,
     entry_points={
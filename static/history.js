@@ -0,0 +1,31 @@
+/* Draws the activity box from the /api/history endpoints */
+$(function () {
+    if (!$('#peak-hours').length) {
+        return;
+    }
+
+    var basePath = $('body').data('base-path') || '';
+
+    $.getJSON(basePath + '/api/history/peak-hours', {days: 7}, function (hours) {
+        var context = document.getElementById('peak-hours').getContext('2d');
+        new Chart(context).Bar({
+            labels: $.map(hours, function (hour) { return hour.hour + ':00'; }),
+            datasets: [{
+                label: 'Average players',
+                fillColor: 'rgba(243, 156, 18, 0.8)',
+                data: $.map(hours, function (hour) { return Math.round(hour.average * 10) / 10; })
+            }]
+        }, {responsive: true});
+    });
+
+    $.getJSON(basePath + '/api/history/playtime', {limit: 10}, function (players) {
+        var $tbody = $('#playtime').empty();
+        $.each(players, function (i, player) {
+            $('<tr>').append(
+                $('<td>').text(player.username),
+                $('<td>').text((player.seconds / 3600).toFixed(1) + ' hours'),
+                $('<td>').text(player.is_online ? 'Online now' : new Date(player.last_seen * 1000).toLocaleDateString())
+            ).appendTo($tbody);
+        });
+    });
+});
@@ -0,0 +1,141 @@
+/* Keeps the status page up to date using the server-sent events from /events */
+$(function () {
+    // Only the status page of a server is kept up to date
+    if (!window.EventSource || !$('#server-status').length) {
+        return;
+    }
+
+    // Set when the server's pages live under /servers/<slug>
+    var basePath = $('body').data('base-path') || '';
+
+    function icon(name) {
+        return $('<i aria-hidden="true">').addClass('fa fa-' + name);
+    }
+
+    function booleanIcon(value) {
+        return icon(value ? 'check' : 'times');
+    }
+
+    function cell(content) {
+        return $('<td>').append(content);
+    }
+
+    var statuses = {
+        connected: [icon('circle text-green'), ' Online'],
+        connecting: [icon('circle text-yellow'), ' Connecting…']
+    };
+
+    function updateStatus(status) {
+        var content = statuses[status.status] || [
+            $('<span data-toggle="tooltip" data-placement="bottom">')
+                .attr('title', status.last_error || '')
+                .append(icon('circle text-red'), ' Unreachable, information may be out of date')
+        ];
+        $('#server-status').empty().append(content);
+    }
+
+    function updatePlayers(players) {
+        var $tbody = $('#players');
+        $.each(players, function (i, player) {
+            var $row = $tbody.children('tr').filter(function () {
+                return $(this).attr('data-username') === player.username;
+            });
+            if (!$row.length) {
+                $tbody.children('tr.empty').remove();
+                $row = $('<tr>').attr('data-username', player.username).appendTo($tbody);
+            }
+            $row.empty().append(
+                cell(document.createTextNode(player.username)),
+                cell(booleanIcon(player.is_online)),
+                cell(booleanIcon(player.is_admin))
+            );
+        });
+    }
+
+    function updateConfig(config) {
+        if ($.isEmptyObject(config)) {
+            return;
+        }
+        var $tbody = $('#config').empty();
+        $.each(config, function (option, value) {
+            var content = typeof value === 'boolean' ? booleanIcon(value) : document.createTextNode(value);
+            $('<tr>').attr('data-option', option).append(
+                cell(document.createTextNode(option)).addClass('monospace'),
+                cell(content)
+            ).appendTo($tbody);
+        });
+
+        $('#visibility').empty().append(config.visibility_public ?
+            [icon('globe'), ' Publicly listed'] : [icon('user-secret'), ' Not publicly listed']);
+        $('#password').empty().append(config.password ?
+            [icon('lock'), ' Password protected'] : [icon('unlock'), ' No password']);
+    }
+
+    function updateMods(mods) {
+        var $tbody = $('#mods').empty();
+        $.each(mods, function (i, mod) {
+            var name = document.createTextNode(mod.name);
+            if (mod.portal_name) {
+                name = $('<a target="_blank" data-toggle="tooltip" data-placement="left">')
+                    .attr('href', 'https://mods.factorio.com/mods/' + mod.owner + '/' + mod.portal_name)
+                    .attr('title', mod.summary || '')
+                    .append(name);
+            }
+            var download = mod.file_name ? $('<a class="btn btn-default btn-xs">')
+                .attr('href', basePath + '/mods/download/' + encodeURIComponent(mod.file_name))
+                .append(icon('download')) : '';
+            $('<tr>').append(
+                cell(name),
+                cell(document.createTextNode(mod.version || '-')).append(mod.problems.length ? [' ', icon('exclamation-triangle')
+                    .addClass('text-yellow').attr('data-toggle', 'tooltip').attr('title', mod.problems.join('; '))] : []),
+                cell(mod.downloads_count ? mod.downloads_count.toLocaleString() : ''),
+                cell(download)
+            ).appendTo($tbody);
+        });
+        $tbody.find('[data-toggle="tooltip"]').tooltip();
+    }
+
+    function formatSize(bytes) {
+        // Matches jinja's filesizeformat
+        return bytes >= 1e6 ? (bytes / 1e6).toFixed(1) + ' MB' : (bytes / 1e3).toFixed(1) + ' kB';
+    }
+
+    function updateSaves(saves) {
+        var $tbody = $('#saves').empty();
+        $.each(saves, function (i, save) {
+            $('<tr>').append(
+                cell(document.createTextNode(save.name)).attr('title', save.mods.length + ' mods'),
+                cell(document.createTextNode(save.modified.slice(0, 16).replace('T', ' '))),
+                cell(document.createTextNode(formatSize(save.size))),
+                cell(document.createTextNode(save.factorio_version || '-')),
+                cell($('<a class="btn btn-default btn-xs">')
+                    .attr('href', basePath + '/saves/download/' + encodeURIComponent(save.file_name))
+                    .append(icon('download')))
+            ).appendTo($tbody);
+        });
+    }
+
+    function updateSources(sources) {
+        var stale = $.map(sources, function (status, name) {
+            return status.stale ? name : null;
+        });
+        $('#stale-sources').text(stale.join(', '));
+        $('#stale-notice').toggle(stale.length > 0);
+    }
+
+    var handlers = {
+        status: updateStatus,
+        players: updatePlayers,
+        config: updateConfig,
+        mods: updateMods,
+        saves: updateSaves,
+        sources: updateSources
+    };
+
+    var source = new EventSource(basePath + '/events');
+    $.each(handlers, function (event, handler) {
+        source.addEventListener(event, function (e) {
+            handler(JSON.parse(e.data));
+        });
+    });
+});
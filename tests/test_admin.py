@@ -0,0 +1,42 @@
+"""Rate limiting the admin console"""
+from factorio_status_ui.admin import RateLimiter
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_refill():
+    clock = FakeClock()
+    # A command every 2 seconds, after a burst of 2
+    limiter = RateLimiter(rate=30, burst=2, clock=clock)
+    assert [limiter.check('admin') for _ in range(2)] == [0, 0]
+    assert limiter.check('admin') == 2
+
+    # Told to wait for exactly as long as the refill takes
+    clock.now = 0.5
+    assert limiter.check('admin') == 1.5
+    clock.now = 2
+    assert limiter.check('admin') == 0
+    assert limiter.check('admin') == 2
+
+
+def test_users_have_their_own_buckets():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=30, burst=1, clock=clock)
+    assert limiter.check('admin') == 0
+    assert limiter.check('admin') == 2
+    assert limiter.check('other-admin') == 0
+
+
+def test_bucket_refills_up_to_burst():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=30, burst=2, clock=clock)
+    limiter.check('admin')
+    clock.now = 1000
+    assert [limiter.check('admin') for _ in range(3)] == [0, 0, 2]
@@ -0,0 +1,93 @@
+"""Resumable downloads (via Range & If-Range), as served for mods and saves"""
+import asyncio
+import os
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from factorio_status_ui.web import download_response
+
+ETAG = '"0123456789abcdef"'
+CONTENT = os.urandom(100 * 1024)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def download(tmp_path):
+    """Make requests for a file, returning (status, headers, body)"""
+    path = tmp_path / 'some-mod_1.0.0.zip'
+    path.write_bytes(CONTENT)
+
+    async def handler(request):
+        return download_response(request, path, ETAG)
+
+    app = web.Application()
+    app.router.add_get('/download', handler)
+
+    async def requests(*headers_list):
+        results = []
+        async with TestClient(TestServer(app)) as client:
+            for headers in headers_list:
+                response = await client.get('/download', headers=headers)
+                results.append((response.status, response.headers, await response.read()))
+        return results
+
+    return lambda *headers_list: run(requests(*headers_list))
+
+
+def test_whole_file(download):
+    [(status, headers, body)] = download({})
+    assert status == 200
+    assert body == CONTENT
+    assert headers['Content-Disposition'] == 'attachment; filename="some-mod_1.0.0.zip"'
+
+
+def test_range(download):
+    [(status, headers, body)] = download({'Range': 'bytes=100-199', 'If-Range': ETAG})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 100-199/{}'.format(len(CONTENT))
+    assert body == CONTENT[100:200]
+
+
+def test_resume_in_chunks(download):
+    chunk_size = 30 * 1024
+    ranges = [
+        {'Range': 'bytes={}-{}'.format(start, start + chunk_size - 1), 'If-Range': ETAG}
+        for start in range(0, len(CONTENT), chunk_size)
+    ]
+    results = download(*ranges)
+    assert [status for status, _, _ in results] == [206] * len(ranges)
+    assert b''.join(body for _, _, body in results) == CONTENT
+    # The last chunk is cut short at the end of the file
+    assert results[-1][1]['Content-Range'] == 'bytes {}-{}/{}'.format(
+        (len(ranges) - 1) * chunk_size, len(CONTENT) - 1, len(CONTENT)
+    )
+
+
+def test_stale_if_range_gets_whole_file(download):
+    [(status, headers, body)] = download({'Range': 'bytes=100-199', 'If-Range': '"stale"'})
+    assert status == 200
+    assert 'Content-Range' not in headers
+    assert body == CONTENT
+
+
+def test_unsatisfiable_range(download):
+    [(status, headers, _)] = download({'Range': 'bytes={}-'.format(len(CONTENT) + 10)})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */{}'.format(len(CONTENT))
+
+
+def test_not_modified(download):
+    [(status, headers, body)] = download({'If-None-Match': ETAG})
+    assert status == 304
+    assert body == b''
@@ -0,0 +1,76 @@
+"""Streaming the "download all mods" archive from its own threads"""
+import asyncio
+import io
+import os
+import zipfile
+
+import pytest
+
+from factorio_status_ui import mod_archive
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def entries(tmp_path):
+    paths = []
+    for number in range(3):
+        path = tmp_path / 'mod-{}_1.0.0.zip'.format(number)
+        # Larger than a chunk, so that streams block on a full queue
+        path.write_bytes(os.urandom(mod_archive.STREAM_CHUNK_SIZE * 4))
+        paths.append(path)
+    return [(path, 'mods/{}'.format(path.name)) for path in paths]
+
+
+def test_stream(entries):
+    executor = mod_archive.StreamExecutor(1)
+
+    async def download():
+        stream = mod_archive.ArchiveStream(asyncio.get_event_loop())
+        stream.start(entries, executor)
+        try:
+            return b''.join([chunk async for chunk in stream.chunks()])
+        finally:
+            await stream.close()
+
+    with zipfile.ZipFile(io.BytesIO(run(download()))) as archive:
+        assert archive.namelist() == [name for _, name in entries]
+        assert archive.read(entries[0][1]) == entries[0][0].read_bytes()
+    assert executor.active == 0
+
+
+def test_streams_are_limited(entries):
+    executor = mod_archive.StreamExecutor(2)
+
+    async def scenario():
+        loop = asyncio.get_event_loop()
+        # Two slow downloads, each stuck on a full queue
+        streams = [mod_archive.ArchiveStream(loop, max_chunks=1) for _ in range(2)]
+        for stream in streams:
+            stream.start(entries, executor)
+        await asyncio.sleep(0.1)
+        assert executor.active == 2
+
+        with pytest.raises(mod_archive.StreamsBusyError):
+            mod_archive.ArchiveStream(loop).start(entries, executor)
+        # Everything else still has the default executor to itself
+        assert await loop.run_in_executor(None, sum, [1, 2]) == 3
+
+        # Abandoning a download frees its thread
+        await streams[0].close()
+        assert executor.active == 1
+        stream = mod_archive.ArchiveStream(loop)
+        stream.start(entries, executor)
+        await stream.close()
+        await streams[1].close()
+        assert executor.active == 0
+
+    run(scenario())
@@ -0,0 +1,166 @@
+"""The RCON connection pool's backoff & circuit breaker, and its queue of commands"""
+import asyncio
+
+import pytest
+
+from factorio_status_ui import rcon, simulator
+from factorio_status_ui.state import ApplicationConfig, Server
+
+PASSWORD = 'test'
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def make_server(port=0) -> Server:
+    return Server(slug='test', settings=ApplicationConfig(
+        rcon_host='127.0.0.1', rcon_port=port, rcon_password=PASSWORD, rcon_timeout=1,
+        rcon_max_in_flight=4, rcon_max_queue=10,
+    ))
+
+
+async def keep_polling(pool: rcon.RconPool):
+    while True:
+        if pool.is_connected:
+            try:
+                await pool.run_command('/players')
+            except rcon.RconError:
+                pass
+        await asyncio.sleep(0.01)
+
+
+def test_quickly_lost_connections_back_off():
+    # Accepts every connection, but drops it on the first command, like a server crashing on load
+    factorio = simulator.FakeFactorio(password=PASSWORD, drop_rate=1.0, seed=1)
+
+    async def scenario():
+        port = await factorio.start()
+        server = make_server(port)
+        pool = rcon.RconPool(server, min_backoff=0.1, max_backoff=0.1, failure_threshold=3, reset_timeout=60,
+                             min_uptime=1)
+        tasks = [asyncio.ensure_future(pool.run()), asyncio.ensure_future(keep_polling(pool))]
+        await asyncio.sleep(1)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await factorio.close()
+        return server
+
+    server = run(scenario())
+    # Backed off after each drop, then stopped trying once the circuit opened
+    assert factorio.connections == 3
+    assert server.rcon_health.status == 'circuit_open'
+    assert server.rcon_health.last_error.startswith('Connection lost after')
+
+
+def test_stable_connection_forgets_failures():
+    factorio = simulator.FakeFactorio(password=PASSWORD, seed=1)
+
+    async def scenario():
+        port = await factorio.start()
+        server = make_server(port)
+        pool = rcon.RconPool(server, min_backoff=0.1, max_backoff=0.1, failure_threshold=3, min_uptime=0.2)
+        pool._failures = 2
+        tasks = [asyncio.ensure_future(pool.run()), asyncio.ensure_future(keep_polling(pool))]
+        await asyncio.sleep(0.1)
+        # Still counted until the connection has been up for min_uptime
+        assert pool.is_connected and pool._failures == 2
+        await asyncio.sleep(0.3)
+        assert pool._failures == 0
+
+        # So a later drop is reconnected straight away, rather than opening the circuit
+        factorio.disconnect_all()
+        await asyncio.sleep(0.3)
+        assert pool.is_connected
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await factorio.close()
+        return server
+
+    server = run(scenario())
+    assert server.rcon_health.reconnects == 1
+
+
+def test_admin_commands_overtake_queued_polls():
+    async def scenario():
+        queue = rcon.CommandQueue(max_in_flight=1)
+        order = []
+
+        async def command(name, priority):
+            await queue.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0)
+            queue.release()
+
+        await queue.acquire(rcon.PRIORITY_POLL)
+        commands = [asyncio.ensure_future(command(name, rcon.PRIORITY_POLL)) for name in ('poll-1', 'poll-2')]
+        await asyncio.sleep(0)
+        commands.append(asyncio.ensure_future(command('admin', rcon.PRIORITY_ADMIN)))
+        await asyncio.sleep(0)
+        assert queue.waiting == {rcon.PRIORITY_POLL: 2, rcon.PRIORITY_ADMIN: 1}
+
+        queue.release()
+        await asyncio.gather(*commands)
+        assert queue.in_flight == 0
+        return order
+
+    assert run(scenario()) == ['admin', 'poll-1', 'poll-2']
+
+
+def test_too_many_waiting_polls_are_refused():
+    async def scenario():
+        queue = rcon.CommandQueue(max_in_flight=1, max_waiting=2)
+        await queue.acquire(rcon.PRIORITY_POLL)
+        polls = [asyncio.ensure_future(queue.acquire(rcon.PRIORITY_POLL)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(rcon.RconBusyError):
+            await queue.acquire(rcon.PRIORITY_POLL)
+
+        # The backlog of polls doesn't shut out admins
+        admin = asyncio.ensure_future(queue.acquire(rcon.PRIORITY_ADMIN))
+        await asyncio.sleep(0)
+        queue.release()
+        await admin
+        for poll in polls:
+            queue.release()
+            await poll
+        queue.release()
+        assert (queue.in_flight, sum(queue.waiting.values())) == (0, 0)
+
+    run(scenario())
+
+
+def test_cancelled_waiters_dont_leak_slots():
+    async def scenario():
+        queue = rcon.CommandQueue(max_in_flight=1)
+        await queue.acquire(rcon.PRIORITY_POLL)
+        first, second, third = [asyncio.ensure_future(queue.acquire(rcon.PRIORITY_POLL)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        # Cancelled while still waiting, so it is skipped
+        first.cancel()
+        await asyncio.sleep(0)
+        assert queue.waiting[rcon.PRIORITY_POLL] == 2
+
+        # Handed the slot, but cancelled before it could run, so it passes the slot on
+        queue.release()
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await third
+        assert first.cancelled() and second.cancelled()
+        assert queue.in_flight == 1
+
+        queue.release()
+        assert (queue.in_flight, sum(queue.waiting.values())) == (0, 0)
+        # So a new command goes straight through
+        await asyncio.wait_for(queue.acquire(rcon.PRIORITY_POLL), 1)
+
+    run(scenario())
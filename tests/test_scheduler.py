@@ -0,0 +1,150 @@
+"""The polling scheduler, driven by a fake clock"""
+import asyncio
+
+import pytest
+
+from factorio_status_ui.scheduler import Scheduler
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_job(clock: FakeClock, runs: list, name: str, duration=0.0):
+    """A job which records when it runs, and takes duration seconds by the clock"""
+    async def job():
+        runs.append((name, clock.now))
+        clock.now += duration
+    return job
+
+
+async def run_pending(scheduler: Scheduler):
+    """Start the due jobs, and let them finish"""
+    delay = scheduler.run_pending()
+    for _ in range(3):
+        await asyncio.sleep(0)
+    return delay
+
+
+def test_stagger(clock):
+    async def scenario():
+        scheduler = Scheduler(clock=clock)
+        runs = []
+        for name in ('players', 'config', 'history'):
+            scheduler.add(name, make_job(clock, runs, name), 3)
+        scheduler.last_viewed = clock.now
+        scheduler.stagger()
+        assert [job.next_run for job in scheduler.jobs] == [0, 1, 2]
+
+        assert await run_pending(scheduler) == 1
+        clock.now = 1
+        assert await run_pending(scheduler) == 1
+        clock.now = 2
+        await run_pending(scheduler)
+        return runs
+
+    assert run(scenario()) == [('players', 0), ('config', 1), ('history', 2)]
+
+
+def test_idle_factor(clock):
+    async def scenario():
+        scheduler = Scheduler(idle_factor=10, idle_after=60, clock=clock)
+        runs = []
+        players = scheduler.add('players', make_job(clock, runs, 'players'), 1)
+        history = scheduler.add('history', make_job(clock, runs, 'history'), 1, adaptive=False)
+        scheduler.last_viewed = clock.now
+        scheduler.stagger()
+        for job in scheduler.jobs:
+            job.next_run = 0
+
+        # Viewed recently, so at the base interval
+        await run_pending(scheduler)
+        assert (players.next_run, history.next_run) == (1, 1)
+
+        # Nobody has looked for a while, so adaptive jobs are stretched
+        clock.now = 100
+        await run_pending(scheduler)
+        assert (players.next_run, history.next_run) == (110, 101)
+
+        # A viewer connected to /events keeps the rate up
+        scheduler.viewers = lambda: 1
+        clock.now = 110
+        await run_pending(scheduler)
+        assert players.next_run == 111
+
+    run(scenario())
+
+
+def test_load_backoff(clock):
+    async def scenario():
+        scheduler = Scheduler(load_factor=4, clock=clock)
+        runs = []
+        slow = scheduler.add('slow', make_job(clock, runs, 'slow', duration=2), 1)
+        fixed = scheduler.add('fixed', make_job(clock, runs, 'fixed', duration=2), 1, adaptive=False)
+        scheduler.last_viewed = clock.now
+        scheduler.stagger()
+        for job in scheduler.jobs:
+            job.next_run = 0
+
+        await run_pending(scheduler)
+        # Each took 2s by the clock, so the adaptive job waits for 4 times that
+        assert slow.next_run == slow.last_started + 8
+        assert fixed.next_run == fixed.last_started + 1
+
+        # The duration is smoothed, so one quick run only brings it down a little
+        slow.func = make_job(clock, runs, 'slow')
+        clock.now = slow.next_run
+        scheduler.viewed()
+        await run_pending(scheduler)
+        assert slow.next_run == pytest.approx(slow.last_started + 2 * 0.7 * 4)
+
+    run(scenario())
+
+
+def test_viewed_catches_up_after_idle(clock):
+    async def scenario():
+        scheduler = Scheduler(idle_factor=10, idle_after=60, clock=clock)
+        runs = []
+        players = scheduler.add('players', make_job(clock, runs, 'players'), 1)
+        scheduler.last_viewed = clock.now
+        scheduler.stagger()
+
+        clock.now = 100
+        players.next_run = 100
+        await run_pending(scheduler)
+        assert players.next_run == 110
+
+        # A viewer arrives, and the job is overdue at its base interval, so runs at once
+        clock.now = 103
+        scheduler.viewed()
+        assert players.next_run == 101
+        await run_pending(scheduler)
+        assert runs == [('players', 100), ('players', 103)]
+        assert players.next_run == 104
+
+        # Viewing again while not idle changes nothing
+        clock.now = 103.5
+        scheduler.viewed()
+        assert players.next_run == 104
+
+    run(scenario())
@@ -0,0 +1,203 @@
+"""End-to-end: the status UI polling a simulated Factorio server, checked through the JSON API"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from factorio_status_ui import serve, simulator, web as status_web
+from factorio_status_ui.state import application_config, configure_servers, servers
+
+PASSWORD = 'test'
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+async def wait_for(condition, timeout=10, interval=0.05):
+    """Wait until the coroutine function condition() returns something true, returning it"""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = await condition()
+        if result or time.monotonic() > deadline:
+            return result
+        await asyncio.sleep(interval)
+
+
+class Environment(object):
+    """A simulated Factorio server & mod portal, and the status UI monitoring them"""
+
+    def __init__(self, directory, factorio: simulator.FakeFactorio, *arguments):
+        self.directory = directory
+        self.factorio = factorio
+        self.arguments = arguments
+        self.portal = None
+        self.client = None
+
+    async def __aenter__(self):
+        names = simulator.make_mods_directory(self.directory / 'mods', 3, seed=1)
+        self.portal = simulator.FakeModPortal(names, seed=1)
+        await self.portal.start()
+        rcon_port = await self.factorio.start()
+
+        arguments = serve.get_parser().parse_args([
+            '--rcon-host=127.0.0.1', '--rcon-port={}'.format(rcon_port), '--rcon-password={}'.format(PASSWORD),
+            '--poll-players-interval=0.1', '--poll-config-interval=0.1', '--poll-idle-factor=1',
+            '--server-host=127.0.0.1', '--mods-directory={}'.format(self.directory / 'mods'),
+            '--mod-portal-url={}'.format(self.portal.url),
+            '--mod-portal-cache={}'.format(self.directory / 'mod-portal.json'),
+            '--all-mods-directory={}'.format(self.directory / 'all-mods'),
+            '--snapshot-directory={}'.format(self.directory / 'snapshot'),
+            '--history-directory={}'.format(self.directory / 'history'),
+        ] + list(self.arguments))
+        for option in dir(application_config):
+            if not option.startswith('_'):
+                setattr(application_config, option, getattr(arguments, option))
+        configure_servers()
+
+        app = web.Application()
+        status_web.setup_routes(app)
+        app.on_startup.append(status_web.start_background_tasks)
+        app.on_cleanup.append(status_web.cleanup_background_tasks)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.close()
+        await self.portal.close()
+        await self.factorio.close()
+
+    async def api(self, document: str):
+        response = await self.client.get('/api/{}'.format(document))
+        assert response.status == 200
+        return await response.json()
+
+    async def online_players(self) -> set:
+        return {player['username'] for player in await self.api('players') if player['is_online']}
+
+    async def wait_for_players(self, expected: set):
+        async def matches():
+            return await self.online_players() == expected
+        assert await wait_for(matches), 'Online players never became {}'.format(sorted(expected))
+
+
+@pytest.fixture
+def factorio():
+    return simulator.FakeFactorio(password=PASSWORD, players=50, online=10, admins=2, seed=1)
+
+
+def test_players_follow_churn(tmp_path, factorio):
+    async def scenario():
+        async with Environment(tmp_path, factorio) as environment:
+            await environment.wait_for_players(factorio.online)
+            admins = {player['username'] for player in await environment.api('players') if player['is_admin']}
+            assert admins == factorio.admins
+
+            for _ in range(3):
+                factorio.churn(5)
+                await environment.wait_for_players(set(factorio.online))
+
+            factorio.join('newcomer')
+            await environment.wait_for_players(set(factorio.online))
+            assert 'newcomer' in {player['username'] for player in await environment.api('players')}
+
+    run(scenario())
+
+
+def test_reconnects_after_connection_drops(tmp_path, factorio):
+    async def scenario():
+        async with Environment(tmp_path, factorio) as environment:
+            await environment.wait_for_players(factorio.online)
+            connections = factorio.connections
+
+            factorio.disconnect_all()
+
+            async def reconnected():
+                status = await environment.api('status')
+                return status['rcon']['status'] == 'connected' and factorio.connections > connections
+            assert await wait_for(reconnected)
+            assert servers['default'].rcon_health.reconnects == 1
+
+            # Polling carries on over the new connection
+            factorio.churn(5)
+            await environment.wait_for_players(set(factorio.online))
+
+    run(scenario())
+
+
+def test_config_changes(tmp_path, factorio):
+    async def scenario():
+        async with Environment(tmp_path, factorio) as environment:
+            async def config():
+                return (await environment.api('status'))['config']
+            assert (await wait_for(config))['max_players'] == '0'
+
+            factorio.config['max-players'] = '16'
+            factorio.config['password'] = 'The server currently has a password'
+
+            async def changed():
+                current = await config()
+                return current if current['max_players'] == '16' else None
+            current = await wait_for(changed)
+            assert current, 'The config change was never picked up'
+            assert current['password'] is True
+
+    run(scenario())
+
+
+def test_mods_with_portal_records(tmp_path, factorio):
+    async def scenario():
+        async with Environment(tmp_path, factorio) as environment:
+            async def mods():
+                mods = {mod['name']: mod for mod in await environment.api('mods')}
+                # The portal is only asked once the servers' own state is in
+                return mods if mods.get('mod-0', {}).get('owner') else None
+            mods = await wait_for(mods)
+            assert mods, 'The mod portal records were never loaded'
+            assert set(mods) == {'base', 'mod-0', 'mod-1', 'mod-2'}
+            assert mods['mod-2']['summary'] == 'Summary of mod-2'
+            assert all(mod['enabled'] and not mod['problems'] for mod in mods.values())
+
+            url = '/mods/download/{}'.format(mods['mod-0']['file_name'])
+            responses = await asyncio.gather(*[environment.client.get(url) for _ in range(5)])
+            assert [response.status for response in responses] == [200] * 5
+            assert len({response.headers['ETag'] for response in responses}) == 1
+
+    run(scenario())
+
+
+def test_admin_commands_are_rate_limited(tmp_path, factorio):
+    tokens_file = tmp_path / 'admin-tokens.json'
+    tokens_file.write_text('{"admin": "secret"}')
+
+    async def scenario():
+        async with Environment(tmp_path, factorio, '--admin-tokens-file={}'.format(tokens_file),
+                               '--admin-rate-limit=20', '--admin-rate-burst=2') as environment:
+            await environment.wait_for_players(factorio.online)
+
+            async def command():
+                return await environment.client.post('/api/admin/command', json={'command': '/players'},
+                                                     headers={'Authorization': 'Bearer secret'})
+            for _ in range(2):
+                response = await command()
+                assert response.status == 200
+                assert (await response.json())['response'].startswith('Players (50):')
+
+            # 20 a minute is one every 3 seconds
+            response = await command()
+            assert response.status == 429
+            assert response.headers['Retry-After'] == '3'
+
+            response = await environment.client.post('/api/admin/command', json={'command': '/players'})
+            assert response.status == 401
+
+    run(scenario())
@@ -0,0 +1,40 @@
+"""Turning the differences between snapshots into events"""
+import pickle
+from datetime import datetime
+from pathlib import Path
+
+from factorio_status_ui import events, snapshot
+from factorio_status_ui.saves import Save
+from factorio_status_ui.state import ApplicationConfig, Server
+
+
+def make_server() -> Server:
+    server = Server(slug='test', settings=ApplicationConfig())
+    server.players.set_online({'player-1', 'player-2'})
+    server.saves = (Save(file=Path('/saves/some-save.zip'), size=1234, modified=datetime(2020, 1, 1)),)
+    return server
+
+
+def publish_changes(server: Server, monkeypatch, change=None):
+    """Publish the changes from the server's state to a copy of it, as read back from a snapshot"""
+    published = []
+    monkeypatch.setattr(events, 'publish', lambda slug, name, data: published.append((name, data)))
+    previous = snapshot.server_state(server)
+    previous['mods'] = [mod.as_dict() for mod in server.mods]
+    current = pickle.loads(pickle.dumps(snapshot.server_state(server)))
+    if change:
+        change(current)
+    snapshot.publish_changes(server, previous, current)
+    return published
+
+
+def test_unchanged_snapshot_publishes_nothing(monkeypatch):
+    assert publish_changes(make_server(), monkeypatch) == []
+
+
+def test_changed_saves_are_published(monkeypatch):
+    def change(current):
+        current['saves'][0].size = 5678
+
+    published = publish_changes(make_server(), monkeypatch, change)
+    assert [(name, [save['size'] for save in data]) for name, data in published] == [('saves', [5678])]
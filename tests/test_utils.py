@@ -0,0 +1,70 @@
+"""File ETags, shared between concurrent requests"""
+import asyncio
+import os
+import threading
+
+from factorio_status_ui import utils
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def counting_file_etag(monkeypatch):
+    """Count the files hashed, slowly enough that requests overlap"""
+    hashed = []
+    file_etag = utils.file_etag
+    lock = threading.Lock()
+
+    def counting(path):
+        with lock:
+            hashed.append(path)
+        threading.Event().wait(0.1)
+        return file_etag(path)
+
+    monkeypatch.setattr(utils, 'file_etag', counting)
+    return hashed
+
+
+def test_concurrent_requests_share_one_hash(tmp_path, monkeypatch):
+    hashed = counting_file_etag(monkeypatch)
+    path = tmp_path / 'some-mod_1.0.0.zip'
+    path.write_bytes(b'some mod')
+    etags = utils.FileEtags(lambda: {path})
+
+    async def scenario():
+        first = await asyncio.gather(*[etags.get(path) for _ in range(20)])
+        again = await etags.get(path)
+        path.write_bytes(b'some mod, rebuilt')
+        changed = await etags.get(path)
+        return first, again, changed
+
+    first, again, changed = run(scenario())
+    assert len(set(first)) == 1
+    assert again == first[0]
+    assert changed != first[0]
+    assert hashed == [path, path]
+
+
+def test_forgets_files_no_longer_kept(tmp_path, monkeypatch):
+    counting_file_etag(monkeypatch)
+    paths = [tmp_path / 'mod-{}_1.0.0.zip'.format(number) for number in range(3)]
+    for path in paths:
+        path.write_bytes(os.urandom(10))
+    keep = set(paths)
+    etags = utils.FileEtags(lambda: keep)
+
+    async def scenario():
+        for path in paths[:2]:
+            await etags.get(path)
+        keep.remove(paths[0])
+        await etags.get(paths[2])
+
+    run(scenario())
+    assert set(etags._etags) == set(paths[1:])
@@ -0,0 +1,101 @@
+"""Scanning the mods directory, and surviving it being missing or half written"""
+import asyncio
+import json
+
+from factorio_status_ui.state import Server, State
+from factorio_status_ui.watcher import ModDirectoryScanner
+from factorio_status_ui.web import poll_local_mods
+
+MOD_LIST = {'mods': [{'name': 'base', 'enabled': True}]}
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def write_mod_list(directory, content=MOD_LIST):
+    directory.mkdir(exist_ok=True)
+    (directory / 'mod-list.json').write_text(content if isinstance(content, str) else json.dumps(content))
+
+
+def test_scan_only_reports_changes(tmp_path):
+    write_mod_list(tmp_path)
+    (tmp_path / 'some-mod_1.0.0.zip').write_bytes(b'')
+    scanner = ModDirectoryScanner(tmp_path)
+    assert scanner.scan() == (MOD_LIST['mods'], {}, [tmp_path / 'some-mod_1.0.0.zip'])
+    assert scanner.scan() is None
+
+    (tmp_path / 'some-mod_1.0.0.zip').unlink()
+    assert scanner.scan() == (MOD_LIST['mods'], {}, [])
+
+
+def test_scan_waits_for_missing_directory(tmp_path):
+    directory = tmp_path / 'mods'
+    scanner = ModDirectoryScanner(directory)
+    assert scanner.scan() is None
+    assert scanner.scan() is None
+
+    write_mod_list(directory)
+    assert scanner.scan() == (MOD_LIST['mods'], {}, [])
+
+
+def test_scan_waits_for_half_written_files(tmp_path):
+    write_mod_list(tmp_path)
+    scanner = ModDirectoryScanner(tmp_path)
+    assert scanner.scan() is not None
+
+    write_mod_list(tmp_path, '{"mods": [{"name": "ba')
+    assert scanner.scan() is None
+    write_mod_list(tmp_path, {'mods': MOD_LIST['mods'] + [{'name': 'some-mod', 'enabled': False}]})
+    (tmp_path / 'mod-settings.json').write_text('{"startup":')
+    assert scanner.scan() is None
+
+    (tmp_path / 'mod-settings.json').write_text('{"startup": {}}')
+    mod_list, mod_settings, _ = scanner.scan()
+    assert [mod['name'] for mod in mod_list] == ['base', 'some-mod']
+    assert mod_settings == {'startup': {}}
+
+
+def poll(directory, changes):
+    """Poll the directory, making each of the changes in turn, and return what the handler saw"""
+    server = Server(slug='test', settings=State(
+        mods_directory=directory, mods_watcher='poll', saves_directory=None
+    ))
+    handled = []
+
+    async def scenario():
+        poller = asyncio.ensure_future(
+            poll_local_mods(server, lambda mod_data, *args: handled.append(mod_data), interval=0.01)
+        )
+        for change in changes:
+            await asyncio.sleep(0.05)
+            assert not poller.done()
+            assert server.sources['mods'].is_warm
+            change()
+        await asyncio.sleep(0.05)
+        poller.cancel()
+        await poller
+
+    run(scenario())
+    return handled
+
+
+def test_poller_survives_missing_directory(tmp_path):
+    directory = tmp_path / 'mods'
+    handled = poll(directory, [lambda: write_mod_list(directory)])
+    assert handled == [MOD_LIST['mods']]
+
+
+def test_poller_survives_half_written_files(tmp_path):
+    write_mod_list(tmp_path)
+    handled = poll(tmp_path, [
+        lambda: write_mod_list(tmp_path, '{"mods": '),
+        lambda: write_mod_list(tmp_path, {'mods': []}),
+    ])
+    assert handled == [MOD_LIST['mods'], []]